@@ -2,6 +2,7 @@
 """
 Contains Sentinel-2 Level-1 radiometric configuration
 """
+import datetime
 
 Lref = [129.11, 128, 128, 108, 74.6, 68.23, 66.70, 103, 52.39, 8.77, 6, 4, 1.70]
 
@@ -27,3 +28,11 @@ u_diff_absarray = {'Sentinel-2A': [1.09, 1.08, 0.84, 0.73, 0.68, 0.97, 0.83, 0.8
 u_diff_temp_rate = {'Sentinel-2A': [0.15, 0.09, 0.04, 0.02, 0.01, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
                     'Sentinel-2B': [0.15, 0.09, 0.04, 0.02, 0.01, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]}
 
+# fixed uncertainties [%] of the diffuser and of the gamma correction, assumed same for S2A/S2B (AIRBUS 2015)
+u_diff_cos = 0.4  # from 0.13° diffuser planarity/micro
+u_diff_k = 0.3  # conservative residual
+u_gamma = 0.4
+
+# S2A launch date 23-june-2015 and S2B launch date 7-march-2017, time is indifferent.
+time_init = {'Sentinel-2A': datetime.datetime(2015, 6, 23, 10, 00),
+             'Sentinel-2B': datetime.datetime(2017, 3, 7, 10, 00)}
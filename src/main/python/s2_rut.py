@@ -4,33 +4,50 @@ Created on Wed Jan 20 13:48:33 2016
 
 @author: jg9
 """
-import snappy
-from snappy import HashMap as hash
 import s2_rut_algo
+import s2_rut_backends
+import s2_rut_lut
+import s2_rut_region
+import s2_rut_roi
+import s2_rut_sza
+import s2_rut_timing
 import numpy as np
 import datetime
+import math
 import os
+import threading
 
-try:
-    import xml.etree.cElementTree as ET  # C implementation is much faster and consumes significantly less memory
-except ImportError:
-    import xml.etree.ElementTree as ET
 import s2_l1_rad_conf as rad_conf
 
 # necessary for logging
 # from snappy import SystemUtils
 
 S2_MSI_TYPE_STRING = 'S2_MSI_Level-1C'
-S2_BAND_NAMES = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B8A', 'B9', 'B10', 'B11', 'B12']
-S2_BAND_SAMPLING = {'B1': 60, 'B2': 10, 'B3': 10, 'B4': 10, 'B5': 20, 'B6': 20, 'B7': 20, 'B8': 10, 'B8A': 20, 'B9': 60,
-                    'B10': 60, 'B11': 20, 'B12': 20}
+from s2_rut_algo import S2_BAND_NAMES, S2_BAND_SAMPLING, S2_BAND_MASKS, S2_CLOUD_MASKS, S2_CONTRIBUTOR_TAGS
 
-# If a Java type is needed which is not imported by snappy by default it can be retrieved manually.
-# First import jpy and then the type to be imported
-from snappy import jpy
+# snappy and the Java types are imported by the first initialize (see import_snappy), so that importing this module
+# neither starts the JVM nor looks up Java types
+snappy = None
+MetadataElement = None
+MetadataAttribute = None
+CrsGeoCoding = None
+Rectangle = None
 
-MetadataElement = jpy.get_type('org.esa.snap.core.datamodel.MetadataElement')
-MetadataAttribute = jpy.get_type('org.esa.snap.core.datamodel.MetadataAttribute')
+
+def import_snappy():
+    global snappy, MetadataElement, MetadataAttribute, CrsGeoCoding, Rectangle
+    if snappy is not None:
+        return
+    import snappy as snappy_module
+    # If a Java type is needed which is not imported by snappy by default it can be retrieved manually.
+    # First import jpy and then the type to be imported
+    from snappy import jpy
+
+    MetadataElement = jpy.get_type('org.esa.snap.core.datamodel.MetadataElement')
+    MetadataAttribute = jpy.get_type('org.esa.snap.core.datamodel.MetadataAttribute')
+    CrsGeoCoding = jpy.get_type('org.esa.snap.core.datamodel.CrsGeoCoding')
+    Rectangle = jpy.get_type('java.awt.Rectangle')
+    snappy = snappy_module
 
 
 class S2RutOp:
@@ -44,16 +61,36 @@ class S2RutOp:
         self.rut_algo = s2_rut_algo.S2RutAlgo()
         self.unc_band = None
         self.toa_band = None
-        # S2A launch date 23-june-2015 and S2A launch date 7-march-2017, time is indifferent.
-        self.time_init = {'Sentinel-2A': datetime.datetime(2015, 6, 23, 10, 00),
-                          'Sentinel-2B': datetime.datetime(2017, 3, 7, 10, 00)}
+        self.time_init = rad_conf.time_init
         self.sourceBandMap = None
         self.targetBandList = []
+        self.band_sources = {}  # (source band, contributor index) of every target band. Index None for the total
         self.inforoot = None
         self.rut_product_meta = None
-        self.source_sza = None
+        self.sza_grid = None  # coarse SZA grid of the product (S2SzaGrid), read on the first SZA request
+        self.sza_geometry = {}  # raster geometry of each resolution, on its first SZA request (see get_sza_geometry)
+        self.resolution_bands = {}  # a selected source band of each sampling (10, 20, 60)
+        self.region = None  # subset (x, y, width, height) in pixels of the 10 m bands, aligned to 60 m. None if full
+        self.overview_factor = 1  # a target pixel is a block of overview_factor x overview_factor source pixels
+        self.roi_sites = []  # (name, lat, lon) of the ROI table sites
+        self.roi_sizes = []  # ROI widths of the ROI table [m]
+        self.band_coeffs = None  # S2RutBandCoeffs of the selected bands, indexed by band id
+        self.kernel_params = {}  # S2RutKernelParams of the target bands, indexed by (band id, contributor index)
+        self.backend = 'auto'  # requested compute backend of the uncertainty kernel (see s2_rut_backends)
+        self.backend_name = None  # backend actually used, loaded in initialize for the metadata
+        self.kernel = None
+        self.thread_buffers = threading.local()  # kernel scratch and mask buffers of each tile thread
+        self.band_luts = {}  # S2RutLut of the selected bands, indexed by band id, built on the first tile of the band
+        self.lut_sza_step = None  # width of the SZA bins of the LUTs [deg]. None if LUT mode is off
+        self.lazy_lock = threading.Lock()  # guards the inputs created by the first tile that needs them
+        self.tile_stack = False  # computes all bands of a resolution together in computeTileStack
+        self.masks = {}  # Mask nodes of the source product by name, cast once
+        self.timer = s2_rut_timing.S2RutNullTimer()  # per-stage timing, S2RutTimer when enabled
+        self.timing_file = None  # JSON sidecar receiving the timing statistics
+        self.statistics_meta = None  # Processing_statistics metadata element, filled in dispose
 
     def initialize(self, context):
+        import_snappy()
         self.source_product = context.getSourceProduct()
 
         if self.source_product.getProductType() != S2_MSI_TYPE_STRING:
@@ -81,9 +118,29 @@ class S2RutOp:
         # for granule_meta in granules_meta.getElements():
         #     tecta += self.get_tecta(granule_meta)
         # self.rut_algo.tecta = tecta / granules_meta.getNumElements()
-        self.source_sza = self.get_tecta()
         self.rut_algo.k = self.get_k(context)
         self.rut_algo.unc_select = self.get_unc_select(context)
+        self.tile_stack = context.getParameter('tile_stack')
+        self.backend = context.getParameter('backend') or 'auto'
+        s2_rut_backends.check_backend_name(self.backend)
+        contributor_tags = context.getParameter('contributor_bands') or []
+        for tag in contributor_tags:
+            if tag not in S2_CONTRIBUTOR_TAGS:
+                raise RuntimeError('Contributor "' + tag + '" is not valid. Valid contributors are ' +
+                                   ', '.join(S2_CONTRIBUTOR_TAGS))
+        self.roi_sites = self.get_roi_sites(context.getParameter('roi_centres') or [])
+        self.roi_sizes = list(context.getParameter('roi_sizes') or [])
+        if self.roi_sites and (not context.getParameter('roi_table') or not self.roi_sizes):
+            raise RuntimeError('The ROI table file and the ROI sizes must be given with the ROI centres')
+        self.region = self.get_region(context)
+        overview_level = context.getParameter('overview_level') or 0
+        if overview_level < 0:
+            raise RuntimeError('The overview level must be 0 (full resolution) or higher')
+        self.overview_factor = 2 ** overview_level
+        timing = context.getParameter('timing') or os.environ.get(s2_rut_timing.TIMING_ENV, '') not in ('', '0')
+        self.timer = s2_rut_timing.create_timer(timing)
+        if timing and context.getParameter('timing_file'):
+            self.timing_file = context.getParameter('timing_file')
 
         self.sourceBandMap = {}
         for name in self.toa_band_names:
@@ -95,14 +152,40 @@ class S2RutOp:
                     raise RuntimeError('Source band "' + name + '" is not valid and has not been processed')
 
             source_band = self.source_product.getBand(name)
-            unc_toa_band = snappy.Band(name + '_rut', snappy.ProductData.TYPE_UINT8, source_band.getRasterWidth(),
-                                       source_band.getRasterHeight())
+            width, height = self.get_target_size(source_band)
+            unc_toa_band = snappy.Band(name + '_rut', snappy.ProductData.TYPE_UINT8, width, height)
             unc_toa_band.setDescription('Uncertainty of ' + name + ' (coverage factor k=' + str(self.rut_algo.k) + ')')
             unc_toa_band.setNoDataValue(250)
             unc_toa_band.setNoDataValueUsed(True)
             self.targetBandList.append(unc_toa_band)
             self.sourceBandMap[unc_toa_band] = source_band
-            snappy.ProductUtils.copyGeoCoding(source_band, unc_toa_band)
+            self.band_sources[unc_toa_band] = (source_band, None)
+            self.set_target_geocoding(source_band, unc_toa_band)
+
+            # contributor bands: uncertainty of a single contributor, encoded as the total uncertainty band
+            for tag in contributor_tags:
+                contributor_band = snappy.Band(name + '_rut_' + tag, snappy.ProductData.TYPE_UINT8, width, height)
+                contributor_band.setDescription('Uncertainty of ' + name + ' due to ' + tag + ' only (coverage factor k='
+                                                + str(self.rut_algo.k) + ')')
+                contributor_band.setNoDataValue(250)
+                contributor_band.setNoDataValueUsed(True)
+                self.targetBandList.append(contributor_band)
+                self.band_sources[contributor_band] = (source_band, S2_CONTRIBUTOR_TAGS.index(tag))
+                self.set_target_geocoding(source_band, contributor_band)
+
+        self.resolution_bands = dict((S2_BAND_SAMPLING[band.getName()], band) for band in self.sourceBandMap.values())
+        # the metadata is only walked here, computeTile looks up the coefficients by band id
+        self.band_coeffs = self.get_band_coeffs([S2_BAND_NAMES.index(band.getName())
+                                                 for band in self.sourceBandMap.values()])
+        # immutable kernel constants: the tiles only read them, so GPF can compute tiles on several threads
+        for source_band, index in self.band_sources.values():
+            band_id = S2_BAND_NAMES.index(source_band.getName())
+            unc_select = None if index is None else s2_rut_algo.contributor_select(index)
+            self.kernel_params[(band_id, index)] = self.rut_algo.kernel_params(self.band_coeffs[band_id], unc_select)
+        if context.getParameter('lut_mode'):
+            self.lut_sza_step = context.getParameter('lut_sza_step')
+        if self.roi_sites:
+            s2_rut_roi.write_roi_table(context.getParameter('roi_table'), self.get_roi_rows())
 
         masterband = self.get_masterband(self.targetBandList)
         rut_product = snappy.Product(self.source_product.getName() + '_rut', 'S2_RUT',
@@ -147,6 +230,25 @@ class S2RutOp:
             sourceattr.setData(data)
             sourceelem.addAttribute(sourceattr)
         self.rut_product_meta.addElement(sourceelem)
+        # SUBSET REGION: pixels of the 10 m bands processed, only for a subset
+        if self.region is not None:
+            sourceelem = MetadataElement('Subset_region')
+            data = snappy.ProductData.createInstance('%d,%d,%d,%d' % self.region)
+            sourceattr = MetadataAttribute("REGION", snappy.ProductData.TYPE_ASCII, data.getNumElems())
+            sourceattr.setData(data)
+            sourceelem.addAttribute(sourceattr)
+            self.rut_product_meta.addElement(sourceelem)
+        # OVERVIEW LEVEL: the target bands are overviews of 2^level x 2^level pixel blocks, only for an overview
+        if self.overview_factor > 1:
+            sourceelem = MetadataElement('Overview_level')
+            self.set_text_attribute(sourceelem, 'OVERVIEW_LEVEL', str(overview_level))
+            self.rut_product_meta.addElement(sourceelem)
+        # COMPUTE BACKEND: implementation of the uncertainty kernel actually used, after the fallbacks. The header is
+        # written before any tile is computed, so the backend is loaded here
+        sourceelem = MetadataElement('Compute_backend')
+        self.get_kernel()
+        self.set_text_attribute(sourceelem, 'BACKEND', self.backend_name)
+        self.rut_product_meta.addElement(sourceelem)
         # DATE OF PROCESSING
         sourceelem = MetadataElement('Processing_datetime')
         data = snappy.ProductData.createInstance(str(datetime.datetime.now()))
@@ -154,6 +256,20 @@ class S2RutOp:
         sourceattr.setData(data)
         sourceelem.addAttribute(sourceattr)
         self.rut_product_meta.addElement(sourceelem)
+        # PROCESSING STATISTICS: per-stage timing of the bands, only when the timing is enabled. Filled in dispose, also
+        # in the BEAM-DIMAP header already written
+        if timing:
+            self.statistics_meta = MetadataElement('Processing_statistics')
+            self.rut_product_meta.addElement(self.statistics_meta)
+        # LUT ERROR BOUND: maximum deviation from the analytic calculation [%] when LUT mode is used. The LUTs of the
+        # uncertainty bands are built here for the header
+        if self.lut_sza_step:
+            sourceelem = MetadataElement('LUT_error_bound')
+            for band_id in sorted(set(S2_BAND_NAMES.index(source_band.getName())
+                                      for source_band, index in self.band_sources.values() if index is None)):
+                self.set_text_attribute(sourceelem, S2_BAND_NAMES[band_id],
+                                        str(self.get_band_lut(band_id).error_bound() / 10.0))
+            self.rut_product_meta.addElement(sourceelem)
 
         context.setTargetProduct(rut_product)
 
@@ -162,79 +278,194 @@ class S2RutOp:
         # SystemUtils.LOG.info('target band name: ' + band.getName())
         # SystemUtils.LOG.info('tile rect: ' + tile.getRectangle().toString())
 
-        source_band = self.sourceBandMap[band]
-        toa_band_id = np.int(S2_BAND_NAMES.index(source_band.getName()))
-
-        if S2_BAND_SAMPLING[source_band.getName()] == 10:  # selects the correct resampled SZA band
-            source_sza = self.source_sza[0]
-            cloudmask = self.mask_roi('opaque_clouds_10m', tile.getRectangle())
-            cirrusmask = self.mask_roi('cirrus_clouds_10m', tile.getRectangle())
-        elif S2_BAND_SAMPLING[source_band.getName()] == 20:
-            source_sza = self.source_sza[1]
-            cloudmask = self.mask_roi('opaque_clouds_20m', tile.getRectangle())
-            cirrusmask = self.mask_roi('cirrus_clouds_20m', tile.getRectangle())
-        elif S2_BAND_SAMPLING[source_band.getName()] == 60:
-            source_sza = self.source_sza[2]
-            cloudmask = self.mask_roi('opaque_clouds_60m', tile.getRectangle())
-            cirrusmask = self.mask_roi('cirrus_clouds_60m', tile.getRectangle())
-
-        sza_tile = context.getSourceTile(source_sza, tile.getRectangle())  # selects the tile SZA values
-        sza_samples = sza_tile.getSamplesFloat()
-        self.rut_algo.tecta = sza_samples
-
-        self.rut_algo.a = self.get_a(self.datastrip_meta, toa_band_id)
-        self.rut_algo.e_sun = self.get_e_sun(self.product_meta, toa_band_id)
-        self.rut_algo.alpha = self.get_alpha(self.datastrip_meta, toa_band_id)
-        self.rut_algo.beta = self.get_beta(self.datastrip_meta, toa_band_id)
-        self.rut_algo.u_diff_temp = self.get_u_diff_temp(self.datastrip_meta, toa_band_id)
-
-        toa_tile = context.getSourceTile(source_band, tile.getRectangle())
-        toa_samples = toa_tile.getSamplesFloat()
-
-        # this is the core where the uncertainty calculation should grow
-        unc = self.rut_algo.unc_calculation(np.array(toa_samples, dtype=np.float64), toa_band_id, self.spacecraft)
-
-        degrademask = self.mask_roi('msi_degraded_' + source_band.getName(), tile.getRectangle())
-        lostmask = self.mask_roi('msi_lost_' + source_band.getName(), tile.getRectangle())
-        defectmask = self.mask_roi('defective_' + source_band.getName(), tile.getRectangle())
-        invalidmask = np.maximum(np.maximum(degrademask, lostmask), defectmask)
-        satl1amask = self.mask_roi('saturated_l1a_' + source_band.getName(), tile.getRectangle())
-        satl1bmask = self.mask_roi('saturated_l1b_' + source_band.getName(), tile.getRectangle())
-        satl1mask = np.maximum(satl1amask, satl1bmask)
-        nodatamask = self.mask_roi('nodata_' + source_band.getName(), tile.getRectangle())
-        # selects the maximum element-wise. Mask true value is 255. This is higher than 250 (max uncertainty permitted)
+        source_band, index = self.band_sources[band]
+        resolution_inputs = self.get_resolution_inputs(context, S2_BAND_SAMPLING[source_band.getName()],
+                                                       tile.getRectangle())
+        self.compute_band_tile(context, source_band, [(index, tile)], resolution_inputs)
+
+    def computeTileStack(self, context, target_tiles, target_rectangle):
+        # target_tiles is a Map<Band,Tile>. Bands of different resolution have different tile rectangles, so the
+        # tiles are grouped by resolution and rectangle and the SZA and cloud masks are read once per group.
+        # The total and contributor tiles of a source band are computed together from a single TOA and mask read.
+        source_tiles = {}
+        for band in self.targetBandList:
+            tile = target_tiles.get(band)
+            if tile is None:
+                continue
+            if not self.tile_stack:
+                self.computeTile(context, band, tile)
+                continue
+            source_band, index = self.band_sources[band]
+            source_tiles.setdefault(source_band.getName(), (source_band, []))[1].append((index, tile))
+
+        resolution_inputs = {}
+        for source_band, tiles in source_tiles.values():
+            sampling = S2_BAND_SAMPLING[source_band.getName()]
+            rectangle = tiles[0][1].getRectangle()
+            key = (sampling, rectangle.x, rectangle.y, rectangle.width, rectangle.height)
+            if key not in resolution_inputs:
+                resolution_inputs[key] = self.get_resolution_inputs(context, sampling, rectangle)
+            self.compute_band_tile(context, source_band, tiles, resolution_inputs[key])
+
+    def get_resolution_inputs(self, context, sampling, rectangle):
+        '''
+        Reads the inputs that are common to all bands of the same resolution: cloud masks, and SZA on request
+        (see get_tile_sza), as it is not needed when the whole tile is flagged.
+        :param context: operator context
+        :param sampling: spatial sampling of the bands in meters (10, 20 or 60)
+        :param rectangle: target tile rectangle in the raster of that resolution
+        :return: dictionary with the cirrus/opaque cloud flag codes of the target tile, and its target and source
+        rectangles
+        '''
+        mark = self.timer.start()
+        source_rectangle = self.get_source_rectangle(sampling, rectangle)
+        cloud_masks = self.read_masks([tag % sampling for tag, code in S2_CLOUD_MASKS], source_rectangle)
+        cloud_flags = s2_rut_algo.flag_codes(cloud_masks, [code for tag, code in S2_CLOUD_MASKS])
+        if self.overview_factor > 1:
+            cloud_flags = self.aggregate_tile(cloud_flags, source_rectangle, s2_rut_algo.block_flags)
+        self.timer.lap('%dm' % sampling, 'cloud_masks', mark)
+        return {'sampling': sampling, 'rectangle': source_rectangle, 'target_rectangle': rectangle,
+                'cloud_flags': cloud_flags}
+
+    def get_tile_sza(self, resolution_inputs):
+        '''
+        SZA of a tile, interpolated on the first request and kept in the resolution inputs.
+        :param resolution_inputs: shared inputs of the band resolution and tile rectangle (see get_resolution_inputs)
+        :return: SZA and its cosine
+        '''
+        if 'tecta' not in resolution_inputs:
+            mark = self.timer.start()
+            sampling = resolution_inputs['sampling']
+            rectangle = resolution_inputs['rectangle']
+            origin_x, origin_y, resolution_x, resolution_y = self.get_sza_geometry(sampling)
+            if self.overview_factor > 1:
+                # SZA at the centre of the blocks, in the raster of the overview
+                x, y, width, height = self.get_source_region(self.resolution_bands[sampling])
+                origin_x += x * resolution_x
+                origin_y += y * resolution_y
+                resolution_x *= self.overview_factor
+                resolution_y *= self.overview_factor
+                rectangle = resolution_inputs['target_rectangle']
+            tecta = self.get_sza_grid().tile(origin_x, origin_y, resolution_x, resolution_y, rectangle.x, rectangle.y,
+                                             rectangle.width, rectangle.height)  # selects the tile SZA values
+            resolution_inputs['cos_tecta'] = np.cos(np.radians(tecta))
+            resolution_inputs['tecta'] = tecta
+            self.timer.lap('%dm' % sampling, 'sza', mark)
+        return resolution_inputs['tecta'], resolution_inputs['cos_tecta']
+
+    def compute_band_tile(self, context, source_band, tiles, resolution_inputs):
+        '''
+        Computes the uncertainty and flags of the target tiles of one source band, all with the same rectangle.
+        :param context: operator context
+        :param source_band: S2 band
+        :param tiles: list of (contributor index, target tile). Index None for the total uncertainty band
+        :param resolution_inputs: shared inputs of the band resolution and tile rectangle (see get_resolution_inputs)
+        '''
+        mark = self.timer.start()
+        rectangle = resolution_inputs['rectangle']
+        name = source_band.getName()
+        toa_band_id = S2_BAND_NAMES.index(name)
+
         # 251 is for degraded,lost or defective data. 252 is for saturated (L1a or L1b). 253 is for pixel with no data,
-        # 254 is for cirrus cloud and 255 is for opaque clouds.
-        val = np.maximum(unc, np.uint8(251 * invalidmask / 255))
-        val = np.maximum(val, np.uint8(252 * satl1mask / 255))
-        val = np.maximum(val, np.uint8(253 * nodatamask / 255))
-        val = np.maximum(val, np.uint8(254 * cirrusmask / 255))
-        val = np.maximum(val, np.uint8(cloudmask))
-        tile.setSamples(val)
-
-    # NOTE: this is a function that it is not stable enough
-    # def computeTileStack(self, context, target_tiles, target_rectangle):
-    #     for targetband in self.targetBandList:
-    #         source_band = self.sourceBandMap[targetband]
-    #         tile = target_tiles.get(targetband)  # target_tiles is a Map<Band,Tile>
-    #         toa_band_id = np.int(S2_BAND_NAMES.index(source_band.getName()))
-    #         self.rut_algo.a = self.get_a(self.datastrip_meta, toa_band_id)
-    #         self.rut_algo.e_sun = self.get_e_sun(self.product_meta, toa_band_id)
-    #         self.rut_algo.alpha = self.get_alpha(self.datastrip_meta, toa_band_id)
-    #         self.rut_algo.beta = self.get_beta(self.datastrip_meta, toa_band_id)
-    #         self.rut_algo.u_diff_temp = self.get_u_diff_temp(self.datastrip_meta, toa_band_id)
-    #
-    #         toa_tile = context.getSourceTile(source_band, snappy.Rectangle(source_band.getRasterWidth(),
-    #                                                                        source_band.getRasterHeight()))
-    #         toa_samples = toa_tile.getSamplesFloat()
-    #
-    #         # this is the core where the uncertainty calculation should grow
-    #         unc = self.rut_algo.unc_calculation(np.array(toa_samples, dtype=np.float64), toa_band_id, self.spacecraft)
-    #
-    #         tile.setSamples(unc)
+        # 254 is for cirrus cloud and 255 is for opaque clouds. All are higher than 250 (max uncertainty permitted)
+        # The masks are read first: a fully flagged tile (outside the swath, cloud) is written without reading the TOA
+        # and SZA, and in a partly flagged tile the uncertainty is only computed on the unflagged pixels.
+        # In an overview, a block with flagged pixels takes the highest flag code, and the uncertainty of the other
+        # blocks is computed from their mean TOA reflectance.
+        band_masks = self.read_masks([tag + name for tag, code in S2_BAND_MASKS], rectangle)
+        flags = s2_rut_algo.flag_codes(band_masks, [code for tag, code in S2_BAND_MASKS])
+        if self.overview_factor > 1:
+            flags = self.aggregate_tile(flags, rectangle, s2_rut_algo.block_flags)
+        np.maximum(flags, resolution_inputs['cloud_flags'], out=flags)
+        valid = s2_rut_algo.unflagged_pixels(flags)
+        mark = self.timer.lap(name, 'masks', mark)
+        if valid is not None and valid.size == 0:
+            for index, tile in tiles:
+                tile.setSamples(flags)
+                self.timer.add_pixels(name, flags.size)
+            self.timer.lap(name, 'set_samples', mark)
+            return
+
+        toa_tile = context.getSourceTile(source_band, rectangle)
+        toa_samples = np.asarray(toa_tile.getSamplesFloat(), dtype=np.float32)
+        if self.overview_factor > 1:
+            toa_samples = self.aggregate_tile(toa_samples, rectangle, s2_rut_algo.block_mean)
+        tecta, cos_tecta = self.get_tile_sza(resolution_inputs)
+        if valid is not None:
+            toa_samples = toa_samples[valid]
+            tecta = tecta[valid]
+            cos_tecta = cos_tecta[valid]
+        mark = self.timer.lap(name, 'toa', mark)
+
+        for index, tile in tiles:
+            # this is the core where the uncertainty calculation should grow
+            if index is None and self.lut_sza_step:
+                unc = self.get_band_lut(toa_band_id).lookup(toa_samples, tecta)
+            else:
+                unc = self.get_kernel()(self.kernel_params[(toa_band_id, index)], toa_samples, cos_tecta,
+                                        scratch=self.get_kernel_scratch(tile))
+            mark = self.timer.lap(name, 'uncertainty', mark)
+            if valid is None:
+                np.maximum(unc, flags, out=unc)
+            else:
+                unc_valid = unc
+                unc = flags.copy()
+                unc[valid] = unc_valid
+            tile.setSamples(unc)
+            mark = self.timer.lap(name, 'set_samples', mark)
+            self.timer.add_pixels(name, unc.size)
 
     def dispose(self, context):
-        pass
+        if self.statistics_meta is not None:
+            totals = self.timer.totals()
+            self.set_statistics_meta(totals)
+            # the header of the written product does not have the statistics yet, it is updated in place
+            location = context.getTargetProduct().getFileLocation()
+            if location is not None and location.getPath().endswith('.dim') and os.path.isfile(location.getPath()):
+                s2_rut_timing.write_dimap_statistics(location.getPath(), totals)
+        if self.timing_file:
+            self.timer.write_json(self.timing_file)
+
+    def set_statistics_meta(self, totals):
+        '''
+        Writes the timing totals in the Processing_statistics element, one sub-element per band or shared input.
+        :param totals: dictionary returned by S2RutTimer.totals
+        '''
+        for key, entry in sorted(totals.items()):
+            keyelem = MetadataElement(key)
+            for stat in sorted(entry):
+                data = snappy.ProductData.createInstance(str(entry[stat]))
+                statattr = MetadataAttribute(stat.upper(), snappy.ProductData.TYPE_ASCII, data.getNumElems())
+                statattr.setData(data)
+                keyelem.addAttribute(statattr)
+            self.statistics_meta.addElement(keyelem)
+
+    def set_text_attribute(self, element, name, text):
+        data = snappy.ProductData.createInstance(text)
+        attribute = MetadataAttribute(name, snappy.ProductData.TYPE_ASCII, data.getNumElems())
+        attribute.setData(data)
+        element.addAttribute(attribute)
+
+    def get_kernel(self):
+        '''
+        Loads the compute backend on the first request, as the optional backends are slow to import and compile.
+        :return: kernel function of the backend (see s2_rut_backends)
+        '''
+        if self.kernel is None:
+            with self.lazy_lock:
+                if self.kernel is None:
+                    self.backend_name, self.kernel = s2_rut_backends.get_backend(self.backend)
+        return self.kernel
+
+    def get_sza_grid(self):
+        '''
+        :return: coarse SZA grid of the product (see get_tecta), read on the first request
+        '''
+        if self.sza_grid is None:
+            with self.lazy_lock:
+                if self.sza_grid is None:
+                    self.sza_grid = self.get_tecta()
+        return self.sza_grid
 
     def get_quant(self, product_meta):
         return (product_meta.getElement('General_info').getElement('Product_Image_Characteristics').
@@ -254,49 +485,243 @@ class S2RutOp:
 
     def get_tecta(self):
         '''
-        Generates the SZA resampled at the S2 bands spatial resolution
-        :return: SZA angle bands resampled at 10,20 and 60m.
-        '''
-        parameters = hash()
-        parameters.put('targetResolution', 20)
-        parameters.put('upsampling', 'Nearest') # ideal Bilinear but does not extrapolate (NaN) the external values yet
-        parameters.put('downsampling', 'Mean')  # indiferent since angles will be always upsampled
-        parameters.put('flagDownsampling', 'FlagMedianAnd')
-        parameters.put('resampleOnPyramidLevels', True)
-        product20 = snappy.GPF.createProduct('Resample', parameters, self.source_product)
-        parameters.put('targetResolution', 10)
-        product10 = snappy.GPF.createProduct('Resample', parameters, self.source_product)
-        parameters.put('targetResolution', 60)
-        product60 = snappy.GPF.createProduct('Resample', parameters, self.source_product)
-        return (product10.getBand('sun_zenith'), product20.getBand('sun_zenith'), product60.getBand('sun_zenith'))
-
-    def get_e_sun(self, product_meta, band_id):
-        return float([i for i in product_meta.getElement('General_Info').getElement('Product_Image_Characteristics').
-                     getElement('Reflectance_Conversion').getElement('Solar_Irradiance_list').
-                     getAttributes() if i.getName() == 'SOLAR_IRRADIANCE'][band_id].getData().getElemString())
-
-    def get_u_diff_temp(self, datastrip_meta, band_id):
+        Reads the coarse SZA grid of the product. It is interpolated to the tiles of each resolution on request,
+        instead of resampling the whole product to 10, 20 and 60m.
+        :return: S2SzaGrid with the nodes at the pixel centres of the sun_zenith band
+        '''
+        sza_band = self.source_product.getBand('sun_zenith')
+        width = sza_band.getRasterWidth()
+        height = sza_band.getRasterHeight()
+        values = np.zeros(width * height, np.float32)
+        sza_band.readPixels(0, 0, width, height, values)
+        if sza_band.isNoDataValueUsed():
+            values[values == sza_band.getGeophysicalNoDataValue()] = np.nan
+        transform = sza_band.getImageToModelTransform()
+        return s2_rut_sza.S2SzaGrid(values.reshape(height, width),
+                                    transform.getTranslateX() + 0.5 * transform.getScaleX(),
+                                    transform.getTranslateY() + 0.5 * transform.getScaleY(),
+                                    transform.getScaleX(), transform.getScaleY())
+
+    def get_region(self, context):
+        '''
+        Resolves the subset of the product from the geoRegion (WKT, has priority) or region parameter.
+        :param context: operator context
+        :return: (x, y, width, height) in pixels of the 10 m bands aligned to the 60 m grid, None for the whole product
+        '''
+        reference_band = self.source_product.getBand('B2')  # 10 m raster of the region
+        if context.getParameter('geoRegion'):
+            geo_coding = reference_band.getGeoCoding()
+            positions = []
+            for lat, lon in s2_rut_region.parse_wkt_coordinates(context.getParameter('geoRegion')):
+                pixel_pos = geo_coding.getPixelPos(snappy.GeoPos(lat, lon), None)
+                positions.append((pixel_pos.getX(), pixel_pos.getY()))
+            region = s2_rut_region.bounding_region(positions)
+        elif context.getParameter('region'):
+            region = s2_rut_region.parse_region(context.getParameter('region'))
+        elif self.roi_sites:
+            # ROI table mode: the target bands only cover the ROIs (and the 60 m pixels around their borders)
+            geo_coding = reference_band.getGeoCoding()
+            half = max(self.roi_sizes) / 20.0 + s2_rut_region.REGION_BLOCK
+            positions = []
+            for name, lat, lon in self.roi_sites:
+                pixel_pos = geo_coding.getPixelPos(snappy.GeoPos(lat, lon), None)
+                positions += [(pixel_pos.getX() - half, pixel_pos.getY() - half),
+                              (pixel_pos.getX() + half, pixel_pos.getY() + half)]
+            region = s2_rut_region.bounding_region(positions)
+        else:
+            return None
+        return s2_rut_region.align_region(region, reference_band.getRasterWidth(), reference_band.getRasterHeight())
+
+    def get_roi_sites(self, centres):
+        '''
+        :param centres: ROI centres as 'lat:lon' or 'name:lat:lon'
+        :return: list of (name, lat, lon)
+        '''
+        sites = []
+        for centre in centres:
+            values = centre.split(':')
+            try:
+                lat, lon = float(values[-2]), float(values[-1])
+            except (IndexError, ValueError):
+                lat = lon = None
+            if lat is None or len(values) > 3:
+                raise RuntimeError('ROI centre "' + centre + '" is not valid. The expected format is [name:]lat:lon')
+            sites.append((values[0] if len(values) == 3 else centre, lat, lon))
+        return sites
+
+    def get_roi_rows(self):
+        '''
+        Propagates the uncertainty of the selected bands to the mean reflectance of the ROIs centred on the sites,
+        analytically and only from the pixels of the ROIs (see s2_rut_roi.roi_mean_uncertainty). Flagged pixels are
+        excluded from the mean.
+        :return: rows of the ROI table (see s2_rut_roi.ROI_TABLE_COLUMNS)
+        '''
+        rows = []
+        source_bands = sorted(self.sourceBandMap.values(), key=lambda band: S2_BAND_NAMES.index(band.getName()))
+        for site, lat, lon in self.roi_sites:
+            for source_band in source_bands:
+                name = source_band.getName()
+                band_id = S2_BAND_NAMES.index(name)
+                sampling = S2_BAND_SAMPLING[name]
+                pixel_pos = source_band.getGeoCoding().getPixelPos(snappy.GeoPos(lat, lon), None)
+                for size in self.roi_sizes:
+                    # ROI window selected as in S2ROIuncprocessor.read_main
+                    wpix = int(round(size / float(sampling)))
+                    x = int(round(pixel_pos.getX() - wpix / 2.))
+                    y = int(round(pixel_pos.getY() - wpix / 2.))
+                    if (wpix < 1 or x < 0 or y < 0 or x + wpix > source_band.getRasterWidth() or
+                            y + wpix > source_band.getRasterHeight()):
+                        raise RuntimeError('ROI of %d m at %s is not within band %s' % (size, site, name))
+                    rectangle = Rectangle(x, y, wpix, wpix)
+                    toa_samples = np.zeros(wpix * wpix, np.float32)
+                    source_band.readPixels(x, y, wpix, wpix, toa_samples)
+                    flags = s2_rut_algo.flag_codes(self.read_masks([tag + name for tag, code in S2_BAND_MASKS] +
+                                                                   [tag % sampling for tag, code in S2_CLOUD_MASKS],
+                                                                   rectangle),
+                                                   [code for tag, code in S2_BAND_MASKS + S2_CLOUD_MASKS])
+                    origin_x, origin_y, resolution_x, resolution_y = self.get_sza_geometry(sampling)
+                    cos_tecta = np.cos(np.radians(self.get_sza_grid().tile(origin_x, origin_y, resolution_x,
+                                                                           resolution_y, x, y, wpix, wpix)))
+                    contributors = []
+                    for index, tag in enumerate(S2_CONTRIBUTOR_TAGS):
+                        if not self.rut_algo.unc_select[index]:
+                            continue
+                        params = self.rut_algo.kernel_params(self.band_coeffs[band_id],
+                                                             s2_rut_algo.contributor_select(index))
+                        systematic, u_1sigma = s2_rut_algo.unc_components(params, toa_samples, cos_tecta)
+                        kind = s2_rut_roi.ROI_CONTRIBUTOR_KINDS[tag]
+                        values = systematic if kind == 'systematic' else u_1sigma
+                        contributors.append((kind, values.reshape(wpix, wpix)))
+                    weights = np.where(flags == 0, toa_samples, 0).reshape(wpix, wpix)
+                    unc = s2_rut_roi.roi_mean_uncertainty(weights, contributors)
+                    u_combined = math.sqrt(unc.pixel ** 2 + unc.row ** 2 + unc.image ** 2)
+                    rows.append({'site': site, 'lat': lat, 'lon': lon, 'band': name, 'size_m': size,
+                                 'pixels': wpix * wpix, 'flagged': int(np.count_nonzero(flags)),
+                                 'systematic': unc.systematic, 'u_pixel': unc.pixel, 'u_row': unc.row,
+                                 'u_image': unc.image, 'u_combined': u_combined,
+                                 'u_expanded': unc.systematic + self.rut_algo.k * u_combined})
+        return rows
+
+    def get_source_region(self, source_band):
+        '''
+        :return: (x, y, width, height) of the processed pixels of a source band: the subset if any, otherwise all
+        '''
+        if self.region is None:
+            return 0, 0, source_band.getRasterWidth(), source_band.getRasterHeight()
+        return s2_rut_region.band_region(self.region, S2_BAND_SAMPLING[source_band.getName()])
+
+    def get_target_size(self, source_band):
+        '''
+        :return: (width, height) of the target bands of a source band: that of the subset if any, divided by the
+        overview factor (the last blocks may be smaller)
+        '''
+        x, y, width, height = self.get_source_region(source_band)
+        return -(-width // self.overview_factor), -(-height // self.overview_factor)
+
+    def set_target_geocoding(self, source_band, target_band):
+        '''
+        Geocoding of a target band: that of the source band, shifted to the origin of the subset if any and with the
+        pixel size of the overview if any.
+        '''
+        if self.region is None and self.overview_factor == 1:
+            snappy.ProductUtils.copyGeoCoding(source_band, target_band)
+            return
+        x, y, width, height = self.get_source_region(source_band)
+        width, height = self.get_target_size(source_band)
+        transform = source_band.getImageToModelTransform()
+        target_band.setGeoCoding(CrsGeoCoding(source_band.getGeoCoding().getMapCRS(), width, height,
+                                              transform.getTranslateX() + x * transform.getScaleX(),
+                                              transform.getTranslateY() + y * transform.getScaleY(),
+                                              abs(transform.getScaleX()) * self.overview_factor,
+                                              abs(transform.getScaleY()) * self.overview_factor, 0.0, 0.0))
+
+    def get_source_rectangle(self, sampling, rectangle):
+        '''
+        :param sampling: spatial sampling of the band in meters (10, 20 or 60)
+        :param rectangle: rectangle of a target tile
+        :return: rectangle of the same pixels in the source bands (of the blocks of the pixels for an overview)
+        '''
+        if self.region is None and self.overview_factor == 1:
+            return rectangle
+        x, y, width, height = self.get_source_region(self.resolution_bands[sampling])
+        factor = self.overview_factor
+        return Rectangle(x + rectangle.x * factor, y + rectangle.y * factor,
+                         min(rectangle.width * factor, width - rectangle.x * factor),
+                         min(rectangle.height * factor, height - rectangle.y * factor))
+
+    def aggregate_tile(self, samples, rectangle, aggregate):
+        '''
+        Aggregates the source samples of a tile to the blocks of the overview.
+        :param samples: flat samples of the source rectangle
+        :param rectangle: source rectangle of the tile
+        :param aggregate: s2_rut_algo.block_mean or s2_rut_algo.block_flags
+        :return: flat samples of the target tile
+        '''
+        return aggregate(samples.reshape(rectangle.height, rectangle.width), self.overview_factor).ravel()
+
+    def get_sza_geometry(self, sampling):
+        '''
+        Map geometry of a resolution, taken from a selected band on the first request for that resolution.
+        :param sampling: spatial sampling of the bands in meters (10, 20 or 60)
+        :return: (origin_x, origin_y, resolution_x, resolution_y)
+        '''
+        if sampling not in self.sza_geometry:
+            transform = self.resolution_bands[sampling].getImageToModelTransform()
+            self.sza_geometry[sampling] = (transform.getTranslateX(), transform.getTranslateY(),
+                                           transform.getScaleX(), transform.getScaleY())
+        return self.sza_geometry[sampling]
+
+    def get_band_coeffs(self, band_ids):
+        '''
+        Resolves the calibration coefficients of the given bands from the product and datastrip metadata.
+        Every metadata list is walked only once, whatever the number of bands.
+        :param band_ids: list with the zero-based index of the bands
+        :return: dictionary with a S2RutBandCoeffs for each band id
+        '''
+        gains = [i for i in self.datastrip_meta.getElement('Image_Data_Info').getElement('Sensor_Configuration').
+                 getElement('Acquisition_Configuration').getElement('Spectral_Band_Info').getElements()
+                 if i.getName() == 'Spectral_Band_Information']
+        noise_models = [i.getElement('Noise_Model') for i in self.datastrip_meta.getElement('Quality_Indicators_Info').
+                        getElement('Radiometric_Info').getElement('Radiometric_Quality_list').getElements()
+                        if i.getName() == 'Radiometric_Quality']
+        e_suns = [i for i in self.product_meta.getElement('General_Info').getElement('Product_Image_Characteristics').
+                  getElement('Reflectance_Conversion').getElement('Solar_Irradiance_list').getAttributes()
+                  if i.getName() == 'SOLAR_IRRADIANCE']
+        years = self.get_years_in_orbit(self.datastrip_meta)
+
+        band_coeffs = {}
+        for band_id in band_ids:
+            band_coeffs[band_id] = s2_rut_algo.get_band_coeffs(band_id, self.spacecraft,
+                                                               gains[band_id].getAttributeDouble('PHYSICAL_GAINS'),
+                                                               float(e_suns[band_id].getData().getElemString()),
+                                                               noise_models[band_id].getAttributeDouble('ALPHA'),
+                                                               noise_models[band_id].getAttributeDouble('BETA'), years)
+        return band_coeffs
+
+    def get_years_in_orbit(self, datastrip_meta):
         # START or STOP time has no effect. We provide a degradation based on MERIS year rates
         time_start = datetime.datetime.strptime(datastrip_meta.getElement('General_Info').
             getElement('Datastrip_Time_Info').getAttributeString(
             'DATASTRIP_SENSING_START'), '%Y-%m-%dT%H:%M:%S.%fZ')
-        return (time_start - self.time_init[self.spacecraft]).days / 365.25 * \
-               rad_conf.u_diff_temp_rate[self.spacecraft][band_id]
-
-    def get_beta(self, datastrip_meta, band_id):
-        return ([i for i in datastrip_meta.getElement('Quality_Indicators_Info').getElement('Radiometric_Info').
-                getElement('Radiometric_Quality_list').getElements() if i.getName() == 'Radiometric_Quality'][band_id]
-                .getElement('Noise_Model').getAttributeDouble('BETA'))
+        return (time_start - self.time_init[self.spacecraft]).days / 365.25
 
-    def get_alpha(self, datastrip_meta, band_id):
-        return ([i for i in datastrip_meta.getElement('Quality_Indicators_Info').getElement('Radiometric_Info').
-                getElement('Radiometric_Quality_list').getElements() if i.getName() == 'Radiometric_Quality'][band_id]
-                .getElement('Noise_Model').getAttributeDouble('ALPHA'))
-
-    def get_a(self, datastrip_meta, band_id):
-        return ([i for i in datastrip_meta.getElement('Image_Data_Info').getElement('Sensor_Configuration').
-                getElement('Acquisition_Configuration').getElement('Spectral_Band_Info').getElements()
-                 if i.getName() == 'Spectral_Band_Information'][band_id].getAttributeDouble('PHYSICAL_GAINS'))
+    def get_band_lut(self, band_id):
+        '''
+        Builds the uncertainty lookup table of a band on its first request. The SZA grid covers the range of the
+        product, whose statistics are also only computed by the first LUT.
+        :param band_id: zero-based index of the band
+        :return: S2RutLut of the band
+        '''
+        if band_id not in self.band_luts:
+            with self.lazy_lock:
+                if band_id not in self.band_luts:
+                    stx = self.source_product.getBand('sun_zenith').getStx()
+                    sza_min = np.floor(stx.getMinimum() / self.lut_sza_step) * self.lut_sza_step
+                    sza_max = np.ceil(stx.getMaximum() / self.lut_sza_step) * self.lut_sza_step
+                    self.rut_algo.set_band_coeffs(self.band_coeffs[band_id])
+                    self.band_luts[band_id] = s2_rut_lut.S2RutLut(self.rut_algo, band_id, self.spacecraft, sza_min,
+                                                                  sza_max, self.lut_sza_step)
+        return self.band_luts[band_id]
 
     def get_k(self, context):
         return (context.getParameter('coverage_factor'))
@@ -319,16 +744,37 @@ class S2RutOp:
                 max_width = width
         return targetBandList[band_index]
 
-    def mask_roi(self, masktag, rectangle):
+    def get_kernel_scratch(self, tile):
+        '''
+        Returns the scratch buffers of the uncertainty kernel of the calling thread, grown to the size of the largest
+        tile seen so far.
+        :param tile: target tile
+        :return: pair of float32 arrays
+        '''
+        size = tile.getRectangle().width * tile.getRectangle().height
+        scratch = getattr(self.thread_buffers, 'kernel_scratch', None)
+        if scratch is None or scratch[0].size < size:
+            scratch = self.thread_buffers.kernel_scratch = s2_rut_algo.new_scratch(size)
+        return scratch
+
+    def read_masks(self, masktags, rectangle):
         '''
-        The function supports the automatic read of ROI masks in function masks_extract
-        :param masktag: the tag of the mask from the S2 L1C product (list of them in self.source_product.getBandNames())
-        :return: ROI of raster data from the specific mask in integer (0 or 1 value)
+        Reads several masks of a rectangle into the reusable int32 mask buffer of the calling thread, with one
+        readPixels call per mask.
+        :param masktags: the tags of the masks from the S2 L1C product (list of them in self.mask_group.getNodeNames())
+        :param rectangle: tile rectangle
+        :return: int32 array with one row per mask (flattened tile), 0 where the mask is not set. It is only valid
+        until the next call of the same thread
         '''
-        data = np.zeros(rectangle.width * rectangle.height, np.uint32)
-        im = self.mask_group.get(masktag)
-        im2 = snappy.jpy.cast(im, snappy.Mask)  # change from ProductNode to Mask typo
-        im2.readPixels(rectangle.x, rectangle.y, rectangle.width, rectangle.height, data)
-        # No need to reshape data as unc values are not!!!
-        # data.shape = rectangle.height, rectangle.width
+        size = rectangle.width * rectangle.height
+        mask_buffer = getattr(self.thread_buffers, 'mask_buffer', None)
+        if mask_buffer is None or mask_buffer.size < len(masktags) * size:
+            mask_buffer = self.thread_buffers.mask_buffer = np.zeros(len(masktags) * size, np.int32)
+        data = mask_buffer[:len(masktags) * size].reshape(len(masktags), size)
+        for row, masktag in zip(data, masktags):
+            if masktag not in self.masks:
+                with self.lazy_lock:
+                    if masktag not in self.masks:
+                        self.masks[masktag] = snappy.jpy.cast(self.mask_group.get(masktag), snappy.Mask)
+            self.masks[masktag].readPixels(rectangle.x, rectangle.y, rectangle.width, rectangle.height, row)
         return data
@@ -8,9 +8,45 @@ Created on Wed Jan 20 13:48:33 2016
 import numpy as np
 import math
 import warnings
+from collections import namedtuple
 
 import s2_l1_rad_conf as rad_conf
 
+S2_BAND_NAMES = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B8A', 'B9', 'B10', 'B11', 'B12']
+S2_BAND_SAMPLING = {'B1': 60, 'B2': 10, 'B3': 10, 'B4': 10, 'B5': 20, 'B6': 20, 'B7': 20, 'B8': 10, 'B8A': 20, 'B9': 60,
+                    'B10': 60, 'B11': 20, 'B12': 20}
+
+# Calibration coefficients of one band of one product. They only depend on the product metadata and on
+# s2_l1_rad_conf, so S2RutOp resolves them once at initialisation instead of on every tile.
+S2RutBandCoeffs = namedtuple('S2RutBandCoeffs', ['band_id', 'a', 'e_sun', 'alpha', 'beta', 'u_diff_temp', 'Lref',
+                                                 'u_stray_rand', 'u_xtalk', 'u_DS', 'u_diff_abs'])
+
+# Constants of the uncertainty kernel (see unc_kernel) for one band and one selection of contributors. They are
+# immutable, so tiles can be computed concurrently from the same record.
+S2RutKernelParams = namedtuple('S2RutKernelParams', ['cn_factor', 'c_const', 'c_lin', 'c_quad', 'c_quant', 'c_sys',
+                                                     'c_temp', 'k'])
+
+# Flag codes written over the uncertainty values (maximum uncertainty is 250). A higher code has priority.
+FLAG_INVALID = 251  # degraded, lost or defective pixel
+FLAG_SATURATED = 252  # saturated in L1A or L1B
+FLAG_NODATA = 253  # pixel with no data
+FLAG_CIRRUS = 254  # cirrus cloud
+FLAG_CLOUD = 255  # opaque cloud
+
+# Masks of the S2 L1C product that are flagged in the uncertainty bands, with their flag codes in increasing priority.
+# The band masks are suffixed with the band name, the cloud masks are formatted with the band sampling.
+S2_BAND_MASKS = [('msi_degraded_', FLAG_INVALID), ('msi_lost_', FLAG_INVALID), ('defective_', FLAG_INVALID),
+                 ('saturated_l1a_', FLAG_SATURATED), ('saturated_l1b_', FLAG_SATURATED), ('nodata_', FLAG_NODATA)]
+S2_CLOUD_MASKS = [('cirrus_clouds_%dm', FLAG_CIRRUS), ('opaque_clouds_%dm', FLAG_CLOUD)]
+
+# Fraction of flagged pixels of a tile from which the uncertainty is only computed on the unflagged pixels. Below it,
+# gathering and scattering the pixels costs more than computing the flagged ones.
+COMPRESS_FLAGGED_FRACTION = 0.25
+
+# Tags of the uncertainty contributors (order of S2RutAlgo.unc_select), used to name the contributor bands
+S2_CONTRIBUTOR_TAGS = ['unoise', 'u_stray_sys', 'u_stray_rand', 'xtalk', 'ADC', 'ds', 'ugamma', 'udiffabs', 'udifftemp',
+                       'udiffcosine', 'udiffk', 'uL1Cquant']
+
 
 class S2RutAlgo:
     """
@@ -26,15 +62,26 @@ class S2RutAlgo:
         self.quant = 10000.0
         self.alpha = 0.0
         self.beta = 0.0
-        self.u_diff_cos = 0.4  # [%]from 0.13° diffuser planarity/micro as in (AIRBUS 2015). Assumed same for S2A/S2B.
-        self.u_diff_k = 0.3  # [%] as a conservative residual (AIRBUS 2015). Assumed same for S2A/S2B.
+        self.u_diff_cos = rad_conf.u_diff_cos  # [%]from 0.13° diffuser planarity/micro as in (AIRBUS 2015).
+        self.u_diff_k = rad_conf.u_diff_k  # [%] as a conservative residual (AIRBUS 2015). Assumed same for S2A/S2B.
         self.u_diff_temp = 1.0  # This value is correctly redefined for specific satellite at the S2RutOp.
         self.u_ADC = 0.5  # [DN](rectangular distribution, see combination)
-        self.u_gamma = 0.4
+        self.u_gamma = rad_conf.u_gamma
         self.k = 1 # This value is correctly redefined for specific satellite at the S2RutOp.
         self.unc_select = [True, True, True, True, True, True, True, True, True, True, True,
                            True]  # list of booleans with user selected uncertainty sources(order as in interface)
 
+    def set_band_coeffs(self, coeffs):
+        """
+        Sets the band dependent product coefficients from a S2RutBandCoeffs record.
+        :param coeffs: S2RutBandCoeffs of the band to be processed
+        """
+        self.a = coeffs.a
+        self.e_sun = coeffs.e_sun
+        self.alpha = coeffs.alpha
+        self.beta = coeffs.beta
+        self.u_diff_temp = coeffs.u_diff_temp
+
     def unc_calculation(self, band_data, band_id, spacecraft):
         """
         This function represents the core of the RUTv1.
@@ -97,8 +144,8 @@ class S2RutAlgo:
         else:
             u_xtalk = 0
 
-        if not self.unc_select[4]:
-            self.u_ADC = 0  # predefined but updated to 0 if deselected by user
+        # the selection is applied on local copies: the algorithm parameters are not modified
+        u_ADC = self.u_ADC if self.unc_select[4] else 0  # predefined but updated to 0 if deselected by user
 
         if self.unc_select[5]:
             u_DS = rad_conf.u_DS_all[spacecraft][band_id]
@@ -110,9 +157,9 @@ class S2RutAlgo:
         #######################################################################
 
         if self.unc_select[6]:
-            self.u_gamma = 0.4  # [%] (AIRBUS 2015)
+            u_gamma = self.u_gamma  # [%] (AIRBUS 2015)
         else:
-            self.u_gamma = 0
+            u_gamma = 0
 
         #######################################################################
         # 5.	L1C uncertainty contributors: absolute calibration coefficient
@@ -123,14 +170,9 @@ class S2RutAlgo:
         else:
             u_diff_abs = 0
 
-        if not self.unc_select[8]:
-            self.u_diff_temp = 0  # calculated in s2_rut.py. Updated to 0 if deselected by user
-
-        if not self.unc_select[9]:
-            self.u_diff_cos = 0  # predefined but updated to 0 if deselected by user
-
-        if not self.unc_select[10]:
-            self.u_diff_k = 0  # predefined but updated to 0 if deselected by user
+        u_diff_temp = self.u_diff_temp if self.unc_select[8] else 0  # calculated in s2_rut.py. 0 if deselected by user
+        u_diff_cos = self.u_diff_cos if self.unc_select[9] else 0  # predefined but 0 if deselected by user
+        u_diff_k = self.u_diff_k if self.unc_select[10] else 0  # predefined but 0 if deselected by user
 
         #######################################################################
         # 6.	L1C uncertainty contributors: reflectance conversion
@@ -148,13 +190,291 @@ class S2RutAlgo:
         # values given as percentages. Multiplied by 10 and saved to 1 byte(uint8)
         # Clips values to 0-250 --> uncertainty >=25%  assigns a value 250.
         # Uncertainty <=0 represents a processing error (uncertainty is positive)
-        u_adc = (100 * self.u_ADC / math.sqrt(3)) / cn
+        u_adc = (100 * u_ADC / math.sqrt(3)) / cn
         u_ds = (100 * u_DS) / cn
         u_stray = np.sqrt(u_stray_rand ** 2 + ((100 * self.a * u_xtalk) / cn) ** 2)
-        u_diff = math.sqrt(u_diff_abs ** 2 + self.u_diff_cos ** 2 + self.u_diff_k ** 2)
-        u_1sigma = np.sqrt(u_ref_quant ** 2 + self.u_gamma ** 2 + u_stray ** 2 + u_diff ** 2 +
+        u_diff = math.sqrt(u_diff_abs ** 2 + u_diff_cos ** 2 + u_diff_k ** 2)
+        u_1sigma = np.sqrt(u_ref_quant ** 2 + u_gamma ** 2 + u_stray ** 2 + u_diff ** 2 +
                            u_noise ** 2 + u_adc ** 2 + u_ds ** 2)
-        u_expand = np.round(10 * (self.u_diff_temp + ((100 * self.a * u_stray_sys) / cn) + self.k * u_1sigma))
+        u_expand = np.round(10 * (u_diff_temp + ((100 * self.a * u_stray_sys) / cn) + self.k * u_1sigma))
         u_ref = np.uint8(np.clip(u_expand, 0, 250))
 
         return u_ref
+
+    def unc_calculation_f32(self, band_data, band_id, spacecraft, cos_tecta=None, out=None, scratch=None):
+        """
+        Same uncertainty as unc_calculation, computed in float32 without full-size temporaries (see unc_kernel).
+        :param band_data: quantized L1C reflectance pixels of a band (float32 preferred, any shape)
+        :param band_id: zero-based index of the band
+        :param spacecraft: satellite for which uncertainty is calculated. Valid values: "Sentinel-2A" and "Sentinel-2B"
+        :param cos_tecta: cosine of the SZA of the pixels. If None it is computed from self.tecta
+        :param out: uint8 array receiving the result. Allocated if None
+        :param scratch: pair of float32 arrays with at least band_data.size elements (see new_scratch)
+        :return: array of u_int8 with uncertainty associated to each pixel.
+        """
+        params = self.kernel_params(self.get_band_coeffs(band_id, spacecraft))
+        return self.unc_kernel_sza(params, band_data, cos_tecta, out, scratch)
+
+    def contribution_f32(self, band_data, band_id, spacecraft, index, cos_tecta=None, out=None, scratch=None):
+        """
+        Uncertainty of a single contributor, same as unc_calculation_f32 with only that contributor selected.
+        The other parameters and the result are the same as in unc_calculation_f32.
+        :param index: index of the contributor in unc_select (see S2_CONTRIBUTOR_TAGS)
+        """
+        params = self.kernel_params(self.get_band_coeffs(band_id, spacecraft), contributor_select(index))
+        return self.unc_kernel_sza(params, band_data, cos_tecta, out, scratch)
+
+    def unc_kernel_sza(self, params, band_data, cos_tecta, out, scratch):
+        """
+        Runs unc_kernel, with the cosine of self.tecta if cos_tecta is None.
+        """
+        band_data = np.asarray(band_data)
+        if cos_tecta is None:
+            if scratch is None:
+                scratch = new_scratch(band_data.size)
+            cos_tecta = scratch[1][:band_data.size].reshape(band_data.shape)  # overwritten by the kernel once read
+            np.radians(self.tecta, out=cos_tecta)
+            np.cos(cos_tecta, out=cos_tecta)
+        return unc_kernel(params, band_data, cos_tecta, out, scratch)
+
+    def get_band_coeffs(self, band_id, spacecraft):
+        """
+        :return: S2RutBandCoeffs with the band coefficients currently set (see set_band_coeffs)
+        """
+        return S2RutBandCoeffs(band_id=band_id, a=self.a, e_sun=self.e_sun, alpha=self.alpha, beta=self.beta,
+                               u_diff_temp=self.u_diff_temp, Lref=rad_conf.Lref[band_id],
+                               u_stray_rand=rad_conf.u_stray_rand_all[spacecraft][band_id],
+                               u_xtalk=rad_conf.u_xtalk_all[spacecraft][band_id],
+                               u_DS=rad_conf.u_DS_all[spacecraft][band_id],
+                               u_diff_abs=rad_conf.u_diff_absarray[spacecraft][band_id])
+
+    def kernel_params(self, coeffs, unc_select=None):
+        """
+        Resolves the constants of the uncertainty kernel of a band. The algorithm is not modified, so the operator
+        computes them once per band at initialisation and then shares them between the tile threads.
+
+        The contributors are regrouped by their dependence on the CN value so that the combination reads
+            u_1sigma**2 = c_const + (c_lin + c_quad / cn) / cn
+        where all terms that do not depend on the pixel (gamma, stray-light random, diffuser) are folded into
+        c_const.
+
+        :param coeffs: S2RutBandCoeffs of the band
+        :param unc_select: selected contributors (order as in unc_select). If None, self.unc_select
+        :return: S2RutKernelParams
+        """
+        sel = self.unc_select if unc_select is None else unc_select
+        c_const = 0.0  # [%^2] scalar-only contributors
+        if sel[2]:
+            c_const += coeffs.u_stray_rand ** 2
+        if sel[6]:
+            c_const += self.u_gamma ** 2  # gamma [%] (AIRBUS 2015)
+        if sel[7]:
+            c_const += coeffs.u_diff_abs ** 2
+        if sel[9]:
+            c_const += self.u_diff_cos ** 2
+        if sel[10]:
+            c_const += self.u_diff_k ** 2
+        c_lin = 1e4 * coeffs.beta if sel[0] else 0.0  # multiplies 1/cn
+        c_quad = 0.0  # multiplies 1/cn**2
+        if sel[0]:
+            c_quad += 1e4 * coeffs.alpha ** 2
+        if sel[3]:
+            c_quad += (100 * coeffs.a * coeffs.u_xtalk) ** 2
+        if sel[4]:
+            c_quad += (100 * self.u_ADC / math.sqrt(3)) ** 2
+        if sel[5]:
+            c_quad += (100 * coeffs.u_DS) ** 2
+        # L1C quantisation (100 * (0.5 / sqrt(3)) / (quant * band_data))**2 expressed in terms of 1/cn
+        cn_factor = coeffs.a * coeffs.e_sun * self.u_sun / math.pi
+        c_quant = (100 * (0.5 / math.sqrt(3)) * cn_factor / self.quant) ** 2 if sel[11] else 0.0
+        c_sys = 10 * 100 * coeffs.a * 0.3 * coeffs.Lref / 100 if sel[1] else 0.0
+        c_temp = 10 * coeffs.u_diff_temp if sel[8] else 0.0
+        return S2RutKernelParams(cn_factor=cn_factor, c_const=c_const, c_lin=c_lin, c_quad=c_quad, c_quant=c_quant,
+                                 c_sys=c_sys, c_temp=c_temp, k=self.k)
+
+
+def unc_kernel(params, band_data, cos_tecta, out=None, scratch=None):
+    """
+    Uncertainty of a tile from the kernel constants of its band, in float32 without full-size temporaries: all pixel
+    operations are done in place on the two scratch buffers and the result is written straight into the uint8 output.
+
+    The function has no state: tiles can be computed concurrently on several threads, each one with its own scratch
+    buffers. numpy releases the GIL in the array operations, so the threads run them in parallel.
+
+    :param params: S2RutKernelParams of the band and the selected contributors (see S2RutAlgo.kernel_params)
+    :param band_data: quantized L1C reflectance pixels of a band (float32 preferred, any shape)
+    :param cos_tecta: cosine of the SZA of the pixels, same shape as band_data (or scalar). It may be scratch[1]
+    :param out: uint8 array receiving the result. Allocated if None
+    :param scratch: pair of float32 arrays with at least band_data.size elements (see new_scratch)
+    :return: array of u_int8 with uncertainty associated to each pixel.
+    """
+    band_data = np.asarray(band_data)
+    shape = band_data.shape
+    if scratch is None:
+        scratch = new_scratch(band_data.size)
+    buf_cn = scratch[0][:band_data.size].reshape(shape)
+    buf_unc = scratch[1][:band_data.size].reshape(shape)
+    if out is None:
+        out = np.empty(shape, np.uint8)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.multiply(band_data, cos_tecta, out=buf_cn)
+        np.multiply(cos_tecta, cos_tecta, out=buf_unc)
+        buf_cn *= params.cn_factor
+        np.reciprocal(buf_cn, out=buf_cn)  # 1 / cn
+
+        buf_unc *= params.c_quant
+        buf_unc += params.c_quad
+        buf_unc *= buf_cn
+        buf_unc += params.c_lin
+        buf_unc *= buf_cn
+        buf_unc += params.c_const
+        np.sqrt(buf_unc, out=buf_unc)
+        buf_unc *= 10 * params.k
+
+        buf_cn *= params.c_sys
+        buf_cn += params.c_temp
+        buf_cn += buf_unc
+        np.rint(buf_cn, out=buf_cn)
+        np.clip(buf_cn, 0, 250, out=buf_cn)
+        np.copyto(out, buf_cn, casting='unsafe')
+    return out
+
+
+def unc_components(params, band_data, cos_tecta):
+    """
+    Unrounded uncertainty of the pixels, split as in the combination of unc_kernel:
+        u_expand = 10 * (systematic + k * u_1sigma)
+    Used to propagate the uncertainty of the contributors to the mean of a region (see s2_rut_roi).
+    :param params: S2RutKernelParams of the band and the selected contributors (see S2RutAlgo.kernel_params)
+    :param band_data: quantized L1C reflectance pixels of a band
+    :param cos_tecta: cosine of the SZA of the pixels, same shape as band_data (or scalar)
+    :return: systematic and u_1sigma float64 arrays [%] (k = 1)
+    """
+    band_data = np.asarray(band_data, np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inverse_cn = 1 / (params.cn_factor * band_data * cos_tecta)
+        u_1sigma = np.sqrt(params.c_const + (params.c_lin + (params.c_quad + params.c_quant * np.square(cos_tecta)) *
+                                             inverse_cn) * inverse_cn)
+        systematic = (params.c_temp + params.c_sys * inverse_cn) / 10
+    return systematic, u_1sigma
+
+
+def contributor_select(index):
+    """
+    :param index: index of a contributor in S2RutAlgo.unc_select (see S2_CONTRIBUTOR_TAGS)
+    :return: selection with only that contributor
+    """
+    return [i == index for i in range(len(S2_CONTRIBUTOR_TAGS))]
+
+
+def get_band_coeffs(band_id, spacecraft, a, e_sun, alpha, beta, years_in_orbit):
+    """
+    Builds the coefficient record of a band from its product metadata values and s2_l1_rad_conf.
+    :param band_id: zero-based index of the band
+    :param spacecraft: "Sentinel-2A" or "Sentinel-2B"
+    :param a: physical gain of the band
+    :param e_sun: solar irradiance of the band
+    :param alpha: alpha parameter of the noise model
+    :param beta: beta parameter of the noise model
+    :param years_in_orbit: time between the launch of the spacecraft and the acquisition [years]
+    :return: S2RutBandCoeffs
+    """
+    return S2RutBandCoeffs(band_id=band_id, a=a, e_sun=e_sun, alpha=alpha, beta=beta,
+                           u_diff_temp=years_in_orbit * rad_conf.u_diff_temp_rate[spacecraft][band_id],
+                           Lref=rad_conf.Lref[band_id],
+                           u_stray_rand=rad_conf.u_stray_rand_all[spacecraft][band_id],
+                           u_xtalk=rad_conf.u_xtalk_all[spacecraft][band_id],
+                           u_DS=rad_conf.u_DS_all[spacecraft][band_id],
+                           u_diff_abs=rad_conf.u_diff_absarray[spacecraft][band_id])
+
+
+def flag_codes(masks, codes, out=None):
+    """
+    Combines the masks of a tile into the flag codes. Where several masks are set, the highest code is kept.
+    :param masks: 2-D array with one row per mask (flattened tile), non-zero where the mask is set
+    :param codes: flag code of each mask row, in increasing order
+    :param out: uint8 array receiving the flags. Allocated if None
+    :return: uint8 array with the flag code of each pixel, 0 where no mask is set
+    """
+    if out is None:
+        out = np.zeros(masks.shape[1], np.uint8)
+    else:
+        out[:] = 0
+    is_set = np.empty(masks.shape[1], np.bool_)
+    for mask, code in zip(masks, codes):
+        np.not_equal(mask, 0, out=is_set)
+        np.copyto(out, code, where=is_set)
+    return out
+
+
+def unflagged_pixels(flags):
+    """
+    Selects the pixels of a tile where the uncertainty has to be computed.
+    :param flags: flag codes of the tile (see flag_codes)
+    :return: None if the uncertainty is computed on the whole tile, otherwise the flat indices of the unflagged pixels
+    (empty if the whole tile is flagged)
+    """
+    if np.count_nonzero(flags) < COMPRESS_FLAGGED_FRACTION * flags.size:
+        return None
+    return np.flatnonzero(flags == 0)
+
+
+def reduce_blocks(data, factor, ufunc, dtype=None):
+    """
+    Reduces the blocks of factor rows of an array, the last one being smaller if the rows are not a multiple.
+    Reshaping the whole blocks is much faster than ufunc.reduceat.
+    :return: array with ceil(rows / factor) rows
+    """
+    full = data.shape[0] // factor * factor
+    blocks = ufunc.reduce(data[:full].reshape((full // factor, factor) + data.shape[1:]), axis=1, dtype=dtype)
+    if full == data.shape[0]:
+        return blocks
+    return np.concatenate([blocks, ufunc.reduce(data[full:], axis=0, dtype=dtype)[np.newaxis]])
+
+
+def block_mean(data, factor):
+    """
+    Aggregates a 2-D raster to an overview, as the mean of factor x factor blocks.
+    :param data: 2-D array (height, width)
+    :param factor: size of the blocks. The last blocks of a row or column are smaller if the size is not a multiple
+    :return: float32 array (ceil(height / factor), ceil(width / factor))
+    """
+    height, width = data.shape
+    sums = reduce_blocks(reduce_blocks(data, factor, np.add, np.float64).T, factor, np.add).T
+    counts = np.outer(np.diff(np.append(np.arange(0, height, factor), height)),
+                      np.diff(np.append(np.arange(0, width, factor), width)))
+    return (sums / counts).astype(np.float32)
+
+
+def block_flags(flags, factor):
+    """
+    Aggregates the flag codes of a 2-D raster to an overview. A block takes the highest code of its pixels, so any
+    flagged pixel flags the block with the code of highest priority.
+    :param flags: 2-D uint8 array (height, width) of flag codes (see flag_codes), or of uncertainty and flag codes
+    :param factor: size of the blocks (see block_mean)
+    :return: uint8 array (ceil(height / factor), ceil(width / factor))
+    """
+    return reduce_blocks(reduce_blocks(flags, factor, np.maximum).T, factor, np.maximum).T
+
+
+def overview_reference(rut, factor):
+    """
+    Overview of a full resolution uncertainty band, to validate an overview computed from aggregated DN and SZA: the
+    flag codes as block_flags and the mean uncertainty of the unflagged blocks.
+    :param rut: 2-D uint8 array with the uncertainty and flag codes of a band
+    :param factor: size of the blocks (see block_mean)
+    :return: uint8 array (ceil(height / factor), ceil(width / factor))
+    """
+    flags = block_flags(np.where(rut > 250, rut, 0).astype(np.uint8), factor)
+    unc = np.rint(block_mean(rut, factor)).astype(np.uint8)
+    return np.where(flags > 0, flags, unc)
+
+
+def new_scratch(size):
+    """
+    Allocates the scratch buffers of unc_kernel. They can be reused for any tile up to size pixels.
+    :param size: number of pixels
+    :return: pair of float32 arrays
+    """
+    return np.empty(size, np.float32), np.empty(size, np.float32)
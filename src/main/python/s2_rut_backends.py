@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the compute backends of the RUT uncertainty kernel.
+
+A backend is a function with the signature of s2_rut_algo.unc_kernel(params, band_data, cos_tecta, out, scratch):
+- 'numpy': s2_rut_algo.unc_kernel, in place on two float32 scratch buffers. Always available and the reference.
+- 'numexpr': the combination of the contributors evaluated as fused expressions, in blocks and multithreaded.
+- 'numba': a compiled per-pixel loop without any intermediate array, running without the GIL.
+
+The optional backends are loaded on first use. A backend that is not installed, or whose output on the verification
+tile differs from the 'numpy' backend, is not available and the selection falls back to the next one.
+"""
+
+import math
+import os
+import threading
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+
+import s2_rut_algo
+
+# environment variable selecting the backend when the operator parameter is 'auto'
+BACKEND_ENV = 'S2RUT_BACKEND'
+# backends tried by 'auto', fastest first
+BACKEND_PREFERENCE = ['numba', 'numexpr', 'numpy']
+
+loaders = OrderedDict()  # backend name -> function returning the kernel, raising ImportError if not installed
+kernels = {}  # backend name -> verified kernel, None if not available
+lock = threading.Lock()
+
+
+def register_backend(name, loader):
+    """
+    Adds a backend to the registry. It will be verified against the 'numpy' backend when it is first used.
+    :param name: name of the backend
+    :param loader: function without parameters returning the kernel. It raises ImportError if a dependency is missing
+    """
+    with lock:
+        loaders[name] = loader
+        kernels.pop(name, None)
+
+
+def check_backend_name(name, auto=True):
+    """
+    Validates a backend name without loading the backend.
+    :param name: name of a registered backend, or 'auto' if allowed
+    :param auto: whether 'auto' is valid
+    """
+    if name not in loaders and not (auto and name == 'auto'):
+        raise RuntimeError('Unknown RUT backend "' + name + '". Valid values: ' + ', '.join(['auto'] + list(loaders)))
+
+
+def load_backend(name):
+    """
+    :param name: name of a registered backend
+    :return: verified kernel of the backend, or None if it is not installed or not equivalent to the reference
+    """
+    check_backend_name(name, auto=False)
+    with lock:
+        if name not in kernels:
+            try:
+                kernel = loaders[name]()
+            except ImportError:
+                kernel = None
+            if kernel is not None and name != 'numpy':
+                error = verify_backend(kernel)
+                if error is not None:
+                    warnings.warn('RUT backend "' + name + '" is disabled: ' + error)
+                    kernel = None
+            kernels[name] = kernel
+        return kernels[name]
+
+
+def get_backend(name='auto'):
+    """
+    Selects the kernel backend. 'auto' uses the S2RUT_BACKEND environment variable if set, otherwise the first
+    available backend of BACKEND_PREFERENCE. A backend that is not available falls back in the same order.
+    :param name: name of a backend or 'auto'
+    :return: (name, kernel) of the selected backend
+    """
+    if not name or name == 'auto':
+        name = os.environ.get(BACKEND_ENV, '') or 'auto'
+    if name != 'auto':
+        if load_backend(name) is not None:
+            return name, kernels[name]
+        warnings.warn('RUT backend "' + name + '" is not available, falling back')
+    for candidate in BACKEND_PREFERENCE:
+        if candidate in loaders and load_backend(candidate) is not None:
+            return candidate, kernels[candidate]
+    return 'numpy', load_backend('numpy')
+
+
+def available_backends():
+    """
+    :return: names of the registered backends that are available (this loads and verifies them)
+    """
+    return [name for name in loaders if load_backend(name) is not None]
+
+
+def verification_tile():
+    """
+    Kernel inputs covering the range of the S2 reflectances (including no data) and SZA, for all contributors and for
+    each contributor alone (small and large uncertainties, values clipped at 250).
+    :return: list of (params, band_data, cos_tecta)
+    """
+    rut_algo = s2_rut_algo.S2RutAlgo()
+    rut_algo.u_sun = 1.03418574554466
+    rut_algo.k = 2.0
+    coeffs = s2_rut_algo.get_band_coeffs(7, 'Sentinel-2A', 6.22865527455779, 1036.39, 0.571, 0.04447, 3.0)
+    band_data = np.concatenate([[0.0], np.linspace(0.0001, 0.01, 999), np.linspace(0.01, 1.6, 3000)])
+    band_data = band_data.astype(np.float32)
+    cos_tecta = np.cos(np.radians(np.linspace(10., 80., band_data.size))).astype(np.float32)
+    selections = [None] + [s2_rut_algo.contributor_select(index) for index in range(len(rut_algo.unc_select))]
+    return [(rut_algo.kernel_params(coeffs, unc_select), band_data, cos_tecta) for unc_select in selections]
+
+
+def verify_backend(kernel):
+    """
+    Compares a kernel with the 'numpy' backend on the verification tile. The float32 rounding may differ by one unit
+    (0.1%) in rare pixels, as between unc_kernel and S2RutAlgo.unc_calculation.
+    :param kernel: kernel function
+    :return: None if equivalent, otherwise the description of the difference
+    """
+    for params, band_data, cos_tecta in verification_tile():
+        expected = s2_rut_algo.unc_kernel(params, band_data, cos_tecta)
+        try:
+            result = kernel(params, band_data, cos_tecta, out=np.empty(band_data.size, np.uint8),
+                            scratch=s2_rut_algo.new_scratch(band_data.size))
+            scalar = kernel(params, band_data, cos_tecta[0])
+        except Exception as e:
+            return 'failed on the verification tile (' + str(e) + ')'
+        difference = np.abs(expected.astype(np.int16) - result)
+        if result.dtype != np.uint8 or difference.max() > 1 or np.mean(difference != 0) > 0.001:
+            return 'differs from the numpy backend by up to %d' % difference.max()
+        if not np.array_equal(scalar, kernel(params, band_data, np.full(band_data.size, cos_tecta[0], np.float32))):
+            return 'differs with a scalar SZA'
+    return None
+
+
+def load_numpy():
+    return s2_rut_algo.unc_kernel
+
+
+def load_numexpr():
+    import numexpr
+
+    # u_expand = c_temp + c_sys / cn + 10 k sqrt(c_const + (c_lin + (c_quad + c_quant cos^2) / cn) / cn)
+    inverse_cn = 'cn_factor_inverse / (band_data * cos_tecta)'
+    u_expand = ('c_temp + c_sys * inverse_cn + k10 * sqrt(c_const + (c_lin + (c_quad + c_quant * cos_tecta ** 2) '
+                '* inverse_cn) * inverse_cn)')
+
+    def unc_kernel_numexpr(params, band_data, cos_tecta, out=None, scratch=None):
+        band_data = np.asarray(band_data, np.float32)
+        shape = band_data.shape
+        if scratch is None:
+            scratch = s2_rut_algo.new_scratch(band_data.size)
+        buf_cn = scratch[0][:band_data.size].reshape(shape)
+        buf_unc = scratch[1][:band_data.size].reshape(shape)
+        if out is None:
+            out = np.empty(shape, np.uint8)
+        # float32 constants keep the evaluation in float32, as in the numpy backend
+        constants = dict((name, np.float32(value)) for name, value in params._asdict().items())
+        constants['cn_factor_inverse'] = np.float32(1 / params.cn_factor) if params.cn_factor else np.float32(np.inf)
+        constants['k10'] = np.float32(10 * params.k)
+        cos_tecta = np.asarray(cos_tecta, np.float32)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            numexpr.evaluate(inverse_cn, local_dict=dict(constants, band_data=band_data, cos_tecta=cos_tecta),
+                             out=buf_cn, casting='same_kind')
+            numexpr.evaluate(u_expand, local_dict=dict(constants, inverse_cn=buf_cn, cos_tecta=cos_tecta),
+                             out=buf_unc, casting='same_kind')
+            np.rint(buf_unc, out=buf_unc)
+            np.clip(buf_unc, 0, 250, out=buf_unc)
+            np.copyto(out, buf_unc, casting='unsafe')
+        return out
+
+    return unc_kernel_numexpr
+
+
+def load_numba():
+    import numba
+
+    @numba.njit(nogil=True, error_model='numpy')  # division by zero gives inf as in numpy
+    def unc_loop(band_data, cos_tecta, out, cn_factor, c_const, c_lin, c_quad, c_quant, c_sys, c_temp, k10):
+        for i in range(band_data.size):
+            cos_i = cos_tecta[i]
+            inverse_cn = np.float32(1) / (band_data[i] * cos_i * cn_factor)
+            u_1sigma = math.sqrt(c_const + (c_lin + (c_quad + c_quant * cos_i * cos_i) * inverse_cn) * inverse_cn)
+            u_expand = np.rint(c_temp + c_sys * inverse_cn + k10 * np.float32(u_1sigma))
+            if u_expand >= 250:  # also +inf of null reflectances
+                out[i] = 250
+            elif u_expand > 0:
+                out[i] = np.uint8(u_expand)
+            else:  # also NaN, as np.copyto of the numpy backend
+                out[i] = 0
+
+    def unc_kernel_numba(params, band_data, cos_tecta, out=None, scratch=None):
+        band_data = np.asarray(band_data, np.float32)
+        if out is None:
+            out = np.empty(band_data.shape, np.uint8)
+        cos_tecta = np.broadcast_to(np.asarray(cos_tecta, np.float32), band_data.shape)
+        flat_out = out.reshape(-1)  # view for contiguous outputs
+        unc_loop(band_data.ravel(), np.ascontiguousarray(cos_tecta).ravel(), flat_out,
+                 *[np.float32(value) for value in params[:-1] + (10 * params.k,)])
+        if not np.shares_memory(flat_out, out):
+            out[...] = flat_out.reshape(out.shape)
+        return out
+
+    return unc_kernel_numba
+
+
+register_backend('numpy', load_numpy)
+register_backend('numexpr', load_numexpr)
+register_backend('numba', load_numba)
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Batch processing of many S2 L1C products with a bounded number of concurrent RUT jobs.
+
+Each job runs either the standalone engine (s2_rut_engine) inside a worker process, or SNAP's gpt when the engine
+cannot read the product (rasterio missing, or GML masks of the processing baselines before 04.00). The state of every
+product is kept in a JSON manifest, so an interrupted batch can be restarted and only processes what is missing or
+failed.
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import json
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import time
+import traceback
+import xml.etree.ElementTree as ET
+
+import s2_rut_cache
+from s2_rut_algo import S2_BAND_NAMES
+
+MANIFEST_NAME = 's2_rut_manifest.json'
+GPT_PATH = '/opt/snap/bin/gpt'
+
+
+def find_products(paths):
+    """
+    Expands the batch inputs into a list of SAFE products.
+    :param paths: SAFE directories, directories containing SAFE products, or text files listing one product per line
+    :return: sorted list of SAFE directory paths
+    """
+    products = []
+    for path in paths:
+        if path.endswith('.SAFE') and os.path.isdir(path):
+            products.append(path)
+        elif os.path.isdir(path):
+            products.extend(glob.glob(os.path.join(path, '*.SAFE')))
+        elif os.path.isfile(path):
+            with open(path) as f:
+                products.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+        else:
+            raise RuntimeError('Product "' + path + '" does not exist')
+    return sorted(set(os.path.normpath(product) for product in products))
+
+
+def product_name(product):
+    return os.path.basename(os.path.normpath(product))[:-len('.SAFE')]
+
+
+def engine_available():
+    try:
+        import rasterio
+        return True
+    except ImportError:
+        return False
+
+
+def processing_baseline(product):
+    """
+    :return: processing baseline of the product (e.g. '02.06'), from its name or else from its MTD_MSIL1C.xml. None if
+    it is unknown
+    """
+    match = re.search(r'_N(\d\d)(\d\d)_', product_name(product))
+    if match:
+        return match.group(1) + '.' + match.group(2)
+    try:
+        root = ET.parse(os.path.join(product, 'MTD_MSIL1C.xml')).getroot()
+    except (IOError, ET.ParseError):
+        return None
+    for element in root.iter():
+        if element.tag.rsplit('}', 1)[-1] == 'PROCESSING_BASELINE':
+            return element.text.strip()
+    return None
+
+
+def product_engine(product):
+    """
+    :return: 'python' when the standalone engine can read the product, that is rasterio is installed and the masks are
+    the JPEG2000 images of processing baseline 04.00 and later, 'gpt' otherwise
+    """
+    baseline = processing_baseline(product)
+    return 'python' if baseline is not None and baseline >= '04.00' and engine_available() else 'gpt'
+
+
+def result_cache(options):
+    """
+    :return: S2RutResultCache of the batch, None if the batch has no cache
+    """
+    if not options.get('cache_dir'):
+        return None
+    return s2_rut_cache.S2RutResultCache(options['cache_dir'], options['cache_bytes'])
+
+
+def engine_job(product, output_dir, options):
+    """
+    Runs the standalone engine in the current (worker) process. Bands found in the result cache are copied instead.
+    :return: list with the output files
+    """
+    target_dir = os.path.join(output_dir, product_name(product) + '_rut')
+    keys = dict((band_name, s2_rut_cache.result_key(product_name(product), [band_name], None,
+                                                    options['coverage_factor'], 'python'))
+                for band_name in options['band_names'])
+
+    def compute(band_names):
+        import s2_rut_engine
+        engine = s2_rut_engine.S2RutEngine(product, s2_rut_engine.S2Jp2Reader(product), k=options['coverage_factor'])
+        return engine.run(band_names, target_dir)
+
+    return sorted(s2_rut_cache.run_cached(result_cache(options), keys, target_dir, compute).values())
+
+
+def gpt_job(product, output_dir, options):
+    """
+    Runs S2RutOp with SNAP's gpt in a child process whose JVM heap is limited to the memory budget. The BEAM-DIMAP
+    product cannot be assembled from cached bands, so it is cached as a whole for its band list.
+    :return: list with the output files
+    """
+    target = os.path.join(output_dir, product_name(product) + '_rut.dim')
+    cache = result_cache(options)
+    key = s2_rut_cache.result_key(product_name(product), sorted(options['band_names']), None,
+                                  options['coverage_factor'], 'gpt')
+    if cache is not None and cache.get(key, output_dir):
+        return [target]
+    command = [options['gpt'], 'S2RutOp', '-Ssource=' + os.path.join(product, 'MTD_MSIL1C.xml'), '-t', target,
+               '-Pband_names=' + ','.join(options['band_names']),
+               '-Pcoverage_factor=' + str(options['coverage_factor']), '-q', str(options['threads'])]
+    env = dict(os.environ)
+    if options['memory_mb']:
+        env['_JAVA_OPTIONS'] = '-Xmx%dm' % options['memory_mb']
+    process = subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError('gpt failed with exit code %d: %s' % (process.returncode, process.stdout[-2000:]))
+    if cache is not None:
+        data_dir = target[:-len('.dim')] + '.data'
+        cache.put(key, [target, data_dir] if os.path.isdir(data_dir) else [target])
+    return [target]
+
+
+def limit_memory(memory_mb):
+    """
+    Worker initializer: limits the address space of the worker process to the memory budget.
+    """
+    if not memory_mb:
+        return
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return
+    limit = memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def timed_job(job, product, output_dir, options):
+    """
+    Runs a job and never raises, so that one failing product does not stop the batch.
+    :return: dictionary with the manifest entry of the product
+    """
+    start = time.time()
+    try:
+        outputs = job(product, output_dir, options)
+        return {'status': 'done', 'outputs': outputs, 'wall_time': time.time() - start}
+    except Exception as e:
+        return {'status': 'failed', 'error': str(e) or repr(e), 'traceback': traceback.format_exc(),
+                'wall_time': time.time() - start}
+
+
+class S2RutBatch:
+    """
+    Runs RUT jobs for a list of products on a pool of at most `workers` concurrent jobs.
+    """
+
+    def __init__(self, output_dir, workers=2, memory_mb=None, band_names=None, coverage_factor=1.0, engine='auto',
+                 gpt=GPT_PATH, manifest_path=None, cache_dir=None, cache_size_mb=10240):
+        """
+        :param output_dir: directory of the RUT outputs
+        :param workers: maximum number of concurrent jobs
+        :param memory_mb: memory budget of each job in MB (None for no limit)
+        :param band_names: bands to process (all if None)
+        :param coverage_factor: coverage factor k
+        :param engine: 'python' (standalone engine in worker processes), 'gpt' or 'auto' (per product, see
+        product_engine)
+        :param gpt: path of SNAP's gpt executable
+        :param manifest_path: path of the JSON manifest (default in output_dir)
+        :param cache_dir: directory of the result cache shared between batches (None for no cache)
+        :param cache_size_mb: size of the result cache in MB, the least recently used results beyond it are removed
+        """
+        if engine not in ('auto', 'python', 'gpt'):
+            raise ValueError('Unknown engine "' + engine + '"')
+        self.output_dir = output_dir
+        self.workers = max(1, workers)
+        self.memory_mb = memory_mb
+        self.engine = engine
+        self.jobs = {'python': engine_job, 'gpt': gpt_job}
+        self.options = {'band_names': band_names or S2_BAND_NAMES, 'coverage_factor': coverage_factor, 'gpt': gpt,
+                        'memory_mb': memory_mb, 'threads': max(1, multiprocessing.cpu_count() // self.workers),
+                        'cache_dir': cache_dir, 'cache_bytes': cache_size_mb * 1024 * 1024}
+        self.manifest_path = manifest_path or os.path.join(output_dir, MANIFEST_NAME)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def is_done(self, product):
+        """
+        :return: True if the product was processed with the bands and the coverage factor of the batch and its outputs
+        still exist
+        """
+        entry = self.manifest.get(product_name(product))
+        return (entry is not None and entry['status'] == 'done' and
+                entry.get('band_names') == sorted(self.options['band_names']) and
+                entry.get('coverage_factor') == self.options['coverage_factor'] and
+                all(os.path.exists(path) for path in entry['outputs']))
+
+    def save_manifest(self):
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def run(self, products, log=sys.stdout):
+        """
+        Processes the products that are not completed yet.
+        :param products: list of SAFE product paths
+        :param log: stream for the progress report (None for silence)
+        :return: list with the names of the failed products
+        """
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        pending = [product for product in products if not self.is_done(product)]
+        if log:
+            log.write('%d products, %d already done, %d workers\n' % (len(products), len(products) - len(pending),
+                                                                      self.workers))
+        engines = dict((product, self.engine if self.engine != 'auto' else product_engine(product))
+                       for product in pending)
+        # one pool per engine, one after the other, so that at most `workers` jobs run concurrently
+        for engine in ('python', 'gpt'):
+            engine_products = [product for product in pending if engines[product] == engine]
+            if not engine_products:
+                continue
+            # the python engine runs in the workers, so their address space is limited. gpt jobs limit their own JVM
+            # heap
+            if engine == 'python':
+                pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=limit_memory,
+                                                              initargs=(self.memory_mb,))
+            else:
+                pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+            with pool:
+                futures = dict((pool.submit(timed_job, self.jobs[engine], product, self.output_dir, self.options),
+                                product) for product in engine_products)
+                for future in concurrent.futures.as_completed(futures):
+                    name = product_name(futures[future])
+                    try:
+                        entry = future.result()
+                    except Exception as e:  # the worker process itself died (e.g. out of memory)
+                        entry = {'status': 'failed', 'error': str(e) or repr(e), 'wall_time': None}
+                    entry['engine'] = engine
+                    entry['band_names'] = sorted(self.options['band_names'])
+                    entry['coverage_factor'] = self.options['coverage_factor']
+                    self.manifest[name] = entry
+                    self.save_manifest()
+                    if log:
+                        wall_time = '-' if entry['wall_time'] is None else '%.1f s' % entry['wall_time']
+                        log.write('%s %s (%s)%s\n' % (entry['status'], name, wall_time,
+                                                      ': ' + entry['error'] if entry['status'] == 'failed' else ''))
+        return sorted(product_name(product) for product in pending
+                      if self.manifest[product_name(product)]['status'] == 'failed')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Runs the S2 Radiometric Uncertainty Tool on many products')
+    parser.add_argument('products', nargs='+',
+                        help='SAFE products, directories containing them or text files listing them')
+    parser.add_argument('-o', '--output_dir', required=True, help='directory of the RUT outputs and manifest')
+    parser.add_argument('-w', '--workers', type=int, default=2, help='maximum number of concurrent jobs')
+    parser.add_argument('-m', '--memory_mb', type=int, default=None, help='memory budget per job in MB')
+    parser.add_argument('--bands', default=','.join(S2_BAND_NAMES), help='comma separated band names')
+    parser.add_argument('--coverage_factor', type=float, default=1.0, help='coverage factor k')
+    parser.add_argument('--engine', choices=['auto', 'python', 'gpt'], default='auto',
+                        help='standalone python engine or SNAP gpt (auto uses python for the products of '
+                             'processing baseline 04.00 and later when rasterio is installed)')
+    parser.add_argument('--gpt', default=GPT_PATH, help='path of the gpt executable')
+    parser.add_argument('--cache_dir', default=None, help='directory of a result cache reused between batches')
+    parser.add_argument('--cache_size_mb', type=int, default=10240, help='size of the result cache in MB')
+    options = parser.parse_args(args)
+    batch = S2RutBatch(options.output_dir, options.workers, options.memory_mb, options.bands.split(','),
+                       options.coverage_factor, options.engine, options.gpt, cache_dir=options.cache_dir,
+                       cache_size_mb=options.cache_size_mb)
+    failed = batch.run(find_products(options.products))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of RUT results, addressed by the content of their inputs.
+
+The RUT output of a band is fully determined by the L1C product, the selected contributors, the coverage factor, the
+version of the operator and the coefficient tables of s2_l1_rad_conf. The key of a result is the SHA-256 of all of
+them, so a result is reused whatever the output directory of the job, and any change of the inputs or of the
+coefficient tables gives a new key.
+
+Every entry is a directory named after its key, holding the result files and directories. The modification time of
+the entry is its last use: when the cache exceeds its size, the least recently used entries are removed. Entries are
+written in a temporary directory and renamed, so several jobs can share the cache.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+
+import s2_l1_rad_conf as rad_conf
+
+OPERATOR_INFO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 's2_rut-info.xml')
+
+
+def operator_version():
+    """
+    :return: version of S2RutOp, as written in the result metadata
+    """
+    return ET.parse(OPERATOR_INFO).getroot().findtext('.//version')
+
+
+def rad_conf_fingerprint():
+    """
+    :return: SHA-256 of the coefficient tables of s2_l1_rad_conf
+    """
+    tables = dict((name, value) for name, value in vars(rad_conf).items()
+                  if not name.startswith('_') and isinstance(value, (dict, list, tuple, int, float, str)))
+    return hashlib.sha256(json.dumps(tables, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def result_key(product_id, band_names, unc_select, coverage_factor, engine, version=None):
+    """
+    :param product_id: name of the L1C product (unique, with the processing baseline and generation time)
+    :param band_names: bands of the result
+    :param unc_select: selected contributors (order of S2RutAlgo.unc_select), None for all of them
+    :param coverage_factor: coverage factor k
+    :param engine: producer of the result files ('python' or 'gpt'), as they have different formats
+    :param version: version of the operator. The current one if None
+    :return: hexadecimal key of the result
+    """
+    inputs = {'product': product_id, 'bands': list(band_names),
+              'unc_select': None if unc_select is None else [bool(selected) for selected in unc_select],
+              'coverage_factor': float(coverage_factor), 'engine': engine,
+              'version': operator_version() if version is None else version, 'rad_conf': rad_conf_fingerprint()}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class S2RutResultCache:
+    """
+    LRU cache of result files, limited in size.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        """
+        :param cache_dir: directory of the cache
+        :param max_bytes: maximum size of the cached files [bytes]
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key, target_dir):
+        """
+        Copies the files of a cached result to a directory.
+        :param key: key of the result (see result_key)
+        :param target_dir: directory receiving the files
+        :return: list with the paths of the copied files, None if the result is not cached
+        """
+        entry = self.entry_path(key)
+        try:
+            names = sorted(os.listdir(entry))
+            os.utime(entry, None)  # last use
+        except OSError:
+            return None
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        paths = []
+        for name in names:
+            source = os.path.join(entry, name)
+            target = os.path.join(target_dir, name)
+            if os.path.isdir(source):
+                if os.path.isdir(target):
+                    shutil.rmtree(target)
+                shutil.copytree(source, target)
+            else:
+                shutil.copyfile(source, target)
+            paths.append(target)
+        return paths
+
+    def put(self, key, paths):
+        """
+        Stores the files of a result and evicts the least recently used results beyond the cache size.
+        :param key: key of the result (see result_key)
+        :param paths: result files or directories
+        """
+        entry = self.entry_path(key)
+        if os.path.isdir(entry):
+            os.utime(entry, None)
+            return
+        temporary = tempfile.mkdtemp(prefix='.tmp', dir=self.cache_dir)
+        for path in paths:
+            target = os.path.join(temporary, os.path.basename(path))
+            if os.path.isdir(path):
+                shutil.copytree(path, target)
+            else:
+                shutil.copyfile(path, target)
+        try:
+            os.rename(temporary, entry)
+        except OSError:  # stored meanwhile by another job
+            shutil.rmtree(temporary, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        """
+        :return: list of (last use, size in bytes, key) of the cached results, least recently used first
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = self.entry_path(key)
+            if key.startswith('.tmp') or not os.path.isdir(entry):
+                continue
+            try:
+                entries.append((os.path.getmtime(entry), directory_size(entry), key))
+            except OSError:  # evicted meanwhile by another job
+                continue
+        return sorted(entries)
+
+    def evict(self):
+        """
+        Removes the least recently used results until the cache fits in its size.
+        """
+        entries = self.entries()
+        total = sum(size for last_use, size, key in entries)
+        for last_use, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            total -= size
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, names in os.walk(path) for name in names)
+
+
+def run_cached(cache, keys, target_dir, compute):
+    """
+    Reuses the cached bands of a result and computes only the missing ones.
+    :param cache: S2RutResultCache, or None to compute all the bands
+    :param keys: dictionary with the key of each band (see result_key with a single band)
+    :param target_dir: directory of the band files
+    :param compute: function computing a list of band names into target_dir, returning the path of each band in a
+    dictionary
+    :return: dictionary with the path of each band
+    """
+    paths = {}
+    for band_name, key in keys.items():
+        cached = cache.get(key, target_dir) if cache is not None else None
+        if cached:
+            paths[band_name] = cached[0]
+    missing = [band_name for band_name in keys if band_name not in paths]
+    if missing:
+        computed = compute(missing)
+        if cache is not None:
+            for band_name in missing:
+                cache.put(keys[band_name], [computed[band_name]])
+        paths.update(computed)
+    return paths
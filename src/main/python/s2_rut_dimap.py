@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Reader of the BEAM-DIMAP products written by the RUT, without SNAP.
+
+A DIMAP product is a '.dim' XML header and a '.data' directory with one raw ENVI image ('.img' and '.hdr') per band.
+The band images are memory mapped, so a window of a band is a view of the file: nothing is read until it is used.
+The map geocoding of the '.dim' header (image-to-model transform of each band and Transverse Mercator CRS, as in the
+UTM tiles of S2) converts lat/lon positions to pixel positions.
+"""
+
+import math
+import os
+import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+# ENVI 'data type' codes
+ENVI_DATA_TYPES = {1: np.uint8, 2: np.int16, 3: np.int32, 4: np.float32, 5: np.float64, 12: np.uint16, 13: np.uint32,
+                   14: np.int64, 15: np.uint64}
+
+
+class S2DimapReader:
+    """
+    Memory mapped bands and map geocoding of a DIMAP product.
+    """
+
+    def __init__(self, dim_path):
+        """
+        :param dim_path: path of the '.dim' file
+        """
+        self.dim_path = dim_path
+        root = ET.parse(dim_path).getroot()
+        names = dict((int(info.findtext('BAND_INDEX')), info.findtext('BAND_NAME'))
+                     for info in root.iter('Spectral_Band_Info'))
+        self.headers = {}  # band name -> path of the ENVI header
+        for data_file in root.iter('Data_File'):
+            href = data_file.find('DATA_FILE_PATH').get('href')
+            self.headers[names[int(data_file.findtext('BAND_INDEX'))]] = os.path.join(os.path.dirname(dim_path), href)
+        self.transforms = {}  # band name -> (origin_x, origin_y, resolution_x, resolution_y)
+        product_transform = None
+        for geoposition in root.iter('Geoposition'):
+            text = geoposition.findtext('IMAGE_TO_MODEL_TRANSFORM')
+            if text is None:
+                continue
+            # flat matrix of java.awt.geom.AffineTransform: m00, m10, m01, m11, m02, m12
+            m00, m10, m01, m11, m02, m12 = [float(value) for value in text.split(',')]
+            if m10 != 0 or m01 != 0:
+                raise RuntimeError('Rotated image-to-model transforms are not supported')
+            if geoposition.findtext('BAND_INDEX') is None:
+                product_transform = (m02, m12, m00, m11)
+            else:
+                self.transforms[names[int(geoposition.findtext('BAND_INDEX'))]] = (m02, m12, m00, m11)
+        for name in self.headers:
+            if name not in self.transforms and product_transform is not None:
+                self.transforms[name] = product_transform
+        self.crs_wkt = root.findtext('.//Coordinate_Reference_System/WKT')
+        self.projection = None
+        self.bands = {}
+
+    def band_names(self):
+        return sorted(self.headers)
+
+    def band(self, band_name):
+        """
+        :param band_name: name of the band
+        :return: read-only numpy memmap (rows, columns) of the band image
+        """
+        if band_name not in self.bands:
+            if band_name not in self.headers:
+                raise RuntimeError('Band "' + band_name + '" is not in product "' + self.dim_path + '"')
+            header_path = self.headers[band_name]
+            header = read_envi_header(header_path)
+            if int(header.get('bands', '1')) != 1:
+                raise RuntimeError('Only single band ENVI images are supported')
+            dtype = np.dtype(ENVI_DATA_TYPES[int(header['data type'])])
+            dtype = dtype.newbyteorder('>' if header.get('byte order', '0') == '1' else '<')
+            self.bands[band_name] = np.memmap(header_path[:-len('.hdr')] + '.img', dtype=dtype, mode='r',
+                                              offset=int(header.get('header offset', '0')),
+                                              shape=(int(header['lines']), int(header['samples'])))
+            if band_name not in self.transforms and 'map info' in header:
+                self.transforms[band_name] = map_info_transform(header['map info'])
+        return self.bands[band_name]
+
+    def window(self, band_name, x, y, width, height):
+        """
+        :return: view (no copy) of a window of the band
+        """
+        return self.band(band_name)[y:y + height, x:x + width]
+
+    def pixel_position(self, band_name, lat, lon):
+        """
+        Converts a geographic position to a (fractional) pixel position of a band. Pixel (0, 0) spans [0, 1).
+        :return: (x, y)
+        """
+        if self.projection is None:
+            if not self.crs_wkt:
+                raise RuntimeError('Product "' + self.dim_path + '" has no map geocoding')
+            self.projection = get_projection(self.crs_wkt)
+        self.band(band_name)
+        origin_x, origin_y, resolution_x, resolution_y = self.transforms[band_name]
+        easting, northing = self.projection(lat, lon)
+        return (easting - origin_x) / resolution_x, (northing - origin_y) / resolution_y
+
+    def roi(self, band_name, lat, lon, width, height):
+        """
+        Window of a ROI centred at a geographic position, selected as S2ROIuncprocessor.read_main does.
+        :param width: width of the ROI in meters
+        :param height: height of the ROI in meters
+        :return: view (no copy) of the ROI pixels
+        """
+        self.band(band_name)
+        sampling = abs(self.transforms[band_name][2])
+        wpix = int(round(width / sampling))
+        hpix = int(round(height / sampling))
+        x, y = self.pixel_position(band_name, lat, lon)
+        x_off = int(round(x - wpix / 2.))
+        y_off = int(round(y - hpix / 2.))
+        return self.window(band_name, x_off, y_off, wpix, hpix)
+
+
+def read_envi_header(path):
+    """
+    :param path: path of the ENVI '.hdr' file
+    :return: dictionary with the (lower case) keys and the string values of the header
+    """
+    with open(path) as f:
+        text = f.read()
+    if not text.startswith('ENVI'):
+        raise RuntimeError('"' + path + '" is not an ENVI header')
+    header = {}
+    for key, value in re.findall(r'^\s*([^=\n]+?)\s*=\s*(\{[^}]*\}|[^\n]*)', text, re.MULTILINE):
+        header[key.lower()] = value.strip()
+    return header
+
+
+def map_info_transform(map_info):
+    """
+    Image-to-model transform from the 'map info' of an ENVI header.
+    :return: (origin_x, origin_y, resolution_x, resolution_y)
+    """
+    values = [value.strip() for value in map_info.strip('{}').split(',')]
+    ref_x, ref_y, easting, northing, size_x, size_y = [float(value) for value in values[1:7]]
+    # the reference pixel is one-based and refers to the upper left corner of the pixel
+    return easting - (ref_x - 1) * size_x, northing + (ref_y - 1) * size_y, size_x, -size_y
+
+
+def get_projection(wkt):
+    """
+    :param wkt: WKT of the CRS
+    :return: function (lat, lon) -> (easting, northing)
+    """
+    if 'Transverse_Mercator' in wkt or 'Transverse Mercator' in wkt:
+        parameters = dict((name.lower(), float(value))
+                          for name, value in re.findall(r'PARAMETER\["([^"]+)",\s*([-0-9.eE+]+)\]', wkt))
+        spheroid = re.search(r'SPHEROID\["[^"]*",\s*([-0-9.eE+]+),\s*([-0-9.eE+]+)', wkt)
+        a, inverse_flattening = (float(spheroid.group(1)), float(spheroid.group(2))) if spheroid else (6378137.0,
+                                                                                                       298.257223563)
+        return lambda lat, lon: transverse_mercator(lat, lon, parameters.get('central_meridian', 0.0),
+                                                    parameters.get('latitude_of_origin', 0.0),
+                                                    parameters.get('scale_factor', 1.0),
+                                                    parameters.get('false_easting', 0.0),
+                                                    parameters.get('false_northing', 0.0), a, 1 / inverse_flattening)
+    try:
+        import pyproj
+    except ImportError:
+        raise RuntimeError('Only Transverse Mercator (UTM) products are supported without pyproj')
+    transformer = pyproj.Transformer.from_crs('EPSG:4326', pyproj.CRS.from_wkt(wkt), always_xy=True)
+    return lambda lat, lon: transformer.transform(lon, lat)
+
+
+def transverse_mercator(lat, lon, central_meridian, latitude_of_origin, scale_factor, false_easting, false_northing,
+                        a=6378137.0, f=1 / 298.257223563):
+    """
+    Transverse Mercator projection on the ellipsoid (Snyder, Map Projections - A Working Manual, 1987, eq. 8-9/8-10).
+    Accurate to the millimetre within the few degrees of a UTM zone.
+    :return: (easting, northing)
+    """
+    e2 = f * (2 - f)
+    ep2 = e2 / (1 - e2)
+    phi = math.radians(lat)
+    n = a / math.sqrt(1 - e2 * math.sin(phi) ** 2)
+    t = math.tan(phi) ** 2
+    c = ep2 * math.cos(phi) ** 2
+    big_a = math.radians(lon - central_meridian) * math.cos(phi)
+    easting = false_easting + scale_factor * n * (big_a + (1 - t + c) * big_a ** 3 / 6 +
+                                                  (5 - 18 * t + t ** 2 + 72 * c - 58 * ep2) * big_a ** 5 / 120)
+    northing = false_northing + scale_factor * (
+        meridian_distance(phi, a, e2) - meridian_distance(math.radians(latitude_of_origin), a, e2) +
+        n * math.tan(phi) * (big_a ** 2 / 2 + (5 - t + 9 * c + 4 * c ** 2) * big_a ** 4 / 24 +
+                             (61 - 58 * t + t ** 2 + 600 * c - 330 * ep2) * big_a ** 6 / 720))
+    return easting, northing
+
+
+def meridian_distance(phi, a, e2):
+    return a * ((1 - e2 / 4 - 3 * e2 ** 2 / 64 - 5 * e2 ** 3 / 256) * phi -
+                (3 * e2 / 8 + 3 * e2 ** 2 / 32 + 45 * e2 ** 3 / 1024) * math.sin(2 * phi) +
+                (15 * e2 ** 2 / 256 + 45 * e2 ** 3 / 1024) * math.sin(4 * phi) -
+                (35 * e2 ** 3 / 3072) * math.sin(6 * phi))
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+Standalone S2-RUT engine. It computes the same uint8 uncertainty and flag codes as S2RutOp without SNAP, snappy or a
+JVM: the calibration coefficients and the sun angle grid are read from the SAFE metadata files with ElementTree and
+the band rasters and masks are obtained from a pluggable raster reader.
+"""
+
+import abc
+import argparse
+import datetime
+import glob
+import os
+
+try:
+    import xml.etree.cElementTree as ET  # C implementation is much faster and consumes significantly less memory
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+import numpy as np
+
+import s2_l1_rad_conf as rad_conf
+import s2_rut_algo
+import s2_rut_sza
+from s2_rut_algo import S2_BAND_NAMES, S2_BAND_SAMPLING, S2_BAND_MASKS, S2_CLOUD_MASKS
+
+# special DN values of the L1C images (Product_Image_Characteristics/Special_Values)
+NODATA_DN = 0
+SATURATED_DN = 65535
+
+TILE_SIZE = 1024  # size of the square tiles processed by S2RutEngine.run
+
+
+class S2RasterReader(abc.ABC):
+    """
+    Interface of the raster readers used by S2RutEngine. Band and mask names follow the SNAP naming
+    (e.g. 'B8A', 'nodata_B8A', 'opaque_clouds_20m').
+    """
+
+    @abc.abstractmethod
+    def read_band(self, band_name, x, y, width, height):
+        """
+        :return: 2-D array (height, width) with the quantized L1C values (DN) of the band
+        """
+
+    @abc.abstractmethod
+    def read_mask(self, mask_name, x, y, width, height):
+        """
+        :return: 2-D array (height, width), non-zero where the mask is set, or None if the mask is not available
+        """
+
+
+class S2NumpyReader(S2RasterReader):
+    """
+    Reader of in-memory or memory-mapped NumPy arrays.
+    """
+
+    def __init__(self, bands, masks=None):
+        """
+        :param bands: dictionary with the 2-D DN array of each band name
+        :param masks: dictionary with the 2-D array of each mask name
+        """
+        self.bands = bands
+        self.masks = masks if masks is not None else {}
+
+    @classmethod
+    def from_directory(cls, directory):
+        """
+        Memory-maps the '<band>.npy' and '<mask>.npy' files of a directory.
+        """
+        bands = {}
+        masks = {}
+        for path in glob.glob(os.path.join(directory, '*.npy')):
+            name = os.path.splitext(os.path.basename(path))[0]
+            (bands if name in S2_BAND_NAMES else masks)[name] = np.load(path, mmap_mode='r')
+        return cls(bands, masks)
+
+    def read_band(self, band_name, x, y, width, height):
+        return self.bands[band_name][y:y + height, x:x + width]
+
+    def read_mask(self, mask_name, x, y, width, height):
+        if mask_name not in self.masks:
+            return None
+        return self.masks[mask_name][y:y + height, x:x + width]
+
+
+class S2Jp2Reader(S2RasterReader):
+    """
+    Reader of the JPEG2000 images of a SAFE product, based on rasterio (optional dependency).
+    The masks are read from the JPEG2000 quality masks of processing baseline 04.00 and later. The GML masks of the
+    older products are not read: the reader raises a RuntimeError for them, so that they are processed with gpt.
+    """
+    # layers of MSK_QUALIT_Bxx.jp2 and MSK_CLASSI_B00.jp2
+    QUALITY_LAYERS = {'msi_lost_': 3, 'msi_degraded_': 4, 'defective_': 5, 'nodata_': 6, 'saturated_l1a_': 8}
+    CLASSI_LAYERS = {'opaque_clouds_': 1, 'cirrus_clouds_': 2}
+
+    def __init__(self, product_path):
+        try:
+            import rasterio
+        except ImportError:
+            raise RuntimeError('Reading the JPEG2000 images requires the rasterio package')
+        self.rasterio = rasterio
+        self.granule_dir = glob.glob(os.path.join(get_safe_dir(product_path), 'GRANULE', '*'))[0]
+        if not glob.glob(os.path.join(self.granule_dir, 'QI_DATA', 'MSK_QUALIT_*.jp2')):
+            raise RuntimeError('The product has no JPEG2000 quality masks (processing baseline before 04.00): its '
+                               'GML masks can only be read by SNAP')
+        self.datasets = {}
+
+    def dataset(self, pattern):
+        if pattern not in self.datasets:
+            paths = glob.glob(os.path.join(self.granule_dir, pattern))
+            if not paths:
+                raise RuntimeError('Image "' + pattern + '" not found in ' + self.granule_dir)
+            self.datasets[pattern] = self.rasterio.open(paths[0])
+        return self.datasets[pattern]
+
+    def read_window(self, dataset, layer, x, y, width, height, scale):
+        window = self.rasterio.windows.Window(x * scale, y * scale, width * scale, height * scale)
+        return dataset.read(layer, window=window, out_shape=(height, width),
+                            resampling=self.rasterio.enums.Resampling.nearest)
+
+    def read_band(self, band_name, x, y, width, height):
+        name = 'B%02d' % int(band_name[1:]) if band_name != 'B8A' else 'B8A'
+        return self.read_window(self.dataset(os.path.join('IMG_DATA', '*_' + name + '.jp2')), 1, x, y, width, height,
+                                1.0)
+
+    def read_mask(self, mask_name, x, y, width, height):
+        for prefix, layer in self.QUALITY_LAYERS.items():
+            if mask_name.startswith(prefix):
+                band_name = mask_name[len(prefix):]
+                name = 'B%02d' % int(band_name[1:]) if band_name != 'B8A' else 'B8A'
+                dataset = self.dataset(os.path.join('QI_DATA', 'MSK_QUALIT_' + name + '.jp2'))
+                return self.read_window(dataset, layer, x, y, width, height, 1.0)
+        for prefix, layer in self.CLASSI_LAYERS.items():
+            if mask_name.startswith(prefix):
+                dataset = self.dataset(os.path.join('QI_DATA', 'MSK_CLASSI_B00.jp2'))
+                sampling = int(mask_name[len(prefix):-1])
+                return self.read_window(dataset, layer, x, y, width, height, sampling / 60.0)
+        return None
+
+
+class S2RutEngine:
+    """
+    Radiometric uncertainty of a S2 L1C SAFE product, computed in Python only.
+    """
+
+    def __init__(self, product_path, reader, k=1.0, unc_select=None):
+        """
+        :param product_path: path of the SAFE directory or of its MTD_MSIL1C.xml file
+        :param reader: S2RasterReader providing the band rasters and masks
+        :param k: coverage factor
+        :param unc_select: list of 12 booleans with the selected uncertainty contributors (all if None)
+        """
+        safe_dir = get_safe_dir(product_path)
+        product_root = ET.parse(os.path.join(safe_dir, 'MTD_MSIL1C.xml')).getroot()
+        datastrip_root = ET.parse(glob.glob(os.path.join(safe_dir, 'DATASTRIP', '*', 'MTD_DS.xml'))[0]).getroot()
+        granule_root = ET.parse(glob.glob(os.path.join(safe_dir, 'GRANULE', '*', 'MTD_TL.xml'))[0]).getroot()
+        self.reader = reader
+
+        self.spacecraft = find_text(datastrip_root, 'SPACECRAFT_NAME')
+        self.rut_algo = s2_rut_algo.S2RutAlgo()
+        self.rut_algo.u_sun = float(find_text(product_root, 'U'))
+        self.rut_algo.quant = float(find_text(product_root, 'QUANTIFICATION_VALUE'))
+        self.rut_algo.k = k
+        if unc_select is not None:
+            self.rut_algo.unc_select = list(unc_select)
+
+        time_start = datetime.datetime.strptime(find_text(datastrip_root, 'DATASTRIP_SENSING_START'),
+                                                '%Y-%m-%dT%H:%M:%S.%fZ')
+        years = (time_start - rad_conf.time_init[self.spacecraft]).days / 365.25
+        gains = by_band_id([element for element in find_all(datastrip_root, 'Spectral_Band_Information')
+                            if find_all(element, 'PHYSICAL_GAINS')])
+        noise_models = by_band_id([element for element in find_all(datastrip_root, 'Radiometric_Quality')
+                                   if find_all(element, 'Noise_Model')])
+        e_suns = by_band_id(find_all(product_root, 'SOLAR_IRRADIANCE'))
+        # processing baseline 04.00 and later shift the DN by a radiometric offset
+        offsets = by_band_id(find_all(product_root, 'RADIO_ADD_OFFSET'))
+        self.band_coeffs = {}
+        self.radio_offsets = {}
+        for band_id in range(len(S2_BAND_NAMES)):
+            noise_model = noise_models[band_id]
+            self.band_coeffs[band_id] = s2_rut_algo.get_band_coeffs(
+                band_id, self.spacecraft, float(find_text(gains[band_id], 'PHYSICAL_GAINS')),
+                float(e_suns[band_id].text), float(find_text(noise_model, 'ALPHA')),
+                float(find_text(noise_model, 'BETA')), years)
+            self.radio_offsets[band_id] = float(offsets[band_id].text) if band_id in offsets else 0.0
+
+        self.geometry = {}
+        self.sizes = {}
+        for geoposition in find_all(granule_root, 'Geoposition'):
+            self.geometry[int(geoposition.get('resolution'))] = (
+                float(find_text(geoposition, 'ULX')), float(find_text(geoposition, 'ULY')),
+                float(find_text(geoposition, 'XDIM')), float(find_text(geoposition, 'YDIM')))
+        for size in find_all(granule_root, 'Size'):
+            self.sizes[int(size.get('resolution'))] = (int(find_text(size, 'NCOLS')), int(find_text(size, 'NROWS')))
+        self.sza_grid = get_sza_grid(granule_root, self.geometry[10][0], self.geometry[10][1])
+
+    def get_band_size(self, band_name):
+        """
+        :return: (width, height) of the band raster
+        """
+        return self.sizes[S2_BAND_SAMPLING[band_name]]
+
+    def process_tile(self, band_name, x, y, width, height, out=None):
+        """
+        Computes the uncertainty and flag codes of a rectangle of a band.
+        :param band_name: S2 band name (e.g. 'B2')
+        :param x: first column of the rectangle
+        :param y: first row of the rectangle
+        :param width: number of columns of the rectangle
+        :param height: number of rows of the rectangle
+        :param out: uint8 array (height, width) receiving the result. Allocated if None
+        :return: uint8 array (height, width), as in the target bands of S2RutOp
+        """
+        sampling = S2_BAND_SAMPLING[band_name]
+        if out is None:
+            out = np.empty((height, width), np.uint8)
+        dn, flags = self.read_dn_flags(band_name, x, y, width, height)
+        origin_x, origin_y, resolution_x, resolution_y = self.geometry[sampling]
+        return self.compute_unc(band_name, dn.astype(np.float32).ravel(), flags.ravel(),
+                                lambda: self.sza_grid.tile(origin_x, origin_y, resolution_x, resolution_y, x, y, width,
+                                                           height), out)
+
+    def process_overview_tile(self, band_name, x, y, width, height, factor, out=None):
+        """
+        Computes a rectangle of an overview of a band, whose pixels are factor x factor blocks of the band. The
+        uncertainty of a block is computed from its mean DN at the SZA of its centre, and a block with flagged pixels
+        takes the flag code of highest priority (see s2_rut_algo.block_flags).
+        :param band_name: S2 band name (e.g. 'B2')
+        :param x: first column of the rectangle in the overview
+        :param y: first row of the rectangle in the overview
+        :param width: number of columns of the rectangle in the overview
+        :param height: number of rows of the rectangle in the overview
+        :param factor: size of the blocks
+        :param out: uint8 array (height, width) receiving the result. Allocated if None
+        :return: uint8 array (height, width)
+        """
+        sampling = S2_BAND_SAMPLING[band_name]
+        if out is None:
+            out = np.empty((height, width), np.uint8)
+        band_width, band_height = self.get_band_size(band_name)
+        dn, flags = self.read_dn_flags(band_name, x * factor, y * factor, min(width * factor, band_width - x * factor),
+                                       min(height * factor, band_height - y * factor))
+        origin_x, origin_y, resolution_x, resolution_y = self.geometry[sampling]
+        return self.compute_unc(band_name, s2_rut_algo.block_mean(dn, factor).ravel(),
+                                s2_rut_algo.block_flags(flags, factor).ravel(),
+                                lambda: self.sza_grid.tile(origin_x, origin_y, resolution_x * factor,
+                                                           resolution_y * factor, x, y, width, height), out)
+
+    def read_dn_flags(self, band_name, x, y, width, height):
+        """
+        Reads the DN and the flag codes of a rectangle of a band.
+        :return: 2-D DN array and 2-D uint8 flag codes (height, width)
+        """
+        sampling = S2_BAND_SAMPLING[band_name]
+        dn = np.asarray(self.reader.read_band(band_name, x, y, width, height))
+        masks = [(dn == SATURATED_DN, s2_rut_algo.FLAG_SATURATED), (dn == NODATA_DN, s2_rut_algo.FLAG_NODATA)]
+        for tag, code in S2_BAND_MASKS:
+            masks.append((self.reader.read_mask(tag + band_name, x, y, width, height), code))
+        for tag, code in S2_CLOUD_MASKS:
+            masks.append((self.reader.read_mask(tag % sampling, x, y, width, height), code))
+        masks = sorted([(code, mask) for mask, code in masks if mask is not None], key=lambda item: item[0])
+        flags = s2_rut_algo.flag_codes(np.stack([np.asarray(mask).ravel() for code, mask in masks]),
+                                       [code for code, mask in masks])
+        return dn, flags.reshape(height, width)
+
+    def compute_unc(self, band_name, band_data, flags, get_tecta, out):
+        """
+        Computes the uncertainty of the unflagged pixels and writes it with the flag codes.
+        :param band_name: S2 band name
+        :param band_data: flat float32 DN, modified
+        :param flags: flat flag codes, modified
+        :param get_tecta: function returning the flat SZA, only called if a pixel is not flagged
+        :param out: 2-D uint8 array receiving the result
+        :return: out
+        """
+        band_id = S2_BAND_NAMES.index(band_name)
+        valid = s2_rut_algo.unflagged_pixels(flags)
+        if valid is not None and valid.size == 0:  # fully flagged tile: no SZA nor uncertainty
+            out[...] = flags.reshape(out.shape)
+            return out
+
+        tecta = get_tecta()
+        if valid is not None:
+            band_data = band_data[valid]
+            tecta = tecta[valid]
+        band_data += self.radio_offsets[band_id]
+        band_data /= self.rut_algo.quant
+        unc = s2_rut_algo.unc_kernel(self.rut_algo.kernel_params(self.band_coeffs[band_id]), band_data,
+                                     np.cos(np.radians(tecta)))
+        if valid is None:
+            np.maximum(unc, flags, out=unc)
+        else:
+            unc_valid = unc
+            unc = flags
+            unc[valid] = unc_valid
+        out[...] = unc.reshape(out.shape)
+        return out
+
+    def run(self, band_names, output_dir, tile_size=TILE_SIZE, overview_level=0):
+        """
+        Computes complete bands and writes them as '<band>_rut.npy' files, or '<band>_rut_L<level>.npy' for overviews.
+        :param band_names: S2 band names
+        :param output_dir: directory of the output files
+        :param tile_size: size of the square tiles processed at once
+        :param overview_level: 0 for the full resolution, otherwise the level of the overview: its pixels are blocks
+        of 2^level x 2^level pixels of the bands (see process_overview_tile)
+        :return: dictionary with the output path of each band
+        """
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        factor = 2 ** overview_level
+        paths = {}
+        for band_name in band_names:
+            width, height = self.get_band_size(band_name)
+            width = -(-width // factor)
+            height = -(-height // factor)
+            path = os.path.join(output_dir, band_name + ('_rut_L%d.npy' % overview_level if overview_level else
+                                                         '_rut.npy'))
+            target = np.lib.format.open_memmap(path + '.part', mode='w+', dtype=np.uint8, shape=(height, width))
+            for y in range(0, height, tile_size):
+                for x in range(0, width, tile_size):
+                    tile_width = min(tile_size, width - x)
+                    tile_height = min(tile_size, height - y)
+                    tile_out = target[y:y + tile_height, x:x + tile_width]
+                    if overview_level:
+                        self.process_overview_tile(band_name, x, y, tile_width, tile_height, factor, out=tile_out)
+                    else:
+                        self.process_tile(band_name, x, y, tile_width, tile_height, out=tile_out)
+            target.flush()
+            del target
+            os.rename(path + '.part', path)  # complete outputs only
+            paths[band_name] = path
+        return paths
+
+
+def get_safe_dir(product_path):
+    if os.path.isdir(product_path):
+        return product_path
+    return os.path.dirname(product_path)
+
+
+def local_name(element):
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def find_all(root, name):
+    """
+    Elements with a given tag anywhere below root, ignoring the XML namespaces of the S2 metadata.
+    """
+    return [element for element in root.iter() if local_name(element) == name]
+
+
+def find_text(root, name):
+    elements = find_all(root, name)
+    if not elements:
+        raise RuntimeError('Element "' + name + '" not found in the product metadata')
+    return elements[0].text.strip()
+
+
+def by_band_id(elements):
+    """
+    Indexes band elements by their bandId (or band_id) attribute, or by order if there is none.
+    """
+    indexed = {}
+    for index, element in enumerate(elements):
+        band_id = element.get('bandId', element.get('band_id'))
+        indexed[int(band_id) if band_id is not None else index] = element
+    return indexed
+
+
+def get_sza_grid(granule_root, ulx, uly):
+    """
+    Reads the sun zenith angle grid of the granule metadata. Its first node is at the upper left corner of the tile.
+    """
+    sun_angles = find_all(granule_root, 'Sun_Angles_Grid')[0]
+    zenith = [element for element in sun_angles if local_name(element) == 'Zenith'][0]
+    values = np.array([[float(value) for value in row.text.split()] for row in find_all(zenith, 'VALUES')])
+    return s2_rut_sza.S2SzaGrid(values, ulx, uly, float(find_text(zenith, 'COL_STEP')),
+                                -float(find_text(zenith, 'ROW_STEP')))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Sentinel-2 Radiometric Uncertainty Tool without SNAP')
+    parser.add_argument('product', help='SAFE directory of the S2 L1C product')
+    parser.add_argument('output_dir', help='directory of the <band>_rut.npy outputs')
+    parser.add_argument('--bands', default=','.join(S2_BAND_NAMES), help='comma separated band names')
+    parser.add_argument('--coverage_factor', type=float, default=1.0, help='coverage factor k')
+    parser.add_argument('--rasters', default=None,
+                        help='directory with <band>.npy and <mask>.npy rasters. If not given, the JPEG2000 images '
+                             'of the product are read with rasterio')
+    parser.add_argument('--overview_level', type=int, default=0,
+                        help='computes an overview of 2^level x 2^level pixel blocks instead of the full resolution')
+    options = parser.parse_args(args)
+    reader = S2NumpyReader.from_directory(options.rasters) if options.rasters else S2Jp2Reader(options.product)
+    engine = S2RutEngine(options.product, reader, k=options.coverage_factor)
+    engine.run(options.bands.split(','), options.output_dir, overview_level=options.overview_level)
+
+
+if __name__ == '__main__':
+    main()
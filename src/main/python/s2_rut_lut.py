@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Lookup-table evaluation of the S2-RUT uncertainty.
+
+The L1C reflectance is quantized (DN = reflectance * quant) and the uncertainty is stored as uint8, so for a given
+band and product the result of S2RutAlgo.unc_calculation only depends on the DN and on the SZA of the pixel.
+S2RutLut tabulates it once over the DN range and a grid of SZA bins and evaluates a tile with a single gather.
+"""
+
+import copy
+import math
+
+import numpy as np
+
+# Reflectance covered by the table. Pixels above it (or below 0) are computed with the analytic kernel.
+LUT_MAX_REFLECTANCE = 2.0
+
+
+class S2RutLut:
+    """
+    Uncertainty table of one band of one product, indexed by (SZA bin, DN).
+    """
+
+    def __init__(self, rut_algo, band_id, spacecraft, sza_min=0.0, sza_max=90.0, sza_step=0.5):
+        """
+        Builds the table from the analytic path. The band coefficients must already be set in rut_algo.
+        :param rut_algo: S2RutAlgo configured for the band (coefficients, quant, k and unc_select)
+        :param band_id: zero-based index of the band
+        :param spacecraft: "Sentinel-2A" or "Sentinel-2B"
+        :param sza_min: centre of the first SZA bin [deg]
+        :param sza_max: upper limit of the SZA grid [deg]. The last bin centre is the first one >= sza_max
+        :param sza_step: width of the SZA bins [deg]
+        """
+        if sza_step <= 0:
+            raise ValueError('The SZA step of the lookup table must be positive')
+        self.rut_algo = copy.deepcopy(rut_algo)  # frozen copy, also used for the pixels out of the table
+        self.band_id = band_id
+        self.spacecraft = spacecraft
+        self.sza_min = float(sza_min)
+        self.sza_step = float(sza_step)
+        self.num_sza = int(math.ceil((sza_max - sza_min) / sza_step - 1e-9)) + 1
+        self.dn_max = int(round(LUT_MAX_REFLECTANCE * self.rut_algo.quant))
+
+        reflectance = np.arange(self.dn_max + 1, dtype=np.float64) / self.rut_algo.quant
+        self.table = np.empty((self.num_sza, self.dn_max + 1), np.uint8)
+        self.max_error = 0
+        edge_low = self.evaluate(reflectance, self.sza_min - 0.5 * self.sza_step)
+        for i in range(self.num_sza):
+            sza = self.sza_min + i * self.sza_step
+            self.table[i] = self.evaluate(reflectance, sza)
+            # the uncertainty is monotonic in SZA, so the largest deviation within a bin is found at its edges
+            edge_high = self.evaluate(reflectance, sza + 0.5 * self.sza_step)
+            self.max_error = max(self.max_error,
+                                 int(np.abs(self.table[i].astype(np.int16) - edge_low).max()),
+                                 int(np.abs(self.table[i].astype(np.int16) - edge_high).max()))
+            edge_low = edge_high
+        self.flat_table = self.table.ravel()
+
+    def evaluate(self, band_data, sza):
+        """
+        Analytic uncertainty of the band for a constant SZA.
+        :param band_data: reflectance values
+        :param sza: sun zenith angle [deg]
+        :return: uint8 uncertainty
+        """
+        rut_algo = copy.copy(self.rut_algo)
+        rut_algo.tecta = min(max(sza, 0.0), 90.0)
+        with np.errstate(divide='ignore', invalid='ignore'):  # DN 0 gives the maximum uncertainty
+            return rut_algo.unc_calculation(band_data, self.band_id, self.spacecraft)
+
+    def error_bound(self):
+        """
+        Maximum difference between the table and the analytic path for any DN inside the table and any SZA inside
+        the grid, in uint8 counts (0.1 %).
+        """
+        return self.max_error
+
+    def lookup(self, band_data, tecta, out=None):
+        """
+        Uncertainty of the pixels of a tile.
+        :param band_data: quantized L1C reflectance pixels of the band
+        :param tecta: SZA of the pixels [deg], same shape as band_data. The pixels outside the SZA bins, like the ones
+        outside the DN range, are computed with the analytic kernel
+        :param out: uint8 array receiving the result. Allocated if None
+        :return: array of u_int8 with uncertainty associated to each pixel.
+        """
+        band_data = np.asarray(band_data)
+        tecta = np.asarray(tecta)
+        if out is None:
+            out = np.empty(band_data.shape, np.uint8)
+
+        dn = np.multiply(band_data, self.rut_algo.quant, dtype=np.float32)
+        np.rint(dn, out=dn)
+        outside = ~((dn >= 0) & (dn <= self.dn_max))  # also true for NaN
+        np.copyto(dn, 0, where=outside)
+        index = dn.astype(np.intp)
+
+        sza_bin = np.subtract(tecta, self.sza_min, dtype=np.float32)
+        sza_bin /= self.sza_step
+        # the SZA grid of the tile pixels is extrapolated beyond the range of the table, where error_bound does not hold
+        outside |= (sza_bin < -0.5) | (sza_bin > self.num_sza - 0.5)
+        np.rint(sza_bin, out=sza_bin)
+        np.clip(sza_bin, 0, self.num_sza - 1, out=sza_bin)
+        np.copyto(sza_bin, 0, where=np.isnan(sza_bin))
+        index += sza_bin.astype(np.intp) * (self.dn_max + 1)
+
+        np.take(self.flat_table, index, out=out)
+        if outside.any():
+            rut_algo = copy.copy(self.rut_algo)
+            rut_algo.tecta = tecta[outside]
+            out[outside] = rut_algo.unc_calculation_f32(band_data[outside], self.band_id, self.spacecraft)
+        return out
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Pixel region of a subset of a S2 L1C product (e.g. a validation site), shared by the 10, 20 and 60 m bands.
+
+The region is expressed in pixels of the 10 m bands and aligned to the 60 m grid, so that the subset of every band
+covers exactly the same ground extent and the 20 and 60 m regions are whole pixels.
+"""
+
+import math
+import re
+
+# number of 10 m pixels in a 60 m pixel
+REGION_BLOCK = 6
+
+NUMBER = r'[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?'
+
+
+def parse_region(text):
+    """
+    :param text: 'x,y,width,height' in pixels of the 10 m bands
+    :return: (x, y, width, height)
+    """
+    try:
+        x, y, width, height = [int(value) for value in text.split(',')]
+    except ValueError:
+        raise RuntimeError('Region "' + text + '" is not valid. The expected format is x,y,width,height')
+    if width <= 0 or height <= 0:
+        raise RuntimeError('Region "' + text + '" is empty')
+    return x, y, width, height
+
+
+def parse_wkt_coordinates(wkt):
+    """
+    :param wkt: WKT geometry (e.g. POLYGON or POINT) in geographic coordinates, as the geoRegion of SNAP
+    :return: list of (lat, lon) of the vertices
+    """
+    coordinates = [(float(lat), float(lon)) for lon, lat in re.findall('(' + NUMBER + r')\s+(' + NUMBER + ')', wkt)]
+    if not coordinates:
+        raise RuntimeError('Geographic region "' + wkt + '" is not a valid WKT geometry')
+    return coordinates
+
+
+def bounding_region(pixel_positions):
+    """
+    :param pixel_positions: list of (x, y) fractional pixel positions in the 10 m bands
+    :return: (x, y, width, height) of the pixels containing all the positions
+    """
+    xs = [x for x, y in pixel_positions]
+    ys = [y for x, y in pixel_positions]
+    if any(math.isnan(value) for value in xs + ys):
+        raise RuntimeError('The geographic region is not within the product geocoding')
+    x0 = int(math.floor(min(xs)))
+    y0 = int(math.floor(min(ys)))
+    return x0, y0, max(int(math.floor(max(xs))) + 1 - x0, 1), max(int(math.floor(max(ys))) + 1 - y0, 1)
+
+
+def align_region(region, width, height):
+    """
+    Extends a region to the 60 m grid and clips it to the raster of the 10 m bands.
+    :param region: (x, y, width, height) in pixels of the 10 m bands
+    :param width: width of the 10 m bands
+    :param height: height of the 10 m bands
+    :return: aligned (x, y, width, height)
+    """
+    x, y, region_width, region_height = region
+    x0 = max(x // REGION_BLOCK * REGION_BLOCK, 0)
+    y0 = max(y // REGION_BLOCK * REGION_BLOCK, 0)
+    x1 = min(-(-(x + region_width) // REGION_BLOCK) * REGION_BLOCK, width)
+    y1 = min(-(-(y + region_height) // REGION_BLOCK) * REGION_BLOCK, height)
+    if x1 <= x0 or y1 <= y0:
+        raise RuntimeError('Region %d,%d,%d,%d does not intersect the product' % region)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def band_region(region, sampling):
+    """
+    :param region: aligned region (see align_region) in pixels of the 10 m bands
+    :param sampling: spatial sampling of the band in meters (10, 20 or 60)
+    :return: (x, y, width, height) of the region in pixels of the band
+    """
+    factor = sampling // 10
+    return tuple(value // factor for value in region)
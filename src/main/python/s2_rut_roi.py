@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""
+Monte-Carlo (MCM) uncertainty of the mean of a square Region Of Interest (ROI) of a S2 band, as a function of the
+ROI size (Gorrono et al., European Journal of Remote Sensing 2017).
+
+All the iterations of a chunk are drawn as one batch of arrays. The contributors are drawn according to their
+correlation:
+    - uncorrelated ('pixel'): one draw per pixel. The normal ones are merged into a single normal draw with the
+      combined standard deviation, which has the same distribution as their sum.
+    - row correlated ('row'): one draw per image row, shared by the pixels of the row.
+    - fully correlated ('image'): one draw per iteration, scaling an uncertainty value or image.
+The means of all the nested windows are obtained at once from summed-area tables of the weighted errors.
+
+The contributors are combined linearly, so the variance of the ROI mean also has a closed form (S2RoiMcm.analytic),
+evaluated for all the ROI sizes at once from summed-area tables of the weights and squared weights. The MCM remains
+as a cross-check of it.
+
+The adaptive mode (adaptive_mcm) does not keep the samples: it streams them into running moments and stops once the
+estimate of every ROI size is stable within a tolerance, following the adaptive procedure of GUM Supplement 1 (7.9).
+
+Several bands run in parallel with run_bands. Every band draws from its own random stream, derived from a master seed
+and the band index, so the results do not depend on the number of workers nor on the order or selection of bands.
+
+The uncertainty of the mean of a single ROI is also propagated analytically from the contributor images, with the
+same correlations (roi_mean_uncertainty). S2RutOp uses it to write the ROI table of the sites without writing the
+uncertainty images.
+"""
+
+import concurrent.futures
+import csv
+import math
+from collections import namedtuple
+
+import numpy as np
+
+# memory used by the per-pixel arrays of an iteration chunk [bytes]
+DEFAULT_CHUNK_BYTES = 256 * 1024 * 1024
+
+# Result of the adaptive mode. mean, std and estimate (mean + std) have one value per ROI size, quantiles one row
+# per requested probability (None if not requested)
+S2RoiMcmResult = namedtuple('S2RoiMcmResult', ['mean', 'std', 'estimate', 'iterations', 'converged', 'quantiles'])
+
+# Correlation between the pixels of a ROI of the random straylight and of the gamma knowledge, 'pixel' or 'row'.
+# Used by both the MCM (S2RoiMcm) and the ROI table of S2RutOp (ROI_CONTRIBUTOR_KINDS)
+U_STRAY_RAND_KIND = 'pixel'
+UGAMMA_KIND = 'pixel'
+
+# Correlation of the errors of each contributor (S2_CONTRIBUTOR_TAGS) between the pixels of a ROI, as in the MCM:
+# 'systematic' is a bias, the others are the 'pixel', 'row' and 'image' correlations of S2RoiMcm. The crosstalk is
+# not in the MCM and is taken as fully correlated.
+ROI_CONTRIBUTOR_KINDS = {'unoise': 'pixel', 'u_stray_sys': 'systematic', 'u_stray_rand': U_STRAY_RAND_KIND,
+                         'xtalk': 'image', 'ADC': 'pixel', 'ds': 'image', 'ugamma': UGAMMA_KIND, 'udiffabs': 'image',
+                         'udifftemp': 'systematic', 'udiffcosine': 'image', 'udiffk': 'image', 'uL1Cquant': 'pixel'}
+
+# Uncertainty of the mean of a ROI [%]: systematic part and standard uncertainty of each correlation (k = 1)
+S2RoiMeanUnc = namedtuple('S2RoiMeanUnc', ['systematic', 'pixel', 'row', 'image'])
+
+# Columns of the ROI table written by S2RutOp
+ROI_TABLE_COLUMNS = ['site', 'lat', 'lon', 'band', 'size_m', 'pixels', 'flagged', 'systematic', 'u_pixel', 'u_row',
+                     'u_image', 'u_combined', 'u_expanded']
+
+
+class S2RoiMcm:
+    """
+    MCM engine of one band. Uncertainty images and values are in % (k = 1), the images as stored in the RUT
+    contributor products (multiplied by 10).
+    """
+
+    def __init__(self, s2roi, unoise, u_stray_sys, uADC, uds, uL1Cquant, udifftemp, u_stray_rand, udiffabs,
+                 udiffcosine, udiffk, ugamma, u_stray_rand_kind=U_STRAY_RAND_KIND, ugamma_kind=UGAMMA_KIND):
+        """
+        :param s2roi: square array with the TOA reflectance of the ROI
+        :param unoise: instrument noise uncertainty image (x10)
+        :param u_stray_sys: systematic straylight uncertainty image (x10)
+        :param uADC: ADC quantisation uncertainty image (x10)
+        :param uds: dark signal stability uncertainty image (x10)
+        :param uL1Cquant: L1C quantisation uncertainty image (x10)
+        :param udifftemp: diffuser temporal knowledge uncertainty
+        :param u_stray_rand: random straylight uncertainty
+        :param udiffabs: diffuser absolute knowledge uncertainty
+        :param udiffcosine: diffuser cosine effect uncertainty
+        :param udiffk: diffuser straylight residual uncertainty
+        :param ugamma: gamma knowledge uncertainty
+        :param u_stray_rand_kind: correlation of the random straylight, 'pixel' or 'row'
+        :param ugamma_kind: correlation of the gamma knowledge, 'pixel' or 'row'
+        """
+        self.s2roi = np.asarray(s2roi, dtype=np.float64)
+        if self.s2roi.ndim != 2 or self.s2roi.shape[0] != self.s2roi.shape[1]:
+            raise RuntimeError('The ROI width and height must be the same')
+        size = self.s2roi.shape[0]
+        hf = size // 2
+        # nested windows [hf - d, hf + d) for d = 0 .. hf. The first one is empty (NaN), as in the original method
+        self.starts = hf - np.arange(hf + 1)
+        self.ends = hf + np.arange(hf + 1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.roi_sums = window_sums(summed_area_table(self.s2roi), self.starts, self.ends)
+            # systematic part, identical for all the iterations
+            self.sys = self.weighted_means(np.asarray(u_stray_sys, np.float64) / 10) + udifftemp
+            # uniform dark signal draw scaling the whole image
+            self.uds_means = self.weighted_means(np.asarray(uds, np.float64) * math.sqrt(3) / 10)
+
+        self.normal_var = (np.asarray(unoise, np.float64) / 10) ** 2 + np.zeros_like(self.s2roi)
+        self.row_std = []
+        for value, kind in [(u_stray_rand + 1e-9, u_stray_rand_kind), (ugamma, ugamma_kind)]:  # 1e-9 avoids 0 std
+            if kind == 'pixel':
+                self.normal_var += value ** 2
+            elif kind == 'row':
+                self.row_std.append(value)
+            else:
+                raise ValueError('Unknown correlation "' + kind + '"')
+        self.normal_std = np.sqrt(self.normal_var)
+        self.uniform_width = [np.asarray(uADC, np.float64) * math.sqrt(3) / 10 + np.zeros_like(self.s2roi),
+                              np.asarray(uL1Cquant, np.float64) * math.sqrt(3) / 10 + np.zeros_like(self.s2roi)]
+        self.image_std = [udiffabs, udiffcosine, udiffk]
+
+    def weighted_means(self, values):
+        """
+        :return: reflectance weighted mean of values in each window
+        """
+        return window_sums(summed_area_table(values * self.s2roi), self.starts, self.ends) / self.roi_sums
+
+    def samples(self, iterations, rng=None, chunk_bytes=DEFAULT_CHUNK_BYTES):
+        """
+        Draws the ROI uncertainty samples.
+        :param iterations: number of MCM iterations
+        :param rng: numpy Generator or RandomState. The global numpy random state if None
+        :param chunk_bytes: memory of the per-pixel arrays of an iteration chunk [bytes]
+        :return: array with the samples of the iterations as rows and the ROI sizes as columns
+        """
+        rng = np.random if rng is None else rng
+        chunk = max(1, int(chunk_bytes // (3 * 8 * self.s2roi.size)))
+        result = np.empty((iterations, self.starts.size))
+        for start in range(0, iterations, chunk):
+            stop = min(start + chunk, iterations)
+            result[start:stop] = self.draw(rng, stop - start)
+        return result
+
+    def draw(self, rng, iterations):
+        """
+        :return: samples of a chunk of iterations (iterations x ROI sizes)
+        """
+        shape = (iterations,) + self.s2roi.shape
+        errors = rng.normal(0, 1, shape)
+        errors *= self.normal_std
+        for width in self.uniform_width:
+            errors += rng.uniform(-1, 1, shape) * width
+        for std in self.row_std:
+            errors += rng.normal(0, std, shape[:2])[:, :, np.newaxis]
+        errors *= self.s2roi
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            samples = window_sums(summed_area_table(errors), self.starts, self.ends) / self.roi_sums
+        # fully correlated contributors: same relative error in all pixels, so their weighted mean is the draw itself
+        for std in self.image_std:
+            samples += rng.normal(0, 1, (iterations, 1)) * std
+        samples += rng.uniform(-1, 1, (iterations, 1)) * self.uds_means
+        samples += self.sys
+        return samples
+
+    def analytic(self):
+        """
+        Closed-form uncertainty of the ROI mean for every ROI size, with the same contributors and correlations as
+        the MCM. With the reflectance weights w of a window, the variance of the weighted mean is the sum of
+            - uncorrelated: sum(w^2 u^2) / sum(w)^2, the uniform draws having a variance of width^2 / 3
+            - row correlated: u^2 sum over the rows of (sum(w))^2 / sum(w)^2
+            - fully correlated: u^2, and the weighted mean of the dark signal image squared
+        :return: S2RoiMcmResult, the mean being the systematic part. It has no iterations nor quantiles
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):  # the empty ROI size is NaN
+            pixel_var = self.normal_var + sum(width ** 2 for width in self.uniform_width) / 3
+            var = window_sums(summed_area_table(self.s2roi ** 2 * pixel_var), self.starts, self.ends)
+            if self.row_std:
+                var += sum(std ** 2 for std in self.row_std) * row_window_sums(self.s2roi, self.starts, self.ends)
+            var /= self.roi_sums ** 2
+            var += sum(std ** 2 for std in self.image_std) + self.uds_means ** 2 / 3
+            std = np.sqrt(var)
+        mean = self.sys + np.zeros(self.starts.size)
+        return S2RoiMcmResult(mean=mean, std=std, estimate=mean + std, iterations=0, converged=True, quantiles=None)
+
+
+def summed_area_table(data):
+    """
+    Summed-area table over the last two axes, with a leading row and column of zeros.
+    :param data: array (..., rows, columns)
+    :return: array (..., rows + 1, columns + 1) where [..., i, j] is the sum of data[..., :i, :j]
+    """
+    table = np.zeros(data.shape[:-2] + (data.shape[-2] + 1, data.shape[-1] + 1))
+    np.cumsum(data, axis=-2, out=table[..., 1:, 1:])
+    np.cumsum(table[..., 1:, 1:], axis=-1, out=table[..., 1:, 1:])
+    return table
+
+
+def window_sums(table, starts, ends):
+    """
+    Sums of the square windows [start, end) x [start, end) from a summed-area table.
+    :param table: summed-area table (see summed_area_table)
+    :param starts: first row and column of each window
+    :param ends: end (exclusive) row and column of each window
+    :return: array (..., windows)
+    """
+    return (table[..., ends, ends] - table[..., starts, ends] - table[..., ends, starts] +
+            table[..., starts, starts])
+
+
+def roi_mean_uncertainty(weights, contributors):
+    """
+    Propagates the uncertainty of the pixels to the weighted mean of a ROI, as the MCM does (the weights are the
+    reflectances of the pixels):
+        - 'systematic': sum(w u) / sum(w)
+        - 'pixel': sqrt(sum(w^2 u^2)) / sum(w)
+        - 'row': sqrt(sum over rows of (sum(w u))^2) / sum(w)
+        - 'image': sum(w u) / sum(w)
+    The contributors of the same correlation are independent and combined in quadrature.
+    :param weights: array (rows, columns) with the weight of each pixel. Pixels with a zero weight are not used
+    :param contributors: list of (kind, uncertainty image or value [%]) with the kinds of ROI_CONTRIBUTOR_KINDS
+    :return: S2RoiMeanUnc
+    """
+    weights = np.asarray(weights, np.float64)
+    used = weights != 0
+    total = weights.sum()
+    if total == 0:
+        return S2RoiMeanUnc(np.nan, np.nan, np.nan, np.nan)
+    systematic = 0.0
+    variances = {'pixel': 0.0, 'row': 0.0, 'image': 0.0}
+    for kind, values in contributors:
+        weighted = np.where(used, weights * values, 0.0)  # values of unused pixels may be NaN
+        if kind == 'systematic':
+            systematic += weighted.sum() / total
+        elif kind == 'pixel':
+            variances[kind] += (weighted ** 2).sum() / total ** 2
+        elif kind == 'row':
+            variances[kind] += (weighted.sum(axis=1) ** 2).sum() / total ** 2
+        elif kind == 'image':
+            variances[kind] += (weighted.sum() / total) ** 2
+        else:
+            raise ValueError('Unknown correlation "' + kind + '"')
+    return S2RoiMeanUnc(systematic, math.sqrt(variances['pixel']), math.sqrt(variances['row']),
+                        math.sqrt(variances['image']))
+
+
+def write_roi_table(path, rows):
+    """
+    Writes the ROI table as CSV.
+    :param path: path of the CSV file
+    :param rows: list of dictionaries with the ROI_TABLE_COLUMNS
+    """
+    with open(path, 'w') as f:
+        writer = csv.DictWriter(f, ROI_TABLE_COLUMNS, lineterminator='\n')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict((key, '%.4f' % value if isinstance(value, float) else value)
+                                 for key, value in row.items()))
+
+
+def row_window_sums(data, starts, ends):
+    """
+    Sums over the rows of the square windows [start, end) x [start, end) of the squared sums of the row segments.
+    :param data: array (rows, columns)
+    :param starts: first row and column of each window
+    :param ends: end (exclusive) row and column of each window
+    :return: array (windows)
+    """
+    cumulative = np.zeros((data.shape[0], data.shape[1] + 1))
+    np.cumsum(data, axis=1, out=cumulative[:, 1:])
+    segments = cumulative[:, ends] - cumulative[:, starts]  # (rows, windows)
+    table = np.zeros((data.shape[0] + 1, starts.size))
+    np.cumsum(segments ** 2, axis=0, out=table[1:])
+    windows = np.arange(starts.size)
+    return table[ends, windows] - table[starts, windows]
+
+
+class S2RoiStats:
+    """
+    Streaming statistics of the ROI samples: running mean and variance (Welford, merged by chunks) and an optional
+    fixed-size uniform reservoir of samples per ROI size to estimate quantiles.
+    """
+
+    def __init__(self, sizes, reservoir_size=0, rng=None):
+        """
+        :param sizes: number of ROI sizes
+        :param reservoir_size: number of samples kept for the quantiles (0 for no quantiles)
+        :param rng: numpy Generator or RandomState used to select the reservoir samples
+        """
+        self.count = 0
+        self.mean = np.zeros(sizes)
+        self.m2 = np.zeros(sizes)
+        self.reservoir = np.empty((reservoir_size, sizes))
+        self.rng = np.random if rng is None else rng
+
+    def add(self, samples):
+        """
+        :param samples: array with the samples of some iterations as rows and the ROI sizes as columns
+        """
+        count = samples.shape[0]
+        mean = samples.mean(axis=0)
+        delta = mean - self.mean
+        total = self.count + count
+        self.m2 += ((samples - mean) ** 2).sum(axis=0) + delta ** 2 * self.count * count / total
+        self.mean += delta * count / total
+        self.add_reservoir(samples)
+        self.count = total
+
+    def add_reservoir(self, samples):
+        size = self.reservoir.shape[0]
+        if size == 0:
+            return
+        fill = max(0, min(size - self.count, samples.shape[0]))
+        self.reservoir[self.count:self.count + fill] = samples[:fill]
+        # algorithm R: the sample number i replaces a random reservoir row with probability size / (i + 1)
+        seen = np.arange(self.count + fill, self.count + samples.shape[0]) + 1
+        index = (self.rng.uniform(0, 1, seen.size) * seen).astype(np.intp)
+        replaced = index < size
+        self.reservoir[index[replaced]] = samples[fill:][replaced]
+
+    def std(self, ddof=0):
+        return np.sqrt(self.m2 / (self.count - ddof))  # population standard deviation by default, as np.std
+
+    def quantiles(self, probabilities):
+        return np.percentile(self.reservoir[:min(self.count, self.reservoir.shape[0])],
+                             100 * np.asarray(probabilities), axis=0)
+
+
+def adaptive_mcm(mcm, tolerance, rng=None, batch=100, min_batches=10, max_iterations=100000, quantiles=None,
+                 reservoir_size=10000):
+    """
+    Runs the MCM by batches until the estimate (mean + std) of every ROI size is stable.
+    After h batches the standard deviation of the batch means and of the batch standard deviations, divided by
+    sqrt(h), estimate the numerical uncertainty of the result. The run stops when twice these values are within the
+    tolerance for all ROI sizes (GUM Supplement 1, 7.9.4).
+    :param mcm: S2RoiMcm of the band
+    :param tolerance: numerical tolerance of the ROI uncertainty [%]
+    :param rng: numpy Generator or RandomState. The global numpy random state if None
+    :param batch: iterations per batch
+    :param min_batches: batches drawn before testing the convergence
+    :param max_iterations: maximum number of iterations
+    :param quantiles: probabilities of the quantiles to estimate (e.g. [0.025, 0.975]), None for no quantiles
+    :param reservoir_size: samples per ROI size kept for the quantiles
+    :return: S2RoiMcmResult
+    """
+    rng = np.random if rng is None else rng
+    stats = S2RoiStats(mcm.starts.size, reservoir_size if quantiles else 0, rng)
+    batch_means = S2RoiStats(mcm.starts.size)  # running statistics of the batch results
+    batch_stds = S2RoiStats(mcm.starts.size)
+    converged = False
+    with np.errstate(invalid='ignore'):  # the empty ROI size has NaN samples
+        while not converged and stats.count + batch <= max_iterations:
+            samples = mcm.samples(batch, rng)
+            stats.add(samples)
+            batch_means.add(samples.mean(axis=0)[np.newaxis])
+            batch_stds.add(samples.std(axis=0)[np.newaxis])
+            if batch_means.count >= min_batches:
+                spread = np.maximum(batch_means.std(ddof=1), batch_stds.std(ddof=1))
+                converged = bool(np.nanmax(2 * spread / math.sqrt(batch_means.count)) <= tolerance)
+        std = stats.std()
+    return S2RoiMcmResult(mean=stats.mean.copy(), std=std, estimate=stats.mean + std, iterations=stats.count,
+                          converged=converged, quantiles=stats.quantiles(quantiles) if quantiles else None)
+
+
+def band_rng(master_seed, band_id):
+    """
+    Independent random stream of a band.
+    :param master_seed: seed of the whole run
+    :param band_id: zero-based index of the band
+    :return: numpy Generator
+    """
+    return np.random.default_rng(np.random.SeedSequence(master_seed, spawn_key=(band_id,)))
+
+
+def run_band(job):
+    """
+    Runs the MCM of one band (worker function of run_bands).
+    :param job: tuple (band_id, S2RoiMcm, master_seed, iterations, tolerance)
+    :return: S2RoiMcmResult. The quantiles are not computed
+    """
+    band_id, mcm, master_seed, iterations, tolerance = job
+    rng = band_rng(master_seed, band_id)
+    if tolerance is not None:
+        return adaptive_mcm(mcm, tolerance, rng)
+    samples = mcm.samples(iterations, rng)
+    with np.errstate(invalid='ignore'):  # the empty ROI size has NaN samples
+        mean = samples.mean(axis=0)
+        std = samples.std(axis=0)
+    return S2RoiMcmResult(mean=mean, std=std, estimate=mean + std, iterations=iterations, converged=True,
+                          quantiles=None)
+
+
+def run_bands(mcms, master_seed, iterations=2000, tolerance=None, workers=None):
+    """
+    Runs the MCM of several bands on a process pool. The workers only return the statistics of each band.
+    :param mcms: dictionary with the S2RoiMcm of each band id
+    :param master_seed: seed of the whole run
+    :param iterations: number of iterations per band (fixed mode)
+    :param tolerance: numerical tolerance [%] of the adaptive mode. None for the fixed mode
+    :param workers: number of worker processes (None for the number of CPUs, 1 runs in the calling process)
+    :return: dictionary with the S2RoiMcmResult of each band id
+    """
+    band_ids = sorted(mcms)
+    jobs = [(band_id, mcms[band_id], master_seed, iterations, tolerance) for band_id in band_ids]
+    if workers == 1:
+        results = [run_band(job) for job in jobs]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(run_band, jobs))
+    return dict(zip(band_ids, results))
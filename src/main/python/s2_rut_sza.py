@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Sun zenith angle of the Sentinel-2 band rasters, interpolated from the coarse (5 km) angle grid of the product.
+"""
+
+import numpy as np
+
+
+class S2SzaGrid:
+    """
+    Coarse SZA grid with bilinear interpolation to any band raster of the same map geometry.
+    Outside the outermost grid nodes the values are linearly extrapolated, so the borders of the image never
+    get NaN values.
+    """
+
+    def __init__(self, values, x0, y0, step_x, step_y):
+        """
+        :param values: 2-D array with the SZA at the grid nodes [deg]. NaN nodes are filled with the nearest valid one
+        :param x0: map x coordinate of the node [0, 0]
+        :param y0: map y coordinate of the node [0, 0]
+        :param step_x: map distance between grid columns (signed)
+        :param step_y: map distance between grid rows (signed, usually negative)
+        """
+        self.values = fill_nan_nearest(np.asarray(values, dtype=np.float64))
+        self.x0 = float(x0)
+        self.y0 = float(y0)
+        self.step_x = float(step_x)
+        self.step_y = float(step_y)
+
+    def tile(self, origin_x, origin_y, resolution_x, resolution_y, x, y, width, height):
+        """
+        SZA of the pixel centres of a tile of a band raster.
+        :param origin_x: map x coordinate of the upper left corner of the band raster
+        :param origin_y: map y coordinate of the upper left corner of the band raster
+        :param resolution_x: pixel size of the band raster in x (signed)
+        :param resolution_y: pixel size of the band raster in y (signed, usually negative)
+        :param x: first column of the tile
+        :param y: first row of the tile
+        :param width: number of columns of the tile
+        :param height: number of rows of the tile
+        :return: flattened float32 array (row-major) with the SZA of the tile pixels [deg]
+        """
+        columns = (origin_x + (np.arange(x, x + width) + 0.5) * resolution_x - self.x0) / self.step_x
+        rows = (origin_y + (np.arange(y, y + height) + 0.5) * resolution_y - self.y0) / self.step_y
+        col_index, col_weight = interpolation_weights(columns, self.values.shape[1])
+        row_index, row_weight = interpolation_weights(rows, self.values.shape[0])
+
+        # separable bilinear interpolation: first along the columns of all grid rows, then along the tile rows
+        along = self.values[:, col_index] * (1 - col_weight) + self.values[:, col_index + 1] * col_weight
+        sza = along[row_index] * (1 - row_weight)[:, np.newaxis] + along[row_index + 1] * row_weight[:, np.newaxis]
+        return sza.astype(np.float32).ravel()
+
+
+def interpolation_weights(positions, size):
+    """
+    Lower node index and weight of the upper node for linear interpolation on a grid axis.
+    Weights outside [0, 1] extrapolate the first or last grid interval.
+    :param positions: fractional node positions
+    :param size: number of nodes of the axis
+    :return: index and weight arrays. With a single node, both nodes are the same one
+    """
+    if size == 1:
+        return np.zeros(positions.size, np.intp) - 1, np.ones(positions.size)
+    index = np.clip(np.floor(positions), 0, size - 2).astype(np.intp)
+    return index, positions - index
+
+
+def fill_nan_nearest(values):
+    """
+    Replaces the NaN cells of a small 2-D grid by the value of the nearest valid cell.
+    :param values: 2-D float array
+    :return: array without NaN values
+    """
+    invalid = np.isnan(values)
+    if not invalid.any():
+        return values
+    if invalid.all():
+        raise RuntimeError('The sun zenith angle grid does not contain any valid value')
+    valid_rows, valid_cols = np.nonzero(~invalid)
+    filled = values.copy()
+    for row, col in zip(*np.nonzero(invalid)):
+        nearest = np.argmin((valid_rows - row) ** 2 + (valid_cols - col) ** 2)
+        filled[row, col] = values[valid_rows[nearest], valid_cols[nearest]]
+    return filled
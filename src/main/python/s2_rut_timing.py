@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in per-stage timing of the RUT processing.
+
+The stages of a tile are measured as laps: each call to lap() charges the time elapsed since the previous mark to a
+stage. When the timing is disabled S2RutNullTimer is used instead, whose methods do nothing, so the instrumented code
+does not need any condition.
+"""
+
+import json
+import threading
+import time
+
+# environment variable enabling the timing whatever the operator parameter
+TIMING_ENV = 'S2RUT_TIMING'
+
+
+class S2RutTimer:
+    """
+    Accumulates wall time and call counts per key (band name or shared resolution inputs) and stage, plus the
+    number of pixels per key. It can be used by several tile threads at the same time.
+    """
+
+    def __init__(self):
+        self.stages = {}  # key -> stage -> [seconds, calls]
+        self.pixels = {}  # key -> number of pixels
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        :return: mark of the current time, to be passed to the first lap
+        """
+        return time.perf_counter()
+
+    def lap(self, key, stage, mark):
+        """
+        Charges the time elapsed since mark to a stage.
+        :param key: band name or name of the shared inputs
+        :param stage: name of the processing stage
+        :param mark: mark returned by start or by the previous lap
+        :return: new mark
+        """
+        now = time.perf_counter()
+        with self.lock:
+            stats = self.stages.setdefault(key, {}).setdefault(stage, [0.0, 0])
+            stats[0] += now - mark
+            stats[1] += 1
+        return now
+
+    def add_pixels(self, key, pixels):
+        with self.lock:
+            self.pixels[key] = self.pixels.get(key, 0) + pixels
+
+    def totals(self):
+        """
+        :return: dictionary key -> {'pixels': n, '<stage>_seconds': s, '<stage>_calls': n, 'total_seconds': s}
+        """
+        with self.lock:
+            totals = {}
+            for key in sorted(set(self.stages) | set(self.pixels)):
+                entry = {'pixels': self.pixels.get(key, 0), 'total_seconds': 0.0}
+                for stage, (seconds, calls) in sorted(self.stages.get(key, {}).items()):
+                    entry[stage + '_seconds'] = seconds
+                    entry[stage + '_calls'] = calls
+                    entry['total_seconds'] += seconds
+                totals[key] = entry
+            return totals
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.totals(), f, indent=2, sort_keys=True)
+
+
+class S2RutNullTimer:
+    """
+    Timer used when the timing is disabled.
+    """
+
+    def start(self):
+        return None
+
+    def lap(self, key, stage, mark):
+        return None
+
+    def add_pixels(self, key, pixels):
+        pass
+
+    def totals(self):
+        return {}
+
+
+def create_timer(enabled):
+    return S2RutTimer() if enabled else S2RutNullTimer()
+
+
+def write_dimap_statistics(dim_path, totals):
+    """
+    Fills the Processing_statistics element of a BEAM-DIMAP header. GPF writes the header before the tiles are
+    computed, so the element is empty until the processing ends.
+    :param dim_path: path of the .dim header
+    :param totals: dictionary returned by S2RutTimer.totals
+    """
+    import xml.etree.ElementTree as ET  # only needed at the end of a timed run
+
+    tree = ET.parse(dim_path)
+    for element in tree.getroot().iter('MDElem'):
+        if element.get('name') == 'Processing_statistics':
+            break
+    else:
+        raise RuntimeError('Element "Processing_statistics" not found in ' + dim_path)
+    for child in list(element):
+        element.remove(child)
+    for key, entry in sorted(totals.items()):
+        keyelem = ET.SubElement(element, 'MDElem', name=key)
+        for stat in sorted(entry):
+            statattr = ET.SubElement(keyelem, 'MDATTR', name=stat.upper(), type='ascii', mode='rw')
+            statattr.text = str(entry[stat])
+    tree.write(dim_path, encoding='ISO-8859-1', xml_declaration=True)
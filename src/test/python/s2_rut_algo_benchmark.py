@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark of the S2-RUT uncertainty kernels on synthetic tiles.
+
+Usage (from the repository root):
+    PYTHONPATH=src/main/python python src/test/python/s2_rut_algo_benchmark.py --save baseline.json
+    PYTHONPATH=src/main/python python src/test/python/s2_rut_algo_benchmark.py --compare baseline.json
+
+Every case reports the throughput in Mpixel/s (best of --repeat runs) and the peak memory allocated by the kernel.
+With --compare the run fails (exit code 1) when a case is slower, or uses more memory, than the baseline by more
+than --threshold. The baseline is machine dependent: create it on the machine that runs the comparison.
+"""
+
+import argparse
+import json
+import math
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import s2_rut_algo as s2_rut_algo
+import s2_rut_backends as s2_rut_backends
+import s2_rut_lut as s2_rut_lut
+
+SPACECRAFTS = ['Sentinel-2A', 'Sentinel-2B']
+DEFAULT_SIZES = [512, 2048, 10980]
+DEFAULT_METHODS = ['f32', 'lut']
+QUANT = 10000.0
+
+# Typical metadata values of a L1C product (physical gain, solar irradiance, alpha and beta of the noise model)
+BAND_METADATA = [(3.97, 1884.69, 0.57, 0.044), (3.81, 1959.66, 0.61, 0.041), (4.18, 1823.24, 0.62, 0.040),
+                 (4.55, 1512.06, 0.67, 0.043), (4.66, 1424.64, 0.74, 0.046), (5.16, 1287.61, 0.80, 0.048),
+                 (5.01, 1162.08, 0.82, 0.048), (6.22, 1041.63, 0.57, 0.044), (5.21, 955.32, 0.87, 0.050),
+                 (8.86, 812.92, 1.10, 0.055), (53.70, 367.15, 2.60, 0.070), (25.80, 245.59, 1.90, 0.062),
+                 (72.30, 85.25, 2.40, 0.066)]
+
+# Uncertainty contributors selections (order of S2RutAlgo.unc_select)
+SELECTIONS = {
+    'all': [True] * 12,
+    'noise_only': [True] + [False] * 11,
+    'no_quant': [True] * 11 + [False],
+    'systematic': [False, True, False, False, False, False, False, True, True, True, True, False],
+}
+
+
+def synthetic_tile(size, seed=0):
+    """
+    Synthetic L1C tile with a realistic mix of surfaces and a smooth SZA field.
+    :param size: number of rows and columns
+    :param seed: seed of the random generator
+    :return: flattened float32 reflectance (quantized by QUANT) and SZA [deg] arrays
+    """
+    rng = np.random.RandomState(seed)
+    pixels = size * size
+    dn = np.empty(pixels, np.float32)
+    # generated by blocks of 1M pixels to bound the temporaries of the largest tiles
+    for start in range(0, pixels, 1 << 20):
+        block = dn[start:start + (1 << 20)]
+        # 30 % dark water, 50 % land, 15 % bright clouds/snow, 5 % no data (DN 0)
+        surface = rng.choice(4, block.size, p=[0.30, 0.50, 0.15, 0.05])
+        for index, (mean, sigma) in enumerate([(300.0, 0.5), (2000.0, 0.4), (8000.0, 0.2)]):
+            selected = surface == index
+            block[selected] = rng.lognormal(math.log(mean), sigma, int(selected.sum()))
+        block[surface == 3] = 0
+    np.clip(np.rint(dn, out=dn), 0, 65534, out=dn)
+    band_data = np.divide(dn, QUANT, out=dn)
+
+    # SZA growing by 1 deg along the rows and 0.5 deg along the columns of a 10980 pixels tile
+    steps = np.arange(size, dtype=np.float32) / np.float32(10980)
+    tecta = (np.float32(35.0) + steps[:, np.newaxis] + np.float32(0.5) * steps[np.newaxis, :]).ravel()
+    return band_data, tecta
+
+
+def create_algo(band_id, spacecraft, selection):
+    rut_algo = s2_rut_algo.S2RutAlgo()
+    a, e_sun, alpha, beta = BAND_METADATA[band_id]
+    rut_algo.set_band_coeffs(s2_rut_algo.get_band_coeffs(band_id, spacecraft, a, e_sun, alpha, beta, 2.0))
+    rut_algo.u_sun = 1.0
+    rut_algo.quant = QUANT
+    rut_algo.unc_select = list(SELECTIONS[selection])
+    return rut_algo
+
+
+def get_cases(sizes, methods):
+    """
+    All bands, spacecrafts and selections are measured on the smallest tile; the larger tiles measure the scaling
+    of one representative case per method.
+    :return: list of (method, size, band_id, spacecraft, selection)
+    """
+    cases = []
+    for method in methods:
+        for band_id in range(len(s2_rut_algo.S2_BAND_NAMES)):
+            for spacecraft in SPACECRAFTS:
+                for selection in sorted(SELECTIONS):
+                    cases.append((method, sizes[0], band_id, spacecraft, selection))
+        for size in sizes[1:]:
+            cases.append((method, size, 1, SPACECRAFTS[0], 'all'))
+    return cases
+
+
+def case_name(case):
+    method, size, band_id, spacecraft, selection = case
+    return '%s/%d/%s/%s/%s' % (method, size, s2_rut_algo.S2_BAND_NAMES[band_id], spacecraft, selection)
+
+
+def prepare(case, band_data, tecta):
+    """
+    :return: function computing the uncertainty of the tile with the method of the case
+    """
+    method, size, band_id, spacecraft, selection = case
+    rut_algo = create_algo(band_id, spacecraft, selection)
+    if method == 'reference':
+        rut_algo.tecta = tecta.astype(np.float64)
+        band_data64 = band_data.astype(np.float64)
+
+        def run():
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return rut_algo.unc_calculation(band_data64, band_id, spacecraft)
+        return run
+    if method == 'f32':
+        out = np.empty(band_data.size, np.uint8)
+        scratch = s2_rut_algo.new_scratch(band_data.size)
+        cos_tecta = np.empty(band_data.size, np.float32)
+
+        def run():
+            np.radians(tecta, out=cos_tecta)
+            np.cos(cos_tecta, out=cos_tecta)
+            return rut_algo.unc_calculation_f32(band_data, band_id, spacecraft, cos_tecta=cos_tecta, out=out,
+                                                scratch=scratch)
+        return run
+    if method in ('numexpr', 'numba'):
+        kernel = s2_rut_backends.load_backend(method)
+        if kernel is None:
+            raise RuntimeError('Backend "' + method + '" is not available')
+        params = rut_algo.kernel_params(rut_algo.get_band_coeffs(band_id, spacecraft))
+        out = np.empty(band_data.size, np.uint8)
+        scratch = s2_rut_algo.new_scratch(band_data.size)
+        cos_tecta = np.empty(band_data.size, np.float32)
+
+        def run():
+            np.radians(tecta, out=cos_tecta)
+            np.cos(cos_tecta, out=cos_tecta)
+            return kernel(params, band_data, cos_tecta, out=out, scratch=scratch)
+        return run
+    if method == 'lut':
+        lut = s2_rut_lut.S2RutLut(rut_algo, band_id, spacecraft, float(tecta.min()), float(tecta.max()), 0.05)
+        out = np.empty(band_data.size, np.uint8)
+        return lambda: lut.lookup(band_data, tecta, out)
+    raise ValueError('Unknown method "' + method + '"')
+
+
+def measure(run, pixels, repeat):
+    """
+    :return: dictionary with the best throughput [Mpixel/s] and the peak memory allocated by one run [MB]
+    """
+    run()  # warm up
+    seconds = min(timed(run) for _ in range(repeat))
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': seconds, 'mpixel_s': pixels / seconds / 1e6, 'peak_mb': peak / 1e6}
+
+
+def timed(run):
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+def run_benchmark(sizes, methods, repeat, log=sys.stdout):
+    results = {}
+    tiles = {}
+    for case in get_cases(sizes, methods):
+        size = case[1]
+        if size not in tiles:
+            tiles.clear()  # a single tile in memory at a time (the largest is 10980 x 10980)
+            tiles[size] = synthetic_tile(size)
+        band_data, tecta = tiles[size]
+        name = case_name(case)
+        results[name] = measure(prepare(case, band_data, tecta), band_data.size, repeat)
+        if log:
+            log.write('%-50s %9.1f Mpixel/s %9.1f MB\n' % (name, results[name]['mpixel_s'], results[name]['peak_mb']))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: list of messages describing the regressions of the results with respect to the baseline
+    """
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        result, reference = results[name], baseline[name]
+        if result['mpixel_s'] < reference['mpixel_s'] * (1 - threshold):
+            regressions.append('%s: %.1f Mpixel/s, baseline %.1f' % (name, result['mpixel_s'], reference['mpixel_s']))
+        # small allocations are dominated by noise
+        if result['peak_mb'] > reference['peak_mb'] * (1 + threshold) + 1:
+            regressions.append('%s: %.1f MB, baseline %.1f' % (name, result['peak_mb'], reference['peak_mb']))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the S2-RUT uncertainty kernels')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='tile sizes (rows = columns)')
+    parser.add_argument('--methods', nargs='+', default=DEFAULT_METHODS,
+                        choices=['reference', 'f32', 'lut', 'numexpr', 'numba'])
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per case (the best one is kept)')
+    parser.add_argument('--save', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', help='JSON baseline to compare the results with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='tolerated relative regression')
+    options = parser.parse_args(args)
+
+    results = run_benchmark(sorted(options.sizes), options.methods, options.repeat)
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            regressions = compare(results, json.load(f), options.threshold)
+        for regression in regressions:
+            sys.stdout.write('REGRESSION ' + regression + '\n')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,23 @@
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 import s2_rut_algo as s2_rut_algo
 import numpy as np
 
 
+# S2RutAlgo with the coefficients of S2RutAlgoTest
+def create_algo():
+    rut_algo = s2_rut_algo.S2RutAlgo()
+    rut_algo.a = 6.22865527455779
+    rut_algo.e_sun = 1036.39
+    rut_algo.u_sun = 1.03418574554466
+    rut_algo.tecta = 63.5552301619033
+    rut_algo.quant = 10000.0
+    rut_algo.alpha = 0.571
+    rut_algo.beta = 0.04447
+    rut_algo.u_ADC = 0.5
+    return rut_algo
+
+
 class S2RutAlgoTest(unittest.TestCase):
     def test_simple_case_B8(self):
         rut_algo = s2_rut_algo.S2RutAlgo()
@@ -53,3 +68,109 @@ class S2RutAlgoTest(unittest.TestCase):
         self.assertEqual([250, 97, 61, 42, 31, 26, 25], list(rut_result))
 
 
+class S2RutAlgoF32Test(unittest.TestCase):
+    def test_same_as_reference(self):
+        band_data = np.array([100, 500, 1000, 2000, 5000, 10000, 15000.]) / 10000
+        for spacecraft in ['Sentinel-2A', 'Sentinel-2B']:
+            for band_id in [0, 1, 7]:
+                expected = create_algo().unc_calculation(band_data, band_id, spacecraft)
+                rut_result = create_algo().unc_calculation_f32(band_data.astype(np.float32), band_id, spacecraft)
+                self.assertEqual(list(expected), list(rut_result))
+
+    def test_same_as_reference_deselected(self):
+        band_data = np.array([100, 500, 1000, 2000, 5000, 10000, 15000.]) / 10000
+        for index in range(12):
+            rut_algo = create_algo()
+            rut_algo.unc_select[index] = False
+            rut_result = rut_algo.unc_calculation_f32(band_data.astype(np.float32), 3, 'Sentinel-2A')
+            expected = rut_algo.unc_calculation(band_data, 3, 'Sentinel-2A')
+            self.assertEqual(list(expected), list(rut_result))
+
+    def test_sza_array_and_scratch(self):
+        band_data = np.linspace(0.001, 1.5, 10000).astype(np.float32)
+        rut_algo = create_algo()
+        rut_algo.tecta = np.linspace(20., 75., band_data.size).astype(np.float32)
+        scratch = s2_rut_algo.new_scratch(20000)
+        out = np.empty(band_data.size, np.uint8)
+        rut_result = rut_algo.unc_calculation_f32(band_data, 8, 'Sentinel-2B', out=out, scratch=scratch)
+        expected = rut_algo.unc_calculation(band_data.astype(np.float64), 8, 'Sentinel-2B')
+        self.assertIs(out, rut_result)
+        self.assertLessEqual(np.abs(expected.astype(int) - rut_result).max(), 1)
+        self.assertGreater(np.mean(expected == rut_result), 0.999)
+
+    def test_contribution(self):
+        band_data = np.array([100, 500, 1000, 2000, 5000, 10000, 15000.]) / 10000
+        for index in range(12):
+            rut_algo = create_algo()
+            rut_algo.k = 2.0
+            rut_algo.unc_select = [i == index for i in range(12)]
+            expected = rut_algo.unc_calculation(band_data, 3, 'Sentinel-2B')
+            rut_algo = create_algo()
+            rut_algo.k = 2.0
+            rut_result = rut_algo.contribution_f32(band_data.astype(np.float32), 3, 'Sentinel-2B', index)
+            self.assertEqual(list(expected), list(rut_result))
+
+    def test_components(self):
+        band_data = np.linspace(0.001, 1.5, 1000)
+        cos_tecta = np.cos(np.radians(np.linspace(20., 75., band_data.size)))
+        rut_algo = create_algo()
+        rut_algo.k = 2.0
+        params = rut_algo.kernel_params(rut_algo.get_band_coeffs(3, 'Sentinel-2A'))
+        systematic, u_1sigma = s2_rut_algo.unc_components(params, band_data, cos_tecta)
+        expected = s2_rut_algo.unc_kernel(params, band_data.astype(np.float32), cos_tecta.astype(np.float32))
+        rut_result = np.clip(np.round(10 * (systematic + 2.0 * u_1sigma)), 0, 250)
+        self.assertLessEqual(np.abs(expected - rut_result).max(), 1)
+
+    def test_stateless(self):
+        band_data = np.array([100, 500, 1000, 2000, 5000, 10000, 15000.]) / 10000
+        rut_algo = create_algo()
+        rut_algo.unc_select = [False] * 12
+        rut_algo.unc_calculation(band_data, 3, 'Sentinel-2A')
+        self.assertEqual((0.5, 0.4, 0.4, 0.3, 1.0), (rut_algo.u_ADC, rut_algo.u_gamma, rut_algo.u_diff_cos,
+                                                     rut_algo.u_diff_k, rut_algo.u_diff_temp))
+
+    def test_concurrent_tiles(self):
+        rut_algo = create_algo()
+        coeffs = rut_algo.get_band_coeffs(7, 'Sentinel-2A')
+        params = [rut_algo.kernel_params(coeffs), rut_algo.kernel_params(coeffs, s2_rut_algo.contributor_select(0))]
+        rng = np.random.RandomState(1)
+        tiles = [(params[i % 2], rng.uniform(0.001, 1.2, 50000).astype(np.float32),
+                  np.cos(np.radians(rng.uniform(20, 70, 50000))).astype(np.float32)) for i in range(8)]
+        expected = [s2_rut_algo.unc_kernel(*tile) for tile in tiles]
+        with ThreadPoolExecutor(4) as executor:
+            rut_result = list(executor.map(lambda tile: s2_rut_algo.unc_kernel(*tile), tiles))
+        for expected_tile, rut_tile in zip(expected, rut_result):
+            self.assertTrue(np.array_equal(expected_tile, rut_tile))
+
+
+class S2RutFlagCodesTest(unittest.TestCase):
+    def test_priority(self):
+        # rows: degraded, saturated, nodata, cirrus, cloud (0/255 as returned by the SNAP masks)
+        masks = np.array([[255, 255, 0, 0, 255, 0],
+                          [0, 255, 0, 0, 0, 0],
+                          [0, 0, 255, 0, 255, 0],
+                          [0, 0, 0, 255, 255, 0],
+                          [0, 0, 0, 0, 255, 0]], np.int32)
+        codes = [s2_rut_algo.FLAG_INVALID, s2_rut_algo.FLAG_SATURATED, s2_rut_algo.FLAG_NODATA,
+                 s2_rut_algo.FLAG_CIRRUS, s2_rut_algo.FLAG_CLOUD]
+        out = np.full(6, 7, np.uint8)
+        flags = s2_rut_algo.flag_codes(masks, codes, out=out)
+        self.assertIs(out, flags)
+        self.assertEqual([251, 252, 253, 254, 255, 0], list(flags))
+
+    def test_unflagged_pixels(self):
+        self.assertIsNone(s2_rut_algo.unflagged_pixels(np.array([0, 0, 0, 0, 0, 255], np.uint8)))
+        self.assertEqual([1, 3], list(s2_rut_algo.unflagged_pixels(np.array([253, 0, 255, 0], np.uint8))))
+        self.assertEqual(0, s2_rut_algo.unflagged_pixels(np.full(4, 251, np.uint8)).size)
+
+    def test_block_aggregation(self):
+        data = np.arange(35, dtype=np.uint16).reshape(5, 7)
+        self.assertEqual([[4., 6., 8., 9.5], [18., 20., 22., 23.5], [28.5, 30.5, 32.5, 34.]],
+                         s2_rut_algo.block_mean(data, 2).tolist())
+        flags = np.zeros((5, 7), np.uint8)
+        flags[0, 0] = s2_rut_algo.FLAG_NODATA
+        flags[1, 1] = s2_rut_algo.FLAG_CLOUD
+        flags[4, 6] = s2_rut_algo.FLAG_INVALID
+        self.assertEqual([[255, 0], [0, 251]], s2_rut_algo.block_flags(flags, 4).tolist())
+        rut = np.array([[20, 22, 253], [30, 31, 40]], np.uint8)
+        self.assertEqual([[26, 253]], s2_rut_algo.overview_reference(rut, 2).tolist())
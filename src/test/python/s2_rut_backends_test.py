@@ -0,0 +1,71 @@
+import os
+import unittest
+import warnings
+
+import numpy as np
+
+import s2_rut_algo as s2_rut_algo
+import s2_rut_backends as s2_rut_backends
+
+
+def missing_backend():
+    raise ImportError('not installed')
+
+
+def wrong_backend():
+    def kernel(params, band_data, cos_tecta, out=None, scratch=None):
+        return np.full(np.shape(band_data), 10, np.uint8)
+    return kernel
+
+
+class S2RutBackendsTest(unittest.TestCase):
+    def setUp(self):
+        self.environ = os.environ.pop(s2_rut_backends.BACKEND_ENV, None)
+
+    def tearDown(self):
+        for name in ['missing', 'wrong']:
+            s2_rut_backends.loaders.pop(name, None)
+            s2_rut_backends.kernels.pop(name, None)
+        os.environ.pop(s2_rut_backends.BACKEND_ENV, None)
+        if self.environ is not None:
+            os.environ[s2_rut_backends.BACKEND_ENV] = self.environ
+
+    def test_equivalent(self):
+        rut_algo = s2_rut_algo.S2RutAlgo()
+        rut_algo.a = 6.22865527455779
+        rut_algo.e_sun = 1036.39
+        rut_algo.alpha = 0.571
+        rut_algo.beta = 0.04447
+        params = rut_algo.kernel_params(rut_algo.get_band_coeffs(7, 'Sentinel-2B'))
+        band_data = np.linspace(0.001, 1.5, 20000).astype(np.float32).reshape(100, 200)
+        cos_tecta = np.cos(np.radians(np.linspace(20., 75., band_data.size))).astype(np.float32).reshape(100, 200)
+        expected = s2_rut_algo.unc_kernel(params, band_data, cos_tecta)
+        self.assertIn('numpy', s2_rut_backends.available_backends())
+        for name in s2_rut_backends.available_backends():
+            out = np.empty((100, 400), np.uint8)[:, ::2]  # not contiguous
+            rut_result = s2_rut_backends.load_backend(name)(params, band_data, cos_tecta, out=out)
+            self.assertIs(out, rut_result)
+            self.assertLessEqual(np.abs(expected.astype(int) - rut_result).max(), 1, name)
+            self.assertGreater(np.mean(expected == rut_result), 0.999, name)
+
+    def test_selection_and_fallback(self):
+        self.assertEqual('numpy', s2_rut_backends.get_backend('numpy')[0])
+        self.assertRaises(RuntimeError, s2_rut_backends.get_backend, 'fortran')
+
+        s2_rut_backends.register_backend('missing', missing_backend)
+        s2_rut_backends.register_backend('wrong', wrong_backend)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertIsNone(s2_rut_backends.load_backend('wrong'))  # fails the verification
+            name, kernel = s2_rut_backends.get_backend('missing')
+        self.assertEqual(2, len(caught))
+        self.assertIn(name, s2_rut_backends.BACKEND_PREFERENCE)
+        self.assertIsNotNone(kernel)
+
+        os.environ[s2_rut_backends.BACKEND_ENV] = 'numpy'
+        self.assertEqual(('numpy', s2_rut_algo.unc_kernel), s2_rut_backends.get_backend('auto'))
+        self.assertEqual('numpy', s2_rut_backends.get_backend(None)[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
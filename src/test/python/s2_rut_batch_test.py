@@ -0,0 +1,134 @@
+import json
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import s2_rut_batch as s2_rut_batch
+
+# fake gpt: writes the target product, or fails for products whose name contains FAIL
+FAKE_GPT = '''#!/bin/sh
+case "$2" in *FAIL*) echo "cannot read $2"; exit 1;; esac
+echo "$_JAVA_OPTIONS" > "$4"
+'''
+
+
+def text_job(product, output_dir, options):
+    target = os.path.join(output_dir, s2_rut_batch.product_name(product) + '.txt')
+    with open(target, 'w') as f:
+        f.write(str(options['coverage_factor']))
+    return [target]
+
+
+class S2RutBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.tmp, 'out')
+        self.products = []
+        for name in ['S2A_MSIL1C_A.SAFE', 'S2B_MSIL1C_B.SAFE', 'S2A_MSIL1C_FAIL.SAFE']:
+            os.makedirs(os.path.join(self.tmp, name))
+            self.products.append(os.path.join(self.tmp, name))
+        self.gpt = os.path.join(self.tmp, 'gpt')
+        with open(self.gpt, 'w') as f:
+            f.write(FAKE_GPT)
+        os.chmod(self.gpt, stat.S_IRWXU)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_find_products(self):
+        listing = os.path.join(self.tmp, 'list.txt')
+        with open(listing, 'w') as f:
+            f.write('# products\n' + self.products[0] + '\n')
+        self.assertEqual(sorted(self.products), s2_rut_batch.find_products([self.tmp]))
+        self.assertEqual([self.products[0]], s2_rut_batch.find_products([listing, self.products[0]]))
+        self.assertRaises(RuntimeError, s2_rut_batch.find_products, [os.path.join(self.tmp, 'missing')])
+
+    def test_gpt_batch(self):
+        batch = s2_rut_batch.S2RutBatch(self.output_dir, workers=2, memory_mb=512, engine='gpt', gpt=self.gpt)
+        failed = batch.run(self.products, log=None)
+        self.assertEqual(['S2A_MSIL1C_FAIL'], failed)
+
+        with open(os.path.join(self.output_dir, s2_rut_batch.MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        self.assertEqual('done', manifest['S2A_MSIL1C_A']['status'])
+        self.assertEqual('failed', manifest['S2A_MSIL1C_FAIL']['status'])
+        self.assertIn('cannot read', manifest['S2A_MSIL1C_FAIL']['error'])
+        self.assertTrue(manifest['S2B_MSIL1C_B']['wall_time'] >= 0)
+        with open(manifest['S2A_MSIL1C_A']['outputs'][0]) as f:
+            self.assertEqual('-Xmx512m', f.read().strip())
+
+    def test_resume(self):
+        batch = s2_rut_batch.S2RutBatch(self.output_dir, workers=1, engine='gpt', gpt=self.gpt)
+        batch.run(self.products, log=None)
+        first = os.path.join(self.output_dir, 'S2A_MSIL1C_A_rut.dim')
+        os.remove(os.path.join(self.output_dir, 'S2B_MSIL1C_B_rut.dim'))
+        modified = os.path.getmtime(first) - 100
+        os.utime(first, (modified, modified))
+
+        # a new batch only runs the products whose outputs are missing, and the failed ones
+        batch = s2_rut_batch.S2RutBatch(self.output_dir, workers=1, engine='gpt', gpt=self.gpt)
+        self.assertEqual(['S2B_MSIL1C_B', 'S2A_MSIL1C_FAIL'],
+                         [s2_rut_batch.product_name(p) for p in self.products if not batch.is_done(p)])
+        batch.run(self.products, log=None)
+        self.assertEqual(modified, os.path.getmtime(first))
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'S2B_MSIL1C_B_rut.dim')))
+
+        # other bands or another coverage factor are other results
+        batch = s2_rut_batch.S2RutBatch(self.output_dir, workers=1, band_names=['B2'], engine='gpt', gpt=self.gpt)
+        self.assertFalse(batch.is_done(self.products[0]))
+        batch = s2_rut_batch.S2RutBatch(self.output_dir, workers=1, coverage_factor=2.0, engine='gpt', gpt=self.gpt)
+        self.assertFalse(batch.is_done(self.products[0]))
+
+    def test_result_cache(self):
+        cache_dir = os.path.join(self.tmp, 'cache')
+        batch = s2_rut_batch.S2RutBatch(self.output_dir, workers=1, memory_mb=512, engine='gpt', gpt=self.gpt,
+                                        cache_dir=cache_dir)
+        batch.run(self.products, log=None)
+        self.assertEqual(2, len(os.listdir(cache_dir)))
+
+        # the products are not reprocessed in another batch: a gpt that always fails is not called
+        with open(self.gpt, 'w') as f:
+            f.write('#!/bin/sh\nexit 1\n')
+        other_dir = os.path.join(self.tmp, 'other')
+        batch = s2_rut_batch.S2RutBatch(other_dir, workers=1, engine='gpt', gpt=self.gpt, cache_dir=cache_dir)
+        self.assertEqual(['S2A_MSIL1C_FAIL'], batch.run(self.products, log=None))
+        with open(os.path.join(other_dir, 'S2A_MSIL1C_A_rut.dim')) as f:
+            self.assertEqual('-Xmx512m', f.read().strip())
+
+        # a different coverage factor is a different result
+        batch = s2_rut_batch.S2RutBatch(other_dir, workers=1, coverage_factor=2.0, engine='gpt', gpt=self.gpt,
+                                        cache_dir=cache_dir, manifest_path=os.path.join(self.tmp, 'k2.json'))
+        self.assertEqual(3, len(batch.run(self.products, log=None)))
+
+    def test_product_engine(self):
+        old = os.path.join(self.tmp, 'S2A_MSIL1C_20171010T003621_N0206_R002_T55HFA_20171010T003615.SAFE')
+        new = os.path.join(self.tmp, 'S2B_MSIL1C_20220101T003621_N0400_R002_T55HFA_20220101T003615.SAFE')
+        self.assertEqual('02.06', s2_rut_batch.processing_baseline(old))
+        self.assertEqual('04.00', s2_rut_batch.processing_baseline(new))
+        with open(os.path.join(self.products[0], 'MTD_MSIL1C.xml'), 'w') as f:
+            f.write('<n1:Level-1C_User_Product xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/'
+                    'User_Product_Level-1C.xsd"><General_Info><Product_Info>'
+                    '<PROCESSING_BASELINE>04.00</PROCESSING_BASELINE></Product_Info></General_Info>'
+                    '</n1:Level-1C_User_Product>')
+        self.assertEqual('04.00', s2_rut_batch.processing_baseline(self.products[0]))
+        self.assertEqual(None, s2_rut_batch.processing_baseline(self.products[1]))
+
+        # the GML masks of the older baselines are only read by gpt
+        python = 'python' if s2_rut_batch.engine_available() else 'gpt'
+        self.assertEqual('gpt', s2_rut_batch.product_engine(old))
+        self.assertEqual(python, s2_rut_batch.product_engine(new))
+        self.assertEqual('gpt', s2_rut_batch.product_engine(self.products[1]))
+
+    def test_process_pool(self):
+        batch = s2_rut_batch.S2RutBatch(self.output_dir, workers=2, memory_mb=4096, coverage_factor=2.0,
+                                        engine='python')
+        batch.jobs['python'] = text_job
+        self.assertEqual([], batch.run(self.products, log=None))
+        with open(os.path.join(self.output_dir, 'S2A_MSIL1C_FAIL.txt')) as f:
+            self.assertEqual('2.0', f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import s2_l1_rad_conf as rad_conf
+import s2_rut_cache as s2_rut_cache
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+    return path
+
+
+class S2RutResultKeyTest(unittest.TestCase):
+    def test_inputs(self):
+        key = s2_rut_cache.result_key('S2A_MSIL1C_A', ['B1', 'B2'], None, 1.0, 'python')
+        self.assertEqual(key, s2_rut_cache.result_key('S2A_MSIL1C_A', ['B1', 'B2'], None, 1, 'python'))
+        self.assertEqual(key, s2_rut_cache.result_key('S2A_MSIL1C_A', ['B1', 'B2'], None, 1.0, 'python', '2.0'))
+        others = [s2_rut_cache.result_key('S2A_MSIL1C_B', ['B1', 'B2'], None, 1.0, 'python'),
+                  s2_rut_cache.result_key('S2A_MSIL1C_A', ['B1'], None, 1.0, 'python'),
+                  s2_rut_cache.result_key('S2A_MSIL1C_A', ['B1', 'B2'], [True] * 11 + [False], 1.0, 'python'),
+                  s2_rut_cache.result_key('S2A_MSIL1C_A', ['B1', 'B2'], None, 2.0, 'python'),
+                  s2_rut_cache.result_key('S2A_MSIL1C_A', ['B1', 'B2'], None, 1.0, 'gpt'),
+                  s2_rut_cache.result_key('S2A_MSIL1C_A', ['B1', 'B2'], None, 1.0, 'python', '2.1')]
+        self.assertEqual(len(others), len(set(others) - {key}))
+
+    def test_rad_conf(self):
+        key = s2_rut_cache.result_key('S2A_MSIL1C_A', ['B1'], None, 1.0, 'python')
+        original = rad_conf.u_diff_temp_rate['Sentinel-2A'][0]
+        rad_conf.u_diff_temp_rate['Sentinel-2A'][0] = original + 0.01
+        try:
+            self.assertNotEqual(key, s2_rut_cache.result_key('S2A_MSIL1C_A', ['B1'], None, 1.0, 'python'))
+        finally:
+            rad_conf.u_diff_temp_rate['Sentinel-2A'][0] = original
+        self.assertEqual(key, s2_rut_cache.result_key('S2A_MSIL1C_A', ['B1'], None, 1.0, 'python'))
+
+
+class S2RutResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = s2_rut_cache.S2RutResultCache(os.path.join(self.tmp, 'cache'), 2500)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_get_put(self):
+        product = write_file(os.path.join(self.tmp, 'A_rut.dim'), 10)
+        os.makedirs(os.path.join(self.tmp, 'A_rut.data'))
+        write_file(os.path.join(self.tmp, 'A_rut.data', 'B1_rut.img'), 100)
+        self.assertIsNone(self.cache.get('a', os.path.join(self.tmp, 'out')))
+        self.cache.put('a', [product, os.path.join(self.tmp, 'A_rut.data')])
+
+        paths = self.cache.get('a', os.path.join(self.tmp, 'out'))
+        self.assertEqual([os.path.join(self.tmp, 'out', name) for name in ['A_rut.data', 'A_rut.dim']], paths)
+        self.assertEqual(100, os.path.getsize(os.path.join(self.tmp, 'out', 'A_rut.data', 'B1_rut.img')))
+        self.assertEqual(paths, self.cache.get('a', os.path.join(self.tmp, 'out')))
+
+    def test_lru_eviction(self):
+        for key in ['a', 'b']:
+            self.cache.put(key, [write_file(os.path.join(self.tmp, key), 1000)])
+        os.utime(self.cache.entry_path('a'), (1000, 1000))
+        os.utime(self.cache.entry_path('b'), (2000, 2000))
+        self.assertIsNotNone(self.cache.get('a', os.path.join(self.tmp, 'out')))  # a is now the last used
+
+        self.cache.put('c', [write_file(os.path.join(self.tmp, 'c'), 1000)])
+        self.assertEqual(['a', 'c'], sorted(key for last_use, size, key in self.cache.entries()))
+        self.assertIsNone(self.cache.get('b', os.path.join(self.tmp, 'out')))
+
+    def test_band_reuse(self):
+        computed = []
+
+        def compute(band_names):
+            computed.append(band_names)
+            return dict((name, write_file(os.path.join(self.tmp, 'out', name + '_rut.npy'), 10))
+                        for name in band_names)
+
+        os.makedirs(os.path.join(self.tmp, 'out'))
+        keys = dict((name, s2_rut_cache.result_key('S2A_MSIL1C_A', [name], None, 1.0, 'python'))
+                    for name in ['B1', 'B2'])
+        s2_rut_cache.run_cached(self.cache, keys, os.path.join(self.tmp, 'out'), compute)
+        keys['B3'] = s2_rut_cache.result_key('S2A_MSIL1C_A', ['B3'], None, 1.0, 'python')
+        paths = s2_rut_cache.run_cached(self.cache, keys, os.path.join(self.tmp, 'other'), compute)
+        self.assertEqual([['B1', 'B2'], ['B3']], [sorted(names) for names in computed])
+        self.assertEqual(os.path.join(self.tmp, 'other', 'B2_rut.npy'), paths['B2'])
+        self.assertTrue(os.path.exists(paths['B2']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import s2_rut_dimap as s2_rut_dimap
+
+WKT = ('PROJCS["WGS 84 / UTM zone 33S", GEOGCS["WGS 84", DATUM["World Geodetic System 1984", '
+       'SPHEROID["WGS 84", 6378137.0, 298.257223563]], PRIMEM["Greenwich", 0.0], UNIT["degree", 0.017453292519943295]], '
+       'PROJECTION["Transverse_Mercator"], PARAMETER["central_meridian", 15.0], '
+       'PARAMETER["latitude_of_origin", 0.0], PARAMETER["scale_factor", 0.9996], '
+       'PARAMETER["false_easting", 500000.0], PARAMETER["false_northing", 10000000.0], UNIT["m", 1.0]]')
+
+DIM_XML = '''<?xml version="1.0" encoding="ISO-8859-1"?>
+<Dimap_Document name="test_rut.dim">
+    <Coordinate_Reference_System>
+        <WKT>%s</WKT>
+    </Coordinate_Reference_System>
+    <Geoposition>
+        <BAND_INDEX>0</BAND_INDEX>
+        <IMAGE_TO_MODEL_TRANSFORM>10.0,0.0,0.0,-10.0,511640.0,7390550.0</IMAGE_TO_MODEL_TRANSFORM>
+    </Geoposition>
+    <Data_Access>
+        <Data_File>
+            <DATA_FILE_PATH href="test_rut.data/B2_rut.hdr" />
+            <BAND_INDEX>0</BAND_INDEX>
+        </Data_File>
+        <Data_File>
+            <DATA_FILE_PATH href="test_rut.data/B5_rut.hdr" />
+            <BAND_INDEX>1</BAND_INDEX>
+        </Data_File>
+    </Data_Access>
+    <Image_Interpretation>
+        <Spectral_Band_Info>
+            <BAND_INDEX>0</BAND_INDEX>
+            <BAND_NAME>B2_rut</BAND_NAME>
+        </Spectral_Band_Info>
+        <Spectral_Band_Info>
+            <BAND_INDEX>1</BAND_INDEX>
+            <BAND_NAME>B5_rut</BAND_NAME>
+        </Spectral_Band_Info>
+    </Image_Interpretation>
+</Dimap_Document>
+''' % WKT
+
+ENVI_HDR = '''ENVI
+description = {Sentinel-2 RUT}
+samples = %d
+lines = %d
+bands = 1
+header offset = 0
+file type = ENVI Standard
+data type = %d
+interleave = bsq
+byte order = 1
+%s'''
+
+
+class S2DimapReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        data_dir = os.path.join(self.tmp, 'test_rut.data')
+        os.makedirs(data_dir)
+        self.dim_path = os.path.join(self.tmp, 'test_rut.dim')
+        with open(self.dim_path, 'w') as f:
+            f.write(DIM_XML)
+        self.b2 = np.arange(60 * 60, dtype=np.uint32).reshape(60, 60).astype(np.uint8)
+        self.b2.tofile(os.path.join(data_dir, 'B2_rut.img'))
+        with open(os.path.join(data_dir, 'B2_rut.hdr'), 'w') as f:
+            f.write(ENVI_HDR % (60, 60, 1, ''))
+        self.b5 = np.linspace(0, 1, 30 * 30).reshape(30, 30).astype('>f4')
+        self.b5.tofile(os.path.join(data_dir, 'B5_rut.img'))
+        with open(os.path.join(data_dir, 'B5_rut.hdr'), 'w') as f:
+            f.write(ENVI_HDR % (30, 30, 4, 'map info = {UTM, 1.0, 1.0, 511640.0, 7390550.0, 20.0, 20.0, 33, South, '
+                                           'WGS-84, units=Meters}\n'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_bands(self):
+        reader = s2_rut_dimap.S2DimapReader(self.dim_path)
+        self.assertEqual(['B2_rut', 'B5_rut'], reader.band_names())
+        self.assertTrue(np.array_equal(self.b2, reader.band('B2_rut')))
+        self.assertTrue(np.array_equal(self.b5, reader.band('B5_rut')))
+        window = reader.window('B5_rut', 3, 4, 5, 2)
+        self.assertTrue(np.shares_memory(window, reader.band('B5_rut')))
+        self.assertTrue(np.array_equal(self.b5[4:6, 3:8], window))
+        self.assertRaises(RuntimeError, reader.band, 'B3_rut')
+
+    def test_geocoding(self):
+        reader = s2_rut_dimap.S2DimapReader(self.dim_path)
+        # Gobabeb is at 512140.74 E, 7390052.83 N in UTM zone 33S
+        x, y = reader.pixel_position('B2_rut', -23.6, 15.119)
+        self.assertAlmostEqual(50.074, x, places=3)
+        self.assertAlmostEqual(49.717, y, places=3)
+        x, y = reader.pixel_position('B5_rut', -23.6, 15.119)  # transform from the ENVI map info
+        self.assertAlmostEqual(25.037, x, places=3)
+
+        roi = reader.roi('B2_rut', -23.6, 15.119, 200, 200)
+        self.assertTrue(np.array_equal(self.b2[40:60, 40:60], roi))
+        self.assertEqual((10, 10), reader.roi('B5_rut', -23.6, 15.119, 200, 200).shape)
+
+
+if __name__ == '__main__':
+    unittest.main()
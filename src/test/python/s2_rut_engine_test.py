@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+import unittest
+import s2_rut_algo as s2_rut_algo
+import s2_rut_engine as s2_rut_engine
+import numpy as np
+
+PRODUCT_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<n1:Level-1C_User_Product xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/User_Product_Level-1C.xsd">
+<n1:General_Info><Product_Image_Characteristics>
+<QUANTIFICATION_VALUE unit="none">10000</QUANTIFICATION_VALUE>
+<Reflectance_Conversion><U>1.03418574554466</U><Solar_Irradiance_List>%s</Solar_Irradiance_List></Reflectance_Conversion>
+</Product_Image_Characteristics></n1:General_Info>
+</n1:Level-1C_User_Product>'''
+
+DATASTRIP_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<n1:Level-1C_DataStrip_ID xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/S2_PDI_Level-1C_Datastrip_Metadata.xsd">
+<n1:General_Info><Datatake_Info><SPACECRAFT_NAME>Sentinel-2A</SPACECRAFT_NAME></Datatake_Info>
+<Datastrip_Time_Info><DATASTRIP_SENSING_START>2017-06-09T08:46:01.026Z</DATASTRIP_SENSING_START></Datastrip_Time_Info>
+</n1:General_Info>
+<n1:Image_Data_Info><Sensor_Configuration><Acquisition_Configuration><Spectral_Band_Info>%s</Spectral_Band_Info>
+</Acquisition_Configuration></Sensor_Configuration></n1:Image_Data_Info>
+<n1:Quality_Indicators_Info><Radiometric_Info><Radiometric_Quality_List>%s</Radiometric_Quality_List></Radiometric_Info>
+</n1:Quality_Indicators_Info>
+</n1:Level-1C_DataStrip_ID>'''
+
+GRANULE_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<n1:Level-1C_Tile_ID xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/S2_PDI_Level-1C_Tile_Metadata.xsd">
+<n1:Geometric_Info><Tile_Geocoding>
+<Size resolution="10"><NROWS>60</NROWS><NCOLS>90</NCOLS></Size>
+<Size resolution="20"><NROWS>30</NROWS><NCOLS>45</NCOLS></Size>
+<Size resolution="60"><NROWS>10</NROWS><NCOLS>15</NCOLS></Size>
+<Geoposition resolution="10"><ULX>300000</ULX><ULY>5000040</ULY><XDIM>10</XDIM><YDIM>-10</YDIM></Geoposition>
+<Geoposition resolution="20"><ULX>300000</ULX><ULY>5000040</ULY><XDIM>20</XDIM><YDIM>-20</YDIM></Geoposition>
+<Geoposition resolution="60"><ULX>300000</ULX><ULY>5000040</ULY><XDIM>60</XDIM><YDIM>-60</YDIM></Geoposition>
+</Tile_Geocoding>
+<Tile_Angles><Sun_Angles_Grid>
+<Zenith><COL_STEP unit="m">500</COL_STEP><ROW_STEP unit="m">500</ROW_STEP><Values_List>
+<VALUES>40.0 40.5 41.0</VALUES><VALUES>41.0 41.5 42.0</VALUES></Values_List></Zenith>
+<Azimuth><COL_STEP unit="m">500</COL_STEP><ROW_STEP unit="m">500</ROW_STEP><Values_List>
+<VALUES>140.0 140.0 140.0</VALUES><VALUES>140.0 140.0 140.0</VALUES></Values_List></Azimuth>
+</Sun_Angles_Grid></Tile_Angles>
+</n1:Geometric_Info>
+</n1:Level-1C_Tile_ID>'''
+
+
+def create_safe(directory):
+    e_sun = ''.join('<SOLAR_IRRADIANCE bandId="%d" unit="W/m2/um">%.2f</SOLAR_IRRADIANCE>' % (i, 1900 - 100 * i)
+                    for i in range(13))
+    gains = ''.join('<Spectral_Band_Information bandId="%d"><PHYSICAL_GAINS>%.3f</PHYSICAL_GAINS>'
+                    '</Spectral_Band_Information>' % (i, 3.5 + 0.2 * i) for i in range(13))
+    noise = ''.join('<Radiometric_Quality bandId="%d"><Noise_Model><ALPHA>%.3f</ALPHA><BETA>%.4f</BETA></Noise_Model>'
+                    '</Radiometric_Quality>' % (i, 0.5 + 0.01 * i, 0.04 + 0.001 * i) for i in range(13))
+    os.makedirs(os.path.join(directory, 'DATASTRIP', 'DS'))
+    os.makedirs(os.path.join(directory, 'GRANULE', 'L1C_T33KWP'))
+    with open(os.path.join(directory, 'MTD_MSIL1C.xml'), 'w') as f:
+        f.write(PRODUCT_XML % e_sun)
+    with open(os.path.join(directory, 'DATASTRIP', 'DS', 'MTD_DS.xml'), 'w') as f:
+        f.write(DATASTRIP_XML % (gains, noise))
+    with open(os.path.join(directory, 'GRANULE', 'L1C_T33KWP', 'MTD_TL.xml'), 'w') as f:
+        f.write(GRANULE_XML)
+
+
+class S2RutEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.safe = os.path.join(self.directory, 'S2A_MSIL1C_TEST.SAFE')
+        create_safe(self.safe)
+        rng = np.random.RandomState(3)
+        self.bands = {'B2': rng.randint(1, 12000, (60, 90)).astype(np.uint16),
+                      'B5': rng.randint(1, 12000, (30, 45)).astype(np.uint16)}
+        self.bands['B2'][0, :5] = 0
+        cloud = np.zeros((60, 90), np.uint8)
+        cloud[10:12, 20:30] = 255
+        self.reader = s2_rut_engine.S2NumpyReader(self.bands, {'opaque_clouds_10m': cloud})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_metadata(self):
+        engine = s2_rut_engine.S2RutEngine(self.safe, self.reader)
+        self.assertEqual('Sentinel-2A', engine.spacecraft)
+        self.assertEqual(10000.0, engine.rut_algo.quant)
+        self.assertAlmostEqual(3.7, engine.band_coeffs[1].a)
+        self.assertAlmostEqual(1800.0, engine.band_coeffs[1].e_sun)
+        self.assertAlmostEqual(0.042, engine.band_coeffs[2].beta)
+        self.assertEqual((45, 30), engine.get_band_size('B5'))
+        self.assertAlmostEqual(40.0, engine.sza_grid.values[0, 0])
+
+    def test_same_as_reference(self):
+        engine = s2_rut_engine.S2RutEngine(self.safe, self.reader)
+        rut_result = engine.process_tile('B5', 5, 3, 20, 10)
+
+        rut_algo = s2_rut_algo.S2RutAlgo()
+        rut_algo.u_sun = 1.03418574554466
+        rut_algo.set_band_coeffs(engine.band_coeffs[4])
+        rut_algo.tecta = engine.sza_grid.tile(300000, 5000040, 20, -20, 5, 3, 20, 10)
+        band_data = self.bands['B5'][3:13, 5:25].ravel() / 10000.
+        expected = rut_algo.unc_calculation(band_data, 4, 'Sentinel-2A')
+        self.assertLessEqual(np.abs(expected.astype(int) - rut_result.ravel()).max(), 1)
+
+    def test_flags_and_run(self):
+        engine = s2_rut_engine.S2RutEngine(self.safe, self.reader)
+        paths = engine.run(['B2'], os.path.join(self.directory, 'out'), tile_size=32)
+        rut_result = np.load(paths['B2'])
+        self.assertEqual((60, 90), rut_result.shape)
+        self.assertTrue((rut_result[0, :5] == s2_rut_algo.FLAG_NODATA).all())
+        self.assertTrue((rut_result[10:12, 20:30] == s2_rut_algo.FLAG_CLOUD).all())
+        self.assertTrue((rut_result[20:, :] <= 250).all())
+        np.testing.assert_array_equal(rut_result[32:60, 32:64], engine.process_tile('B2', 32, 32, 32, 28))
+
+    def test_overview(self):
+        rng = np.random.RandomState(5)
+        rows, cols = np.mgrid[0:60, 0:90]
+        self.bands['B2'][...] = 800 + 40 * cols + 30 * rows + rng.normal(0, 20, (60, 90))
+        self.bands['B2'][0, :5] = 0
+        engine = s2_rut_engine.S2RutEngine(self.safe, self.reader)
+        full = engine.process_tile('B2', 0, 0, 90, 60)
+        for level in [1, 3]:
+            path = engine.run(['B2'], os.path.join(self.directory, 'out'), tile_size=7, overview_level=level)['B2']
+            self.assertTrue(path.endswith('B2_rut_L%d.npy' % level))
+            overview = np.load(path)
+            expected = s2_rut_algo.overview_reference(full, 2 ** level)
+            self.assertEqual(expected.shape, overview.shape)
+            # same flags, uncertainty of the mean DN within 0.1% of the mean full resolution uncertainty
+            np.testing.assert_array_equal(expected[expected > 250], overview[expected > 250])
+            self.assertLessEqual(np.abs(expected.astype(int) - overview)[expected <= 250].max(), 1)
+        self.assertEqual(s2_rut_algo.FLAG_CLOUD, overview[1, 3])
+
+    def test_flagged_tiles(self):
+        engine = s2_rut_engine.S2RutEngine(self.safe, self.reader)
+        full = engine.process_tile('B2', 0, 20, 40, 20)
+        self.bands['B2'][20:40, 0:30] = 0  # mostly flagged tile: uncertainty of the unflagged pixels only
+        partial = engine.process_tile('B2', 0, 20, 40, 20)
+        self.assertTrue((partial[:, :30] == s2_rut_algo.FLAG_NODATA).all())
+        np.testing.assert_array_equal(full[:, 30:], partial[:, 30:])
+
+        self.bands['B2'][20:40, 0:40] = 0
+        engine.sza_grid = None  # a fully flagged tile does not need the SZA
+        self.assertTrue((engine.process_tile('B2', 0, 20, 40, 20) == s2_rut_algo.FLAG_NODATA).all())
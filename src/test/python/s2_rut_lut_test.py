@@ -0,0 +1,62 @@
+import unittest
+import s2_rut_algo as s2_rut_algo
+import s2_rut_lut as s2_rut_lut
+import numpy as np
+
+
+def create_algo():
+    rut_algo = s2_rut_algo.S2RutAlgo()
+    rut_algo.a = 6.22865527455779
+    rut_algo.e_sun = 1036.39
+    rut_algo.u_sun = 1.03418574554466
+    rut_algo.quant = 10000.0
+    rut_algo.alpha = 0.571
+    rut_algo.beta = 0.04447
+    rut_algo.u_diff_temp = 0.5
+    return rut_algo
+
+
+class S2RutLutTest(unittest.TestCase):
+    def test_bin_centres_are_exact(self):
+        lut = s2_rut_lut.S2RutLut(create_algo(), 2, 'Sentinel-2A', sza_min=30.0, sza_max=32.0, sza_step=0.5)
+        band_data = np.arange(1, 20001, 7, dtype=np.float32) / 10000
+        for sza in [30.0, 30.5, 31.0, 32.0]:
+            rut_algo = create_algo()
+            rut_algo.tecta = sza
+            expected = rut_algo.unc_calculation(band_data.astype(np.float64), 2, 'Sentinel-2A')
+            rut_result = lut.lookup(band_data, np.full(band_data.shape, sza, np.float32))
+            self.assertEqual(list(expected), list(rut_result))
+
+    def test_error_bound(self):
+        lut = s2_rut_lut.S2RutLut(create_algo(), 0, 'Sentinel-2B', sza_min=50.0, sza_max=60.0, sza_step=1.0)
+        rng = np.random.RandomState(5)
+        band_data = (rng.randint(1, 20000, 50000) / 10000.).astype(np.float32)
+        tecta = rng.uniform(49.5, 60.5, band_data.size).astype(np.float32)
+        rut_algo = create_algo()
+        rut_algo.tecta = tecta
+        expected = rut_algo.unc_calculation(band_data.astype(np.float64), 0, 'Sentinel-2B')
+        rut_result = lut.lookup(band_data, tecta)
+        self.assertGreater(lut.error_bound(), 0)
+        self.assertLessEqual(np.abs(expected.astype(int) - rut_result).max(), lut.error_bound())
+
+    def test_outside_table(self):
+        lut = s2_rut_lut.S2RutLut(create_algo(), 7, 'Sentinel-2A', sza_min=40.0, sza_max=40.0)
+        band_data = np.array([2.5, 3.0, -0.1, 0.5], np.float32)
+        tecta = np.full(band_data.shape, 40.0, np.float32)
+        rut_algo = create_algo()
+        rut_algo.tecta = tecta
+        expected = rut_algo.unc_calculation_f32(band_data, 7, 'Sentinel-2A')
+        self.assertEqual(list(expected), list(lut.lookup(band_data, tecta)))
+
+    def test_sza_outside_grid(self):
+        lut = s2_rut_lut.S2RutLut(create_algo(), 3, 'Sentinel-2B', sza_min=50.0, sza_max=52.0, sza_step=1.0)
+        band_data = np.full(6, 0.05, np.float32)
+        tecta = np.array([40.0, 49.4, 49.6, 52.4, 52.6, 70.0], np.float32)
+        rut_algo = create_algo()
+        rut_algo.tecta = tecta
+        expected = rut_algo.unc_calculation_f32(band_data, 3, 'Sentinel-2B')
+        rut_result = lut.lookup(band_data, tecta)
+        # beyond half a step out of the grid the analytic kernel is used, not the edge bins
+        self.assertEqual([expected[i] for i in [0, 1, 4, 5]], [rut_result[i] for i in [0, 1, 4, 5]])
+        self.assertEqual([lut.table[0, 500], lut.table[2, 500]], [rut_result[2], rut_result[3]])
+        self.assertNotEqual(lut.table[0, 500], rut_result[0])
@@ -0,0 +1,33 @@
+import unittest
+
+import s2_rut_region as s2_rut_region
+
+
+class S2RutRegionTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual((10, 20, 30, 40), s2_rut_region.parse_region('10,20,30,40'))
+        self.assertRaises(RuntimeError, s2_rut_region.parse_region, '10,20,30')
+        self.assertRaises(RuntimeError, s2_rut_region.parse_region, '10,20,0,40')
+        wkt = 'POLYGON ((15.11 -23.59, 15.13 -23.59, 15.13 -23.61, 15.11 -23.61, 15.11 -23.59))'
+        coordinates = s2_rut_region.parse_wkt_coordinates(wkt)
+        self.assertEqual(5, len(coordinates))
+        self.assertEqual((-23.61, 15.13), coordinates[2])
+        self.assertEqual([(4.5e-1, -2.0)], s2_rut_region.parse_wkt_coordinates('POINT(-2 4.5e-1)'))
+        self.assertRaises(RuntimeError, s2_rut_region.parse_wkt_coordinates, 'POLYGON EMPTY')
+
+    def test_bounding_region(self):
+        self.assertEqual((3, 7, 8, 2), s2_rut_region.bounding_region([(3.2, 7.9), (10.5, 8.1), (5.0, 7.0)]))
+        self.assertEqual((4, 5, 1, 1), s2_rut_region.bounding_region([(4.5, 5.5)]))
+        self.assertRaises(RuntimeError, s2_rut_region.bounding_region, [(float('nan'), float('nan'))])
+
+    def test_aligned_bands(self):
+        region = s2_rut_region.align_region((13, 5, 20, 10), 10980, 10980)
+        self.assertEqual((12, 0, 24, 18), region)
+        self.assertEqual((6, 0, 12, 9), s2_rut_region.band_region(region, 20))
+        self.assertEqual((2, 0, 4, 3), s2_rut_region.band_region(region, 60))
+        self.assertEqual((10974, 0, 6, 6), s2_rut_region.align_region((10975, -30, 100, 32), 10980, 10980))
+        self.assertRaises(RuntimeError, s2_rut_region.align_region, (11000, 0, 10, 10), 10980, 10980)
+
+
+if __name__ == '__main__':
+    unittest.main()
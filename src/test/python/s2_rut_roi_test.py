@@ -0,0 +1,204 @@
+import math
+import unittest
+
+import numpy as np
+
+import s2_rut_roi as s2_rut_roi
+
+
+def reference_samples(s2roi, images, values, iterations, rng):
+    # loop implementation of S2ROIuncprocessor.MCMalgo (s2roiunc_test.py) before vectorization
+    unoise_img, u_stray_sys_img, uADC_img, uds_img, uL1Cquant_img = images
+    udifftemp, u_stray_rand_val, udiffabs_val, udiffcosine_val, udiffk_val, ugamma_val = values
+    (numrow, numcol) = s2roi.shape
+    hf = int(numrow / 2)
+    roi_uncsamp = []
+    for j in range(0, iterations):
+        roi_uncsize = []
+        unoise = rng.normal(0, unoise_img, (numrow, numcol)) / 10
+        u_stray_rand = np.ones_like(s2roi) * u_stray_rand_val
+        for row in range(0, numrow):
+            u_stray_rand[row, :] = rng.normal(0, u_stray_rand[row, :] + 1e-9, numcol)
+        uADC = rng.uniform(-uADC_img * np.sqrt(3), uADC_img * np.sqrt(3), (numrow, numcol)) / 10
+        udiffabs = rng.normal(0, 1, 1)[0] * udiffabs_val
+        udiffcosine = rng.normal(0, 1, 1)[0] * udiffcosine_val
+        udiffk = rng.normal(0, 1, 1)[0] * udiffk_val
+        uds = rng.uniform(-1, 1, 1)[0] * uds_img * np.sqrt(3) / 10
+        ugamma = np.empty_like(s2roi)
+        for row in range(0, numrow):
+            ugamma[row, :] = rng.normal(0, ugamma_val, numcol)
+        uL1Cquant = rng.uniform(-uL1Cquant_img * np.sqrt(3), uL1Cquant_img * np.sqrt(3), (numrow, numcol)) / 10
+        for d in range(1, hf + 1):  # the empty window d = 0 is skipped
+            w = slice(hf - d, hf + d)
+            s2ref = s2roi[w, w]
+            u_stray_sys = np.mean(u_stray_sys_img[w, w] / 10 * s2ref) / np.mean(s2ref)
+            standardunc = np.mean((unoise[w, w] + u_stray_rand[w, w] + uADC[w, w] + udiffabs + udiffcosine + udiffk +
+                                   uds[w, w] + ugamma[w, w] + uL1Cquant[w, w]) * s2ref) / np.mean(s2ref)
+            roi_uncsize.append(u_stray_sys + udifftemp + standardunc)
+        roi_uncsamp.append(roi_uncsize)
+    return np.array(roi_uncsamp)
+
+
+class S2RoiMcmTest(unittest.TestCase):
+    def create_inputs(self):
+        rng = np.random.RandomState(3)
+        s2roi = rng.uniform(0.1, 0.3, (8, 8))
+        images = [rng.uniform(5, 30, (8, 8)), rng.uniform(1, 3, (8, 8)), rng.uniform(2, 6, (8, 8)),
+                  rng.uniform(1, 4, (8, 8)), rng.uniform(0.5, 2, (8, 8))]
+        values = [0.3, 0.4, 1.1, 0.4, 0.3, 0.4]
+        return s2roi, images, values
+
+    def test_window_sums(self):
+        data = np.arange(49.).reshape(7, 7)
+        table = s2_rut_roi.summed_area_table(data)
+        sums = s2_rut_roi.window_sums(table, np.array([3, 2, 0]), np.array([3, 5, 7]))
+        self.assertEqual([0.0, data[2:5, 2:5].sum(), data.sum()], list(sums))
+
+    def test_statistically_equivalent(self):
+        s2roi, images, values = self.create_inputs()
+        iterations = 4000
+        expected = reference_samples(s2roi, images, values, iterations, np.random.RandomState(1))
+        mcm = s2_rut_roi.S2RoiMcm(s2roi, *(images + values))
+        rut_result = mcm.samples(iterations, np.random.RandomState(2), chunk_bytes=100000)
+
+        self.assertEqual((iterations, 5), rut_result.shape)
+        self.assertTrue(np.isnan(rut_result[:, 0]).all())  # empty window, replaced by the pixel uncertainty
+        for column in range(1, 5):
+            std = expected[:, column - 1].std()
+            self.assertLess(abs(expected[:, column - 1].mean() - rut_result[:, column].mean()),
+                            5 * std / math.sqrt(iterations))
+            self.assertLess(abs(rut_result[:, column].std() / std - 1), 0.08)
+
+    def test_seed_and_chunks(self):
+        s2roi, images, values = self.create_inputs()
+        mcm = s2_rut_roi.S2RoiMcm(s2roi, *(images + values), ugamma_kind='row')
+        first = mcm.samples(50, np.random.RandomState(7))
+        self.assertTrue(np.array_equal(first, mcm.samples(50, np.random.RandomState(7)), equal_nan=True))
+        self.assertEqual((50, 5), mcm.samples(50, np.random.RandomState(7), chunk_bytes=1).shape)
+
+
+class S2RoiAnalyticTest(unittest.TestCase):
+    def test_row_window_sums(self):
+        data = np.arange(49.).reshape(7, 7)
+        sums = s2_rut_roi.row_window_sums(data, np.array([3, 2, 0]), np.array([3, 5, 7]))
+        self.assertEqual([0.0, (data[2:5, 2:5].sum(axis=1) ** 2).sum(), (data.sum(axis=1) ** 2).sum()], list(sums))
+
+    def test_same_as_mcm(self):
+        s2roi, images, values = S2RoiMcmTest().create_inputs()
+        for kind in ['pixel', 'row']:
+            mcm = s2_rut_roi.S2RoiMcm(s2roi, *(images + values), u_stray_rand_kind=kind, ugamma_kind=kind)
+            result = mcm.analytic()
+            samples = mcm.samples(20000, np.random.RandomState(9))
+            self.assertEqual((5,), result.estimate.shape)
+            self.assertTrue(np.isnan(result.estimate[0]))
+            std = samples[:, 1:].std(axis=0)
+            self.assertTrue(np.all(np.abs(samples[:, 1:].mean(axis=0) - result.mean[1:]) < 5 * std / math.sqrt(20000)))
+            self.assertTrue(np.all(np.abs(result.std[1:] / std - 1) < 0.03))
+
+    def test_single_roi(self):
+        s2roi, images, values = S2RoiMcmTest().create_inputs()
+        unoise, u_stray_sys, uADC, uds, uL1Cquant = [image / 10 for image in images]
+        udifftemp, u_stray_rand, udiffabs, udiffcosine, udiffk, ugamma = values
+        contributors = [('pixel', unoise), ('systematic', u_stray_sys), ('pixel', uADC), ('image', uds),
+                        ('pixel', uL1Cquant), ('systematic', udifftemp), ('row', u_stray_rand), ('image', udiffabs),
+                        ('image', udiffcosine), ('image', udiffk), ('pixel', ugamma)]
+        unc = s2_rut_roi.roi_mean_uncertainty(s2roi, contributors)
+        result = s2_rut_roi.S2RoiMcm(s2roi, *(images + values), u_stray_rand_kind='row').analytic()
+        self.assertAlmostEqual(unc.systematic, result.mean[-1])
+        self.assertAlmostEqual(math.sqrt(unc.pixel ** 2 + unc.row ** 2 + unc.image ** 2), result.std[-1], places=6)
+
+
+class S2RoiMeanUncertaintyTest(unittest.TestCase):
+    def test_same_as_analytic(self):
+        # the ROI table of S2RutOp and the analytic MCM use the same correlations (the crosstalk is not in the MCM)
+        s2roi, images, values = S2RoiMcmTest().create_inputs()
+        unoise, u_stray_sys, uADC, uds, uL1Cquant = [image / 10 for image in images]
+        udifftemp, u_stray_rand, udiffabs, udiffcosine, udiffk, ugamma = values
+        contributors = {'unoise': unoise, 'u_stray_sys': u_stray_sys, 'u_stray_rand': u_stray_rand, 'ADC': uADC,
+                        'ds': uds, 'ugamma': ugamma, 'udiffabs': udiffabs, 'udifftemp': udifftemp,
+                        'udiffcosine': udiffcosine, 'udiffk': udiffk, 'uL1Cquant': uL1Cquant}
+        unc = s2_rut_roi.roi_mean_uncertainty(s2roi, [(s2_rut_roi.ROI_CONTRIBUTOR_KINDS[tag], value)
+                                                      for tag, value in contributors.items()])
+        result = s2_rut_roi.S2RoiMcm(s2roi, *(images + values)).analytic()
+        self.assertAlmostEqual(unc.systematic, result.mean[-1])
+        self.assertAlmostEqual(math.sqrt(unc.pixel ** 2 + unc.row ** 2 + unc.image ** 2), result.std[-1], places=6)
+
+    def test_same_as_mcm(self):
+        s2roi, images, values = S2RoiMcmTest().create_inputs()
+        unoise, u_stray_sys, uADC, uds, uL1Cquant = [image / 10 for image in images]
+        udifftemp, u_stray_rand, udiffabs, udiffcosine, udiffk, ugamma = values
+        contributors = [('pixel', unoise), ('systematic', u_stray_sys), ('pixel', uADC), ('image', uds),
+                        ('pixel', uL1Cquant), ('systematic', udifftemp), ('row', u_stray_rand), ('image', udiffabs),
+                        ('image', udiffcosine), ('image', udiffk), ('pixel', ugamma)]
+        unc = s2_rut_roi.roi_mean_uncertainty(s2roi, contributors)
+        samples = s2_rut_roi.S2RoiMcm(s2roi, *(images + values), u_stray_rand_kind='row').samples(
+            20000, np.random.RandomState(8))[:, -1]  # the last window is the whole ROI
+        std = math.sqrt(unc.pixel ** 2 + unc.row ** 2 + unc.image ** 2)
+        self.assertLess(abs(samples.mean() - unc.systematic), 5 * std / math.sqrt(samples.size))
+        self.assertLess(abs(samples.std() / std - 1), 0.03)
+
+    def test_flagged_pixels(self):
+        weights = np.ones((4, 4))
+        weights[0] = 0
+        values = np.full((4, 4), 2.0)
+        values[0] = np.nan  # e.g. no data
+        unc = s2_rut_roi.roi_mean_uncertainty(weights, [('pixel', values), ('row', values), ('image', values),
+                                                        ('systematic', values)])
+        self.assertAlmostEqual(2.0, unc.systematic)
+        self.assertAlmostEqual(2.0 / math.sqrt(12), unc.pixel)
+        self.assertAlmostEqual(2.0 / math.sqrt(3), unc.row)
+        self.assertAlmostEqual(2.0, unc.image)
+        self.assertTrue(np.isnan(s2_rut_roi.roi_mean_uncertainty(np.zeros((2, 2)), []).systematic))
+
+
+class S2RoiStatsTest(unittest.TestCase):
+    def test_streaming_moments(self):
+        rng = np.random.RandomState(4)
+        samples = rng.normal(3, 2, (1000, 3))
+        stats = s2_rut_roi.S2RoiStats(3, reservoir_size=500, rng=rng)
+        for start in range(0, 1000, 130):
+            stats.add(samples[start:start + 130])
+        self.assertEqual(1000, stats.count)
+        self.assertTrue(np.allclose(samples.mean(axis=0), stats.mean))
+        self.assertTrue(np.allclose(samples.std(axis=0), stats.std()))
+        self.assertTrue(np.allclose(samples.std(axis=0, ddof=1), stats.std(ddof=1)))
+        # the reservoir holds a uniform subset of the samples
+        quantiles = stats.quantiles([0.5])
+        self.assertTrue(np.all(np.abs(quantiles - 3) < 0.4))
+
+    def test_adaptive(self):
+        s2roi, images, values = S2RoiMcmTest().create_inputs()
+        mcm = s2_rut_roi.S2RoiMcm(s2roi, *(images + values))
+        result = s2_rut_roi.adaptive_mcm(mcm, 0.05, np.random.RandomState(5), quantiles=[0.025, 0.975])
+        self.assertTrue(result.converged)
+        self.assertLess(result.iterations, 100000)
+        self.assertEqual((2, 5), result.quantiles.shape)
+
+        samples = mcm.samples(20000, np.random.RandomState(6))
+        expected = samples.mean(axis=0) + samples.std(axis=0)
+        self.assertTrue(np.all(np.abs(expected[1:] - result.estimate[1:]) < 0.05))
+
+        result = s2_rut_roi.adaptive_mcm(mcm, 1e-6, np.random.RandomState(5), max_iterations=2000)
+        self.assertFalse(result.converged)
+        self.assertEqual(2000, result.iterations)
+
+
+class S2RoiRunBandsTest(unittest.TestCase):
+    def test_reproducible(self):
+        s2roi, images, values = S2RoiMcmTest().create_inputs()
+        mcms = dict((band_id, s2_rut_roi.S2RoiMcm(s2roi * (1 + 0.1 * band_id), *(images + values)))
+                    for band_id in [0, 3, 7, 12])
+        serial = s2_rut_roi.run_bands(mcms, 42, iterations=300, workers=1)
+        parallel = s2_rut_roi.run_bands(mcms, 42, iterations=300, workers=3)
+        subset = s2_rut_roi.run_bands({7: mcms[7]}, 42, iterations=300, workers=1)
+        for band_id in mcms:
+            self.assertTrue(np.array_equal(serial[band_id].estimate, parallel[band_id].estimate, equal_nan=True))
+        self.assertTrue(np.array_equal(serial[7].estimate, subset[7].estimate, equal_nan=True))
+        self.assertFalse(np.array_equal(serial[0].estimate[1:], serial[3].estimate[1:]))
+
+        adaptive = s2_rut_roi.run_bands(mcms, 42, tolerance=0.1, workers=2)
+        self.assertTrue(all(result.converged for result in adaptive.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
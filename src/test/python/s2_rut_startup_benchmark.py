@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark of S2RutOp: cold import of the RUT modules and operator initialisation with 1, 3 and 13 bands.
+
+Usage (from the repository root):
+    PYTHONPATH=src/main/python python src/test/python/s2_rut_startup_benchmark.py --save baseline.json
+    PYTHONPATH=src/main/python python src/test/python/s2_rut_startup_benchmark.py --product S2A_MSIL1C.SAFE \
+        --compare baseline.json
+
+Every case runs in a fresh interpreter, so that nothing is already imported or initialised, and reports the best
+wall time of --repeat runs. The import cases do not need SNAP. The initialize cases need snappy and the S2RutOp
+plugin: they read the product outside of the measured time and measure GPF.createProduct, which runs
+S2RutOp.initialize without computing any tile. With --compare the run fails (exit code 1) when a case is slower than
+the baseline by more than --threshold. The baseline is machine dependent: create it on the machine that runs the
+comparison.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from s2_rut_algo import S2_BAND_NAMES
+
+IMPORT_MODULES = ['s2_rut', 's2_rut_algo', 's2_rut_roi']
+# one band, one band of each resolution, all bands
+BAND_SETS = {1: ['B2'], 3: ['B2', 'B5', 'B1'], 13: S2_BAND_NAMES}
+
+IMPORT_CHILD = '''
+import sys, time
+start = time.perf_counter()
+import %s
+sys.stdout.write('%%r\\n' %% (time.perf_counter() - start))
+'''
+
+INITIALIZE_CHILD = '''
+import sys, time
+import snappy
+from snappy import jpy
+product = snappy.ProductIO.readProduct(%r)
+parameters = jpy.get_type('java.util.HashMap')()
+parameters.put('band_names', jpy.array('java.lang.String', %r))
+start = time.perf_counter()
+snappy.GPF.createProduct('S2RutOp', parameters, product)
+sys.stdout.write('%%r\\n' %% (time.perf_counter() - start))
+'''
+
+
+def run_child(code):
+    """
+    :return: seconds printed by the last line of the child interpreter
+    """
+    process = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True, env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1'))
+    if process.returncode != 0:
+        raise RuntimeError('Benchmark child failed: ' + process.stderr[-2000:])
+    return float(process.stdout.strip().splitlines()[-1])
+
+
+def get_cases(product):
+    """
+    :return: list of (case name, child code)
+    """
+    cases = [('import/' + module, IMPORT_CHILD % module) for module in IMPORT_MODULES]
+    if product:
+        source = os.path.join(product, 'MTD_MSIL1C.xml') if os.path.isdir(product) else product
+        for count in sorted(BAND_SETS):
+            cases.append(('initialize/%d_bands' % count, INITIALIZE_CHILD % (source, BAND_SETS[count])))
+    return cases
+
+
+def run_benchmark(product, repeat, log=sys.stdout):
+    results = {}
+    for name, code in get_cases(product):
+        results[name] = {'seconds': min(run_child(code) for _ in range(repeat))}
+        if log:
+            log.write('%-30s %9.3f s\n' % (name, results[name]['seconds']))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: list of messages describing the regressions of the results with respect to the baseline
+    """
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        seconds, reference = results[name]['seconds'], baseline[name]['seconds']
+        # the shortest imports are dominated by noise
+        if seconds > reference * (1 + threshold) + 0.01:
+            regressions.append('%s: %.3f s, baseline %.3f' % (name, seconds, reference))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Startup benchmark of S2RutOp')
+    parser.add_argument('--product', help='S2 L1C product (SAFE directory or MTD_MSIL1C.xml) for the initialize '
+                                          'cases. Without it only the imports are measured')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per case (the best one is kept)')
+    parser.add_argument('--save', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', help='JSON baseline to compare the results with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='tolerated relative regression')
+    options = parser.parse_args(args)
+
+    results = run_benchmark(options.product, options.repeat)
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            regressions = compare(results, json.load(f), options.threshold)
+        for regression in regressions:
+            sys.stdout.write('REGRESSION ' + regression + '\n')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
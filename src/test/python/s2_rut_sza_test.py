@@ -0,0 +1,37 @@
+import unittest
+import s2_rut_sza as s2_rut_sza
+import numpy as np
+
+
+class S2SzaGridTest(unittest.TestCase):
+    def plane(self, x, y):
+        return 30.0 + 1e-5 * x - 2e-5 * y
+
+    def create_grid(self):
+        # 5 km grid with nodes at the pixel centres of a 23x23 angle raster starting at (300000, 5000040)
+        x_nodes = 300000 + 2500 + 5000 * np.arange(23)
+        y_nodes = 5000040 - 2500 - 5000 * np.arange(23)
+        values = self.plane(x_nodes[np.newaxis, :], y_nodes[:, np.newaxis])
+        return s2_rut_sza.S2SzaGrid(values, x_nodes[0], y_nodes[0], 5000, -5000)
+
+    def test_plane_is_reproduced_with_extrapolation(self):
+        grid = self.create_grid()
+        for resolution, x, y in [(10, 0, 0), (20, 5000, 100), (60, 1700, 1730)]:
+            sza = grid.tile(300000, 5000040, resolution, -resolution, x, y, 60, 40)
+            columns = 300000 + (np.arange(x, x + 60) + 0.5) * resolution
+            rows = 5000040 - (np.arange(y, y + 40) + 0.5) * resolution
+            expected = self.plane(columns[np.newaxis, :], rows[:, np.newaxis]).ravel()
+            self.assertEqual(sza.dtype, np.float32)
+            self.assertEqual(sza.shape, (2400,))
+            np.testing.assert_allclose(sza, expected, atol=1e-4)
+
+    def test_nan_nodes_are_filled(self):
+        values = np.array([[np.nan, 20.0, 21.0], [19.0, 20.0, 21.0], [np.nan, np.nan, 22.0]])
+        grid = s2_rut_sza.S2SzaGrid(values, 0, 0, 1, 1)
+        self.assertFalse(np.isnan(grid.values).any())
+        self.assertEqual(grid.values[2, 0], 19.0)
+        self.assertFalse(np.isnan(grid.tile(0, 0, 0.5, 0.5, 0, 0, 6, 6)).any())
+
+    def test_single_node(self):
+        grid = s2_rut_sza.S2SzaGrid(np.array([[42.0]]), 0, 0, 5000, -5000)
+        np.testing.assert_allclose(grid.tile(0, 0, 10, -10, 0, 0, 3, 2), 42.0)
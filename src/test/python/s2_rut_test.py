@@ -0,0 +1,18 @@
+import os
+import subprocess
+import sys
+import unittest
+
+
+class S2RutImportTest(unittest.TestCase):
+    def test_lazy_imports(self):
+        # the operator module is imported without snappy, the JVM or the optional compute backends
+        code = ('import sys, s2_rut; sys.stdout.write(" ".join(m for m in ["snappy", "jpy", "numba", "numexpr", '
+                '"xml.etree.ElementTree"] if m in sys.modules))')
+        process = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, universal_newlines=True,
+                                 env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)), check=True)
+        self.assertEqual('', process.stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import json
+import os
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+import s2_rut_timing as s2_rut_timing
+
+# header written by GPF before the tiles are computed
+DIMAP_HEADER = '''<?xml version="1.0" encoding="ISO-8859-1"?>
+<Dimap_Document name="rut.dim">
+    <Dataset_Sources>
+        <MDElem name="metadata">
+            <MDElem name="Processing_datetime">
+                <MDATTR name="PROCESSING_DATETIME" type="ascii" mode="rw">2017-06-09 10:00:00</MDATTR>
+            </MDElem>
+            <MDElem name="Processing_statistics" />
+        </MDElem>
+    </Dataset_Sources>
+</Dimap_Document>
+'''
+
+
+class S2RutTimerTest(unittest.TestCase):
+    def test_laps(self):
+        timer = s2_rut_timing.S2RutTimer()
+        for _ in range(3):
+            mark = timer.start()
+            mark = timer.lap('B2', 'toa', mark)
+            timer.lap('B2', 'uncertainty', mark)
+            timer.add_pixels('B2', 100)
+        timer.lap('10m', 'sza', timer.start())
+
+        totals = timer.totals()
+        self.assertEqual(['10m', 'B2'], sorted(totals))
+        self.assertEqual(300, totals['B2']['pixels'])
+        self.assertEqual(3, totals['B2']['toa_calls'])
+        self.assertEqual(3, totals['B2']['uncertainty_calls'])
+        self.assertAlmostEqual(totals['B2']['toa_seconds'] + totals['B2']['uncertainty_seconds'],
+                               totals['B2']['total_seconds'])
+        self.assertEqual(0, totals['10m']['pixels'])
+
+    def test_write_json(self):
+        timer = s2_rut_timing.S2RutTimer()
+        timer.lap('B8A', 'masks', timer.start())
+        path = os.path.join(tempfile.mkdtemp(), 'timing.json')
+        timer.write_json(path)
+        with open(path) as f:
+            self.assertEqual(1, json.load(f)['B8A']['masks_calls'])
+        os.remove(path)
+
+    def test_write_dimap_statistics(self):
+        timer = s2_rut_timing.S2RutTimer()
+        timer.lap('B2', 'toa', timer.start())
+        timer.add_pixels('B2', 100)
+        path = os.path.join(tempfile.mkdtemp(), 'rut.dim')
+        with open(path, 'w') as f:
+            f.write(DIMAP_HEADER)
+        s2_rut_timing.write_dimap_statistics(path, timer.totals())
+
+        root = ET.parse(path).getroot()
+        statistics = [element for element in root.iter('MDElem') if element.get('name') == 'Processing_statistics']
+        self.assertEqual(['B2'], [element.get('name') for element in statistics[0]])
+        attributes = dict((element.get('name'), element.text) for element in statistics[0][0])
+        self.assertEqual('100', attributes['PIXELS'])
+        self.assertEqual('1', attributes['TOA_CALLS'])
+        self.assertEqual(['Processing_datetime', 'Processing_statistics'],
+                         [element.get('name') for element in root.find('Dataset_Sources')[0]])
+        os.remove(path)
+
+    def test_disabled(self):
+        timer = s2_rut_timing.create_timer(False)
+        timer.add_pixels('B1', 10)
+        self.assertIsNone(timer.lap('B1', 'toa', timer.start()))
+        self.assertEqual({}, timer.totals())
+
+
+if __name__ == '__main__':
+    unittest.main()
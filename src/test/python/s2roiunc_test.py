@@ -7,6 +7,7 @@
 # ===========================================            LIBRARIES            ===========================================
 import os
 import numpy as np
+from collections import OrderedDict
 import datetime
 from scipy.misc import imresize
 import snappy
@@ -19,12 +20,7 @@ import sys  # we need to define the location of the main code to get some of its
 
 sys.path.append(os.path.join(os.getcwd(), 'src', 'main', 'python'))
 import s2_l1_rad_conf as rad_conf
-import s2_rut
-
-s2rutop = s2_rut.S2RutOp()
-import s2_rut_algo
-
-s2rutalgo = s2_rut_algo.S2RutAlgo()
+import s2_rut_roi
 
 # ======================================            CONSTANT VARIABLES            =======================================
 # contains the only valid names of the S2 RUT product bands. S2 L1C product bands use same naming excluding "_rut"
@@ -34,6 +30,14 @@ S2RUT_BAND_SAMPLING = {'B1_rut': 60, 'B2_rut': 10, 'B3_rut': 10, 'B4_rut': 10, '
                        'B8_rut': 10, 'B8A_rut': 20, 'B9_rut': 60, 'B10_rut': 60, 'B11_rut': 20, 'B12_rut': 20}
 
 ITERPOINTS = 2000  # Number of iteration points that MonteCarlo performs
+# Numerical tolerance [%] of the adaptive MonteCarlo: iterations run until the ROI uncertainty is stable within it.
+# None runs ITERPOINTS iterations and keeps all the samples.
+MCM_TOLERANCE = None
+MCM_SEED = 20170609  # master seed of the MonteCarlo. Each band draws from its own stream derived from it
+MCM_WORKERS = None  # number of processes running the bands in parallel (None for all the CPUs)
+# 'analytic' propagates the contributors to the ROI mean in closed form (s2_rut_roi.S2RoiMcm.analytic), 'mcm' draws them
+ROI_METHOD = 'mcm'
+MCM_CROSS_CHECK = False  # with the analytic method, also runs the MonteCarlo and prints the largest difference
 
 # append the two folder directories so that can import the classes inside.
 ROI_PATH = '/home/data/satellite/S2A_MSI/S2ROI/Gobabeb_examplesnap'  # contains the uncertainty products for each site and stores the results
@@ -48,10 +52,49 @@ LON = 15.119
 # In order to work, the ROI width and height must be the same.
 W = 500
 H = 500
+# maximum number of products kept open besides the pinned ones. The least recently used one is disposed
+PRODUCT_CACHE_SIZE = 8
 
 
 # =======================================================================================================================
 
+class ProductCache:
+    def __init__(self, max_size=PRODUCT_CACHE_SIZE):
+        '''
+        Products opened by path, kept open for the next requests. When more than max_size products are open besides
+        the pinned ones, the least recently used one that is not pinned is disposed.
+        :param max_size: maximum number of open products that are not pinned
+        '''
+        self.max_size = max_size
+        self.products = OrderedDict()
+        self.pinned = set()  # paths of the products still referenced by the caller, never disposed before dispose()
+
+    def get(self, path, pin=False):
+        '''
+        :param path: path of the product
+        :param pin: keeps the product open until dispose(), for a caller holding it while other products are read
+        :return: the open product, read if it was not open yet
+        '''
+        if pin:
+            self.pinned.add(path)
+        if path in self.products:
+            self.products.move_to_end(path)
+            return self.products[path]
+        product = snappy.ProductIO.readProduct(path)
+        if product is None:
+            raise RuntimeError('Product "' + path + '" cannot be read')
+        self.products[path] = product
+        unpinned = [open_path for open_path in self.products if open_path not in self.pinned]
+        while len(unpinned) > self.max_size:
+            self.products.pop(unpinned.pop(0)).dispose()
+        return product
+
+    def dispose(self):
+        while self.products:
+            self.products.popitem()[1].dispose()
+        self.pinned.clear()
+
+
 class S2ROIuncprocessor:
     def __init__(self):
         '''
@@ -65,11 +108,14 @@ class S2ROIuncprocessor:
         self.datastrip_meta = None
         self.bandnames = None
         self.source_band = None
+        self.products = ProductCache()  # open products, shared by all the bands
+        self.roi_offsets = {}  # pixel offsets of the ROI by product and sampling (geocoding done once)
+        self.roi_windows = {}  # ROI pixels by product, band and window (read once)
         self.roi_uncpixel = []  # ROI pixels with the systematic uncertainty contributions only selected.
         self.uncpixel = []  # ROI pixels with the specific per pixel uncertainty (all contributions included).
         self.s2roi = []  # TOA reflectance factor values in the Region of Interest
 
-        # These values will be obtained from RUT images in MCMmethod() and read in function MCMalgo()
+        # These values will be obtained from RUT images in MCMmethod() and read in function get_mcm()
         self.unoise = None
         self.u_stray_sys = None
         self.uADC = None
@@ -83,10 +129,10 @@ class S2ROIuncprocessor:
         self.u_stray_rand = None
         self.udiffabs = None
 
-        # Values taken from s2_rut_algo.py. These are fix values.
-        self.udiffcosine = s2rutalgo.u_diff_cos
-        self.udiffk = s2rutalgo.u_diff_k
-        self.ugamma = s2rutalgo.u_gamma
+        # Values taken from s2_l1_rad_conf.py. These are fix values.
+        self.udiffcosine = rad_conf.u_diff_cos
+        self.udiffk = rad_conf.u_diff_k
+        self.ugamma = rad_conf.u_gamma
 
         self.roi_uncMCM = []  # brings all the uncertainty results for the MonteCarlo Method
 
@@ -96,8 +142,9 @@ class S2ROIuncprocessor:
         :param prod: Sentinel-2 product path that is to be processed
         :return:
         '''
-        roiunc_product = snappy.ProductIO.readProduct(os.path.join(ROI_PATH, ROIUNC_FILE))
-        unc_product = snappy.ProductIO.readProduct(os.path.join(ROI_PATH, UNC_FILE))
+        # the products held here stay open while get_unc_image reads the contributor products
+        roiunc_product = self.products.get(os.path.join(ROI_PATH, ROIUNC_FILE), pin=True)
+        unc_product = self.products.get(os.path.join(ROI_PATH, UNC_FILE), pin=True)
         self.bandnames = [i for i in roiunc_product.getBandNames()]
         try:
             self.bandnames == [i for i in unc_product.getBandNames()]
@@ -105,18 +152,13 @@ class S2ROIuncprocessor:
             raise RuntimeError(
                 'Mismatch bands between uncertainty products. All the uncertainty products must have the same bands')
 
-        s2_product = snappy.ProductIO.readProduct(os.path.join(S2_DATA, S2FILE))
+        s2_product = self.products.get(os.path.join(S2_DATA, S2FILE), pin=True)
         metadata_root = s2_product.getMetadataRoot()
         self.datastrip_meta = metadata_root.getElement('Level-1C_DataStrip_ID')
         self.spacecraft = self.datastrip_meta.getElement('General_Info').getElement('Datatake_Info').getAttributeString(
             'SPACECRAFT_NAME')
 
-        f, ax = pt.subplots(nrows=3, ncols=1, sharex=True)  # Plot for MCM
-        f.hold(True)
-        g, ax2 = pt.subplots(nrows=3, ncols=1, sharex=True)  # Plot for MCM vs simple method
-        g.hold(True)
-        colorlist = ['cyan', 'blue', 'green', 'red', 'orange', 'darkred', 'brown', 'black', 'darkviolet', 'aqua',
-                     'sienna', 'magenta', 'darkmagenta']
+        mcms = {}
         for bandname in self.bandnames:
             self.source_band = roiunc_product.getBand(bandname)
             dataroi = self.read_main(S2RUT_BAND_SAMPLING[bandname])
@@ -142,13 +184,44 @@ class S2ROIuncprocessor:
             self.udifftemp = self.get_u_diff_temp(self.datastrip_meta, band_index)
             self.udiffabs = rad_conf.u_diff_absarray[self.spacecraft][band_index]
             self.u_stray_rand = rad_conf.u_stray_rand_all[self.spacecraft][band_index]
-
-            roi_uncsamp = self.MCMalgo()
-
-            roi_uncMCM = [np.mean(roi_uncsamp[:, t]) + np.std(roi_uncsamp[:, t]) for t in
-                          range(0, roi_uncsamp.shape[1])]
+            mcms[band_index] = self.get_mcm()
+
+        if ROI_METHOD == 'analytic':
+            mcm_results = dict((band_index, mcm.analytic()) for band_index, mcm in mcms.items())
+        if ROI_METHOD == 'mcm' or MCM_CROSS_CHECK:
+            # the bands run in parallel, each one with its own random stream. The workers only return the statistics
+            draws = s2_rut_roi.run_bands(mcms, MCM_SEED, ITERPOINTS, MCM_TOLERANCE, MCM_WORKERS)
+            if ROI_METHOD == 'mcm':
+                mcm_results = draws
+            else:
+                for band_index in sorted(draws):
+                    print(S2RUT_BAND_NAMES[band_index] + ': largest difference between MCM and analytic ' +
+                          str(np.nanmax(np.abs(draws[band_index].estimate - mcm_results[band_index].estimate))) + '%')
+        for bandname, datapixel in zip(self.bandnames, self.uncpixel):
+            mcm_result = mcm_results[S2RUT_BAND_NAMES.index(bandname)]
+            if ROI_METHOD == 'mcm' and MCM_TOLERANCE is not None:
+                print(bandname + ': ' + str(mcm_result.iterations) + ' MCM draws, converged: ' +
+                      str(mcm_result.converged))
+            roi_uncMCM = list(mcm_result.estimate)
             roi_uncMCM[0] = np.mean(datapixel) / 10  # the first row is replaced by pixel unc/10!!!
             self.roi_uncMCM.append(roi_uncMCM)
+        self.plot_MCM()
+        self.products.dispose()
+
+    def plot_MCM(self):
+        '''
+        Plots the MCM ROI uncertainty of the bands against the ROI size, and its difference with the select/deselect
+        method.
+        :return:
+        '''
+        f, ax = pt.subplots(nrows=3, ncols=1, sharex=True)  # Plot for MCM
+        f.hold(True)
+        g, ax2 = pt.subplots(nrows=3, ncols=1, sharex=True)  # Plot for MCM vs simple method
+        g.hold(True)
+        colorlist = ['cyan', 'blue', 'green', 'red', 'orange', 'darkred', 'brown', 'black', 'darkviolet', 'aqua',
+                     'sienna', 'magenta', 'darkmagenta']
+        for bandname, dataroi, roi_uncMCM in zip(self.bandnames, self.roi_uncpixel, self.roi_uncMCM):
+            band_index = S2RUT_BAND_NAMES.index(bandname)
             if band_index <= 3:  # Visible
                 a = ax[0]
                 b = ax2[0]
@@ -158,9 +231,9 @@ class S2ROIuncprocessor:
             else:  # case NIR
                 a = ax[1]
                 b = ax2[1]
-            roi_x = [S2RUT_BAND_SAMPLING[bandname] * (1 + 2 * (i - 1)) for i in range(1, roi_uncsamp.shape[1] + 1)]
+            roi_x = [S2RUT_BAND_SAMPLING[bandname] * (1 + 2 * (i - 1)) for i in range(1, len(roi_uncMCM) + 1)]
             a.plot(roi_x, roi_uncMCM, label=bandname[:-4], color=colorlist[band_index], marker='*', linewidth=2)
-            b.plot(roi_x, np.mean(dataroi) / 10 - roi_uncMCM, label=bandname[:-4],
+            b.plot(roi_x, np.mean(dataroi) / 10 - np.array(roi_uncMCM), label=bandname[:-4],
                    color=colorlist[band_index], marker='*', linewidth=2)
             a.grid(True)
             b.grid(True)
@@ -183,27 +256,35 @@ class S2ROIuncprocessor:
         '''
         Convert lat/lon centre coordinates in pixel coordinates of a ROI and extracts values
         :sampling: Spatial sampling in meters from the S2 band.
-        :return: Numpy array with selected ROI of the source band
+        :return: Numpy array with selected ROI of the source band. It is cached: do not modify it
         '''
-
-        # these lines convert centre coordinates LAT, LON in "pix_pos(X,Y)"
+        product_path = str(self.source_band.getProduct().getFileLocation())
         wpix = int(round(W / sampling))  # number of pixels in ROI
         hpix = int(round(H / sampling))
-        geo_pos = snappy.GeoPos()
-        geo_pos.lat = LAT
-        geo_pos.lon = LON
-        pix_pos = snappy.PixelPos()
-        geo_code = self.source_band.getGeoCoding()
-        geo_code.getPixelPos(geo_pos, pix_pos)
-
-        # upper corner of the ROI need to subtract half the ROI size to pix_pos. Rounded to minimise problem
-        x_off = int(round(pix_pos.getX() - wpix / 2))
-        y_off = int(round(pix_pos.getY() - hpix / 2))
+        window_key = (product_path, self.source_band.getName(), LAT, LON, wpix, hpix)
+        if window_key in self.roi_windows:
+            return self.roi_windows[window_key]
+
+        # these lines convert centre coordinates LAT, LON in "pix_pos(X,Y)". All bands of a resolution share them
+        offset_key = (product_path, sampling, LAT, LON, wpix, hpix)
+        if offset_key not in self.roi_offsets:
+            geo_pos = snappy.GeoPos()
+            geo_pos.lat = LAT
+            geo_pos.lon = LON
+            pix_pos = snappy.PixelPos()
+            geo_code = self.source_band.getGeoCoding()
+            geo_code.getPixelPos(geo_pos, pix_pos)
+
+            # upper corner of the ROI need to subtract half the ROI size to pix_pos. Rounded to minimise problem
+            self.roi_offsets[offset_key] = (int(round(pix_pos.getX() - wpix / 2)),
+                                            int(round(pix_pos.getY() - hpix / 2)))
+        x_off, y_off = self.roi_offsets[offset_key]
 
         # with top-coordinates (self.x_off, self.y_off) and size (self.wpix, self.hpix), we can extract the ROI
         roi_data = np.zeros(wpix * hpix, np.float32)
         self.source_band.readPixels(x_off, y_off, wpix, hpix, roi_data)
         roi_data.shape = wpix, hpix
+        self.roi_windows[window_key] = roi_data
         return roi_data
 
     def get_u_diff_temp(self, datastrip_meta, band_id):
@@ -218,78 +299,17 @@ class S2ROIuncprocessor:
         time_start = datetime.datetime.strptime(
             datastrip_meta.getElement('General_Info').getElement('Datastrip_Time_Info').getAttributeString(
                 'DATASTRIP_SENSING_START'), '%Y-%m-%dT%H:%M:%S.%fZ')
-        return (time_start - s2rutop.time_init[self.spacecraft]).days / 365.25 * \
+        return (time_start - rad_conf.time_init[self.spacecraft]).days / 365.25 * \
                rad_conf.u_diff_temp_rate[self.spacecraft][band_id]
 
-    def MCMalgo(self):
+    def get_mcm(self):
         '''
-        This is the core of the MonteCarlo ROI uncertainty calculation. The ROI uncertainty for each contributor is
-        selected. This is the input to a normal or uniform distribution from which samples are extracted.
-        If they are correlated, these samples are extracted from a same distribution and scaled. if uncorrelated the
-        samples are extracted once for each pixel independently. It also brings into consideration the option of only
-        one dimension is correlated. This is obtained by a for loop at each row/ column.
-        The ROI samples are
-        :return:  array with ITERPOINTS samples as rows and different ROI size as columns
+        Builds the MCM engine from the ROI and contributor values of the current band.
+        :return: S2RoiMcm
         '''
-        (numrow, numcol) = self.s2roi.shape
-        hf = int(numrow / 2)  # finds the half width of the ROI
-
-        # Calculate results of the MCM method
-        roi_uncsamp = []
-        for j in range(0, ITERPOINTS):
-            roi_uncsize = []
-            # print "Iteration: " + str(j)
-
-            # ROI OF ERRORS: Each 'uxxx' represent errors out of the distribution (uncertainty) at each iteration
-            # Divide by 10 uncertainty image since is multiplied by that number
-            unoise = np.empty_like(self.s2roi)
-            unoise[:] = np.random.normal(0, self.unoise, (numrow, numcol)) / 10
-
-            u_stray_rand = np.ones_like(self.s2roi) * self.u_stray_rand
-            for row in range(0, numrow):
-                u_stray_rand[row, :] = np.random.normal(0, u_stray_rand[row, :] + 1e-9, numcol)  # avoids 0 std
-
-            uADC = np.empty_like(self.s2roi)
-            uADC[:] = np.random.uniform(-self.uADC * np.sqrt(3), self.uADC * np.sqrt(3), (numrow, numcol)) / 10
-
-            udiffabs = np.ones_like(self.s2roi) * self.udiffabs
-            udiffabs[:] = np.random.normal(0, 1, 1)[0] * udiffabs
-
-            udiffcosine = np.ones_like(self.s2roi) * self.udiffcosine
-            udiffcosine[:] = np.random.normal(0, 1, 1)[0] * udiffcosine
-
-            udiffk = np.ones_like(self.s2roi) * self.udiffk
-            udiffk[:] = np.random.normal(0, 1, 1)[0] * udiffk
-
-            uds = np.empty_like(self.s2roi)
-            uds[:] = np.random.uniform(-1, 1, 1)[0] * self.uds * np.sqrt(3) / 10
-
-            ugamma = np.empty_like(self.s2roi)
-            for row in range(0, numrow):
-                ugamma[row, :] = np.random.normal(0, self.ugamma, numcol)
-
-            uL1Cquant = np.empty_like(self.s2roi)
-            uL1Cquant[:] = np.random.uniform(-self.uL1Cquant * np.sqrt(3), self.uL1Cquant * np.sqrt(3),
-                                             (numrow, numcol)) / 10
-
-            # Combination of all error samples
-            # The errors of the distribution must be multiplied by S2 TOA reflectance pixels (s2ref)
-            # and normalise to the mean of these.
-            for d in range(0, hf + 1):  # d represents at each iteration the pixels from the centre 1x1, 3x3, 5x5
-                s2ref = self.s2roi[hf - d:hf + d, hf - d:hf + d]
-                u_stray_sys = np.mean(self.u_stray_sys[hf - d:hf + d, hf - d:hf + d] / 10 * s2ref) / np.mean(s2ref)
-                sys = u_stray_sys + self.udifftemp
-                standardunc = np.mean(
-                    (unoise[hf - d:hf + d, hf - d:hf + d] + u_stray_rand[hf - d:hf + d, hf - d:hf + d] +
-                     uADC[hf - d:hf + d, hf - d:hf + d] + udiffabs[hf - d:hf + d, hf - d:hf + d] +
-                     udiffcosine[hf - d:hf + d, hf - d:hf + d] + udiffk[hf - d:hf + d, hf - d:hf + d] +
-                     uds[hf - d:hf + d, hf - d:hf + d] + ugamma[hf - d:hf + d, hf - d:hf + d] +
-                     uL1Cquant[hf - d:hf + d, hf - d:hf + d]) * s2ref) / np.mean(s2ref)
-                roi_uncsize.append(sys + standardunc)
-
-            roi_uncsamp.append(roi_uncsize)
-
-        return np.array(roi_uncsamp)
+        return s2_rut_roi.S2RoiMcm(self.s2roi, self.unoise, self.u_stray_sys, self.uADC, self.uds, self.uL1Cquant,
+                                   self.udifftemp, self.u_stray_rand, self.udiffabs, self.udiffcosine, self.udiffk,
+                                   self.ugamma)
 
     def plot_ROI(self, datapixel, dataroi, bandname):
         '''
@@ -342,6 +362,10 @@ class S2ROIuncprocessor:
         :param bandname: string with the name of the band
         :return: ROI uncertainty values for that contributor and band
         '''
-        product = snappy.ProductIO.readProduct(os.path.join(ROI_PATH, ROIUNC_FILE)[:-7] + tagname + '.dim')
-        self.source_band = product.getBand(bandname)
+        # contributor bands written by S2RutOp in the same pass as the uncertainty (contributor_bands parameter)
+        product = self.products.get(os.path.join(ROI_PATH, UNC_FILE))
+        self.source_band = product.getBand(bandname + '_' + tagname)
+        if self.source_band is None:  # separate product computed with only that contributor selected
+            product = self.products.get(os.path.join(ROI_PATH, ROIUNC_FILE)[:-7] + tagname + '.dim')
+            self.source_band = product.getBand(bandname)
         return self.read_main(S2RUT_BAND_SAMPLING[bandname])
\ No newline at end of file
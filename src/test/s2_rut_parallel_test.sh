@@ -2,12 +2,13 @@
 # This is a example to run the S2-RUT with 2 products in parallel
 # The following script can be run from any UNIX terminal by typing "bash s2_rut_parallel_test.sh"
 # The users can use this as a template to accommodate more products, properties...
+# s2_rut_batch.py runs at most --workers products at the same time, with a memory budget of --memory_mb per job.
+# The state of the products is kept in s2_rut_manifest.json in the output directory: running the script again
+# only processes the products that are missing or failed.
 
 S2PRODUCTS=("S2A_MSIL1C_20180220T105051_N0206_R051_T30SYJ_20180221T134037.SAFE" "S2B_MSIL1C_20180225T105019_N0206_R051_T30SYJ_20180225T161518.SAFE")
 basePath="/home/jg9/s2rutv2_testproduct/"
+scriptPath="$(dirname "$0")/../main/python"
 
-for prod in "${S2PRODUCTS[@]}";
-do
-    outpath=$basePath${prod:0:(-5)}_rut.dim
-    /opt/snap/bin/gpt S2RutOp -Ssource=$basePath$prod -t $outpath -Pband_names="B1,B2,B3" &
-done
\ No newline at end of file
+python3 $scriptPath/s2_rut_batch.py "${S2PRODUCTS[@]/#/$basePath}" --output_dir $basePath --workers 2 \
+    --memory_mb 4096 --bands B1,B2,B3 --gpt /opt/snap/bin/gpt